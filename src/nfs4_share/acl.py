@@ -1,9 +1,14 @@
 import os
 import re
+import functools
 import pwd
 import grp
 import subprocess
 import logging
+from collections import OrderedDict
+
+from . import events
+from . import metrics
 
 # Basic paths to binaries
 getfacl_bin = "/usr/bin/nfs4_getfacl"
@@ -18,58 +23,73 @@ def assert_command_exists(command_path):
 
 class AccessControlList:
     """
-    Representation of an NFSv4 ACL (LIST)
+    Representation of an NFSv4 ACL (LIST): an ordered set of ACEs. The order matters as the NFS server evaluates the
+    ACEs from first to last, and an ACE that re-appears later in the list has no effect so duplicates are dropped.
+
+    Union (+) keeps the order of the left-hand ACL and places the new entries of the right-hand ACL as follows:
+    * DENY entries directly after the leading DENY entries (i.e. before the first ALLOW entry), so they are not
+      overruled by an ALLOW entry of the existing list (e.g. LOCK_ACE)
+    * all other entries at the end
+    Difference (-) keeps the order of the left-hand ACL. Union, difference and replace() take linear time, membership
+    checks constant time.
     """
 
-    def __init__(self, entries):
-        if type(entries) not in [set, list]:
-            raise TypeError("Entries should be a set or list")
-        self.entries = entries
+    def __init__(self, entries=()):
+        if isinstance(entries, (str, bytes)) or not hasattr(entries, '__iter__'):
+            raise TypeError("Entries should be an iterable of AccessControlEntity")
+        self._entries = OrderedDict.fromkeys(entries)  # The keys are the entries
+
+    @property
+    def entries(self):
+        return list(self._entries)
 
     def __repr__(self):
-        return ",".join([repr(i) for i in self.entries])
+        return ",".join([repr(i) for i in self._entries])
 
     def __eq__(self, other):
         return self.entries == other.entries
 
+    def __hash__(self):
+        return hash(tuple(self._entries))
+
     def __iter__(self):
-        return iter(self.entries)
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, entry):
+        return entry in self._entries
 
     def __lt__(self, other):
         return str(self) > str(other)
 
     def __sub__(self, other):  # self - other
-        first_index, last_index = find_sub_list(other.entries, self.entries)
-        if first_index is None:  # No sublist was found
-            return self
-        new_acl = AccessControlList(self.entries[:first_index]+self.entries[last_index+1:])
-        return new_acl
+        other = other if isinstance(other, AccessControlList) else AccessControlList(other)
+        return AccessControlList(entry for entry in self._entries if entry not in other)
 
     def __add__(self, other):
-        new_acl = AccessControlList(set(self.entries + other.entries))
-        return new_acl
+        entries = list(self._entries)
+        leading_denies = next((index for index, entry in enumerate(entries) if entry.entry_type != 'D'), len(entries))
+        new_entries = [entry for entry in other if entry not in self._entries]
+        new_denies = [entry for entry in new_entries if entry.entry_type == 'D']
+        entries[leading_denies:leading_denies] = new_denies
+        entries.extend(entry for entry in new_entries if entry.entry_type != 'D')
+        return AccessControlList(entries)
+
+    def replace(self, old, new):
+        """
+        Returns a copy in which entry old is replaced by new at the same position (new is dropped from any later
+        position). Returns an unchanged copy when old is absent.
+        """
+        if old not in self._entries:
+            return AccessControlList(self._entries)
+        return AccessControlList(new if entry == old else entry for entry in self._entries)
 
     @classmethod
     def from_file(cls, filename):
         """Calls the nfs4_getfacl binaries via CLI to get ACEs"""
-        global getfacl_bin
-        assert_command_exists(getfacl_bin)
-        try:
-            output = subprocess.check_output([getfacl_bin, filename], stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            logging.error(e.cmd)
-            logging.error(e.stdout.decode())
-            logging.error(e.stderr.decode())
-            raise e
-        entries = []
-        for line in nonblank_lines(output.decode().split("\n")):
-            if line.startswith('#'):
-                continue
-            entry = AccessControlEntity.from_string(line, filename=filename)
-            entries.append(entry)
-        if len(entries) == 0:
-            raise OSError("Could not get ACLs from file \'%s\'" % filename)
-        return cls(entries)
+        return cls(read_entries(filename))
 
     def append(self, *args, **kwargs):
         self._change_nfs4('-a', *args, **kwargs)
@@ -80,11 +100,19 @@ class AccessControlList:
     def unset(self, *args, **kwargs):
         self._change_nfs4('-x', *args, **kwargs)
 
+    def set_many(self, targets, batch_size=256):
+        """
+        Sets this ACL on many files, calling nfs4_setfacl once per batch of files instead of once per file
+        """
+        targets = [str(target) for target in targets]
+        for start in range(0, len(targets), batch_size):
+            self._change_nfs4('-s', targets[start:start + batch_size])
+
     def _change_nfs4(self, action, target, recursive=False, test=False):
         """
-        Calls the nfs4_setfacl binaries via CLI to change permissions
+        Calls the nfs4_setfacl binaries via CLI to change permissions of a target (or a list of targets)
         """
-        logging.debug("Changing permissions (%s) on %s (recursive=%s)" % (action, target, recursive))
+        logging.debug("Changing permissions (%s) on %s (recursive=%s)", action, target, recursive)
         global setfacl_bin
         assert_command_exists(setfacl_bin)
         command = [setfacl_bin]
@@ -93,13 +121,73 @@ class AccessControlList:
         if test:
             command.append('--test')
         command.append(action)
-        command.extend([repr(self), target])
+        acl_text = repr(self)
+        command.append(acl_text)
+        targets = target if isinstance(target, list) else [target]
+        command.extend(targets)
+        metrics.count('nfs4_share_acl_calls_total', binary='nfs4_setfacl')
         try:
             subprocess.check_output(command, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
             logging.error("Subprocess: %s" % e.cmd)
             logging.error("Subprocess: %s" % e.output.decode())
             raise e
+        if events.sink is not None:
+            for path in targets:
+                events.emit('setfacl', path, action=action, acl=acl_text)
+
+
+def _getfacl(filenames):
+    global getfacl_bin
+    assert_command_exists(getfacl_bin)
+    metrics.count('nfs4_share_acl_calls_total', binary='nfs4_getfacl')
+    try:
+        output = subprocess.check_output([getfacl_bin] + list(filenames), stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        logging.error(e.cmd)
+        logging.error(e.output.decode())
+        raise e
+    return output.decode()
+
+
+def read_entries(filename):
+    """
+    Calls the nfs4_getfacl binaries via CLI to get the ACEs of a file, in order and including duplicates
+    """
+    entries = []
+    for line in nonblank_lines(_getfacl([filename]).split("\n")):
+        if line.startswith('#'):
+            continue
+        entry = AccessControlEntity.from_string(line, filename=filename)
+        entries.append(entry)
+    if len(entries) == 0:
+        raise OSError("Could not get ACLs from file \'%s\'" % filename)
+    return entries
+
+
+def read_entries_batch(filenames, batch_size=256):
+    """
+    Generates (filename, entries) for many files, calling nfs4_getfacl once per batch of files instead of once per
+    file. Relies on the '# file: <filename>' headers nfs4_getfacl prints; falls back on read_entries per file when the
+    installed version does not print them.
+    """
+    filenames = list(filenames)
+    for start in range(0, len(filenames), batch_size):
+        batch = filenames[start:start + batch_size]
+        sections = {}
+        current = None
+        for line in nonblank_lines(_getfacl(batch).split("\n")):
+            if line.startswith('# file: '):
+                current = sections[line[len('# file: '):]] = []
+            elif not line.startswith('#') and current is not None:
+                current.append(line)
+        if sorted(sections) != sorted(batch):
+            logging.debug("nfs4_getfacl did not label its output per file, reading the ACLs one file at a time")
+            for filename in batch:
+                yield filename, read_entries(filename)
+            continue
+        for filename in batch:
+            yield filename, [AccessControlEntity.from_string(line, filename=filename) for line in sections[filename]]
 
 
 class AccessControlEntity:
@@ -140,7 +228,8 @@ class AccessControlEntity:
         return True
 
     def __hash__(self):
-        return hash(str(self))
+        # Consistent with __eq__, which ignores the order of the permissions
+        return hash((self.entry_type, self.flags, self.identity, self.domain, frozenset(self.permissions)))
 
     def __lt__(self, other):
         return str(self) > str(other)
@@ -200,7 +289,12 @@ class AccessControlEntity:
             raise NotImplementedError("Cannot translate %s" % principal)
 
 
+@functools.lru_cache(maxsize=None)
 def get_nfs4_domain():
+    """
+    Looks up the NFSv4 domain in /etc/idmapd.conf and falls back on `dnsdomainname`. The result is cached as it does
+    not change during the lifetime of the process and every special principal translation needs it.
+    """
     domain = subprocess.run(['egrep', '-s', '^Domain', '/etc/idmapd.conf'],
                             stdout=subprocess.PIPE).stdout.decode('utf-8').rstrip()
     try:
@@ -212,16 +306,38 @@ def get_nfs4_domain():
     return (domain)
 
 
+@functools.lru_cache(maxsize=None)
+def group_members(group):
+    """
+    Returns the set of users that are a member of a group, either as supplementary or as primary group. Returns an
+    empty set for an unknown group.
+    """
+    try:
+        group_info = grp.getgrnam(group)
+    except KeyError:
+        return frozenset()
+    members = set(group_info.gr_mem)
+    members.update(user.pw_name for user in pwd.getpwall() if user.pw_gid == group_info.gr_gid)
+    return frozenset(members)
+
+
+@functools.lru_cache(maxsize=None)
+def user_groups(user):
+    """
+    Returns the set of groups (names) a user is a member of, including the primary group
+    """
+    user_info = pwd.getpwnam(user)
+    groups = set()
+    for gid in os.getgrouplist(user, user_info.pw_gid):
+        try:
+            groups.add(grp.getgrgid(gid).gr_name)
+        except KeyError:  # A group id without a name
+            continue
+    return frozenset(groups)
+
+
 def nonblank_lines(f):
     for line in f:
         line = line.rstrip()
         if line:
             yield line
-
-
-def find_sub_list(sublist, mainlist):
-    sublist_length = len(sublist)
-    for index in (i for i, e in enumerate(mainlist) if e == sublist[0]):
-        if mainlist[index:index + sublist_length] == sublist:
-            return index, index+sublist_length-1
-    return None, None
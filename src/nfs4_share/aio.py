@@ -0,0 +1,399 @@
+import os
+import fcntl
+import asyncio
+import logging
+import functools
+import subprocess
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from . import acl
+from . import checksum
+from . import htaccess
+from . import manage
+from . import track_changes
+from .acl import AccessControlList, AccessControlEntity, nonblank_lines
+from .filters import PathFilter
+from .share import Share, ShareBusyError, ItemResults, open_flock_file, LOCK_ACL, LOCK_POLL_INTERVAL, LINKED, RELINKED, \
+    PRESENT, FILTERED, UNHANDLED, REMOVED
+from .sync import scan_item, apply_operations
+
+# Threads that run the blocking filesystem calls of all operations
+max_filesystem_workers = 16
+# nfs4_getfacl/nfs4_setfacl processes that run at the same time over all operations
+max_acl_processes = 8
+# Share operations that run at the same time, others wait for their turn
+max_operations = 4
+# Operations (links, directories, ...) that are applied per executor call; progress is reported per batch
+BATCH_SIZE = 256
+# Files per nfs4_setfacl call
+ACL_BATCH_SIZE = 256
+
+_executor = None
+_limits = weakref.WeakKeyDictionary()  # Per event loop, as asyncio primitives belong to one loop
+
+
+class Limits:
+    """
+    The concurrency limits shared by the operations that run on one event loop
+    """
+
+    def __init__(self):
+        self.operations = asyncio.Semaphore(max_operations)
+        self.acl_processes = asyncio.Semaphore(max_acl_processes)
+
+
+def limits():
+    loop = asyncio.get_event_loop()
+    if loop not in _limits:
+        _limits[loop] = Limits()
+    return _limits[loop]
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max_filesystem_workers)
+    return _executor
+
+
+async def _complete(future):
+    """
+    Awaits a future. When the awaiting task is cancelled, the future is still awaited before the cancellation
+    propagates, so no filesystem call or ACL binary is left running in the background of a cancelled operation.
+    """
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+
+async def run_blocking(function, *args, **kwargs):
+    """
+    Runs a blocking (filesystem) call in the shared, bounded executor
+    """
+    loop = asyncio.get_event_loop()
+    return await _complete(loop.run_in_executor(executor(), functools.partial(function, *args, **kwargs)))
+
+
+async def _run_acl_binary(command):
+    async with limits().acl_processes:
+        process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output, _ = await _complete(asyncio.ensure_future(process.communicate()))
+    if process.returncode != 0:
+        logging.error("Subprocess: %s" % command)
+        logging.error("Subprocess: %s" % output.decode())
+        raise subprocess.CalledProcessError(process.returncode, command, output)
+    return output.decode()
+
+
+async def read_acl(filename):
+    """
+    Returns the ACL of a file, read with an nfs4_getfacl subprocess
+    """
+    acl.assert_command_exists(acl.getfacl_bin)
+    output = await _run_acl_binary([acl.getfacl_bin, str(filename)])
+    return AccessControlList(AccessControlEntity.from_string(line, filename=str(filename))
+                             for line in nonblank_lines(output.split("\n")) if not line.startswith('#'))
+
+
+async def change_acl(access_control_list, targets, action='-s'):
+    """
+    Sets (-s), appends (-a) or removes (-x) an ACL on targets with nfs4_setfacl subprocesses, one per batch of targets
+    """
+    acl.assert_command_exists(acl.setfacl_bin)
+    targets = [str(target) for target in targets]
+    for start in range(0, len(targets), ACL_BATCH_SIZE):
+        await _run_acl_binary([acl.setfacl_bin, action, repr(access_control_list)] + targets[start:start + ACL_BATCH_SIZE])
+
+
+class ShareLock:
+    """
+    Asynchronous counterpart of share.share_flock (the same lock file, so it excludes the synchronous operations as
+    well): waiting for the lock does not block the event loop and can be cancelled
+    """
+
+    def __init__(self, directory, exclusive=True, timeout=None):
+        self.directory = os.path.realpath(str(directory))
+        self.exclusive = exclusive
+        self.timeout = timeout
+        self.lock_file = None
+
+    async def __aenter__(self):
+        self.lock_file = open_flock_file(self.directory, self.exclusive)
+        if self.lock_file is None:
+            return self
+        loop = asyncio.get_event_loop()
+        deadline = None if self.timeout is None else loop.time() + self.timeout
+        try:
+            while True:
+                try:
+                    fcntl.flock(self.lock_file, (fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+                    return self
+                except BlockingIOError:
+                    if deadline is not None and loop.time() >= deadline:
+                        raise ShareBusyError("Share %s is in use by another process (waited %ss)" %
+                                             (self.directory, self.timeout))
+                    await asyncio.sleep(LOCK_POLL_INTERVAL)
+        except BaseException:
+            self.lock_file.close()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        if self.lock_file is None:
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+async def _set_locked(share, locked):
+    """
+    Locks or unlocks a share like Share.lock/unlock, with one nfs4_setfacl call for the share and its subdirectories
+    """
+    permissions = await read_acl(share.directory)
+    await change_acl(Share.manage_write_adjusted(permissions, add_write=not locked), [share.directory])
+    subdirectories = await run_blocking(lambda: list(share._subdirectories()))
+    await change_acl(LOCK_ACL, [share.directory] + subdirectories, action='-a' if locked else '-x')
+
+
+async def _add_items(share, items, path_filter, symlinks, progress):
+    """
+    Adds items to a share in batches, reporting progress(item, done, total) after every batch. Existing items are
+    brought up to date in place (see sync.scan_item) instead of being unshared and linked again. When the operation is
+    cancelled, a partially added new item is removed again; a partially updated item remains a valid (if incomplete)
+    copy of its source.
+    """
+    results = ItemResults()
+    # Directories are created without an ACL in the executor, the ACL of the share is set on them per batch
+    permissions = await read_acl(share.directory)
+    try:
+        for item in items:
+            item = str(item)
+            target = os.path.join(share.directory, os.path.basename(item))
+            if not os.path.isfile(item) and not os.path.isdir(item):
+                logging.error("Did not handle input item '%s'" % item)
+                results.record(item, UNHANDLED, "not a file or directory")
+                continue
+            if os.path.isfile(item) and path_filter and not path_filter.includes_file(os.path.basename(item)):
+                results.record(item, FILTERED)
+                continue
+            existed = os.path.lexists(target)
+            operations, _, _ = await run_blocking(scan_item, item, target, path_filter, symlinks)
+            failed = set()
+            new_directories = []
+            try:
+                for start in range(0, len(operations), BATCH_SIZE):
+                    failed |= await run_blocking(apply_operations, share, operations[start:start + BATCH_SIZE],
+                                                 new_directories=new_directories)
+                    await _set_acl_on_new_directories(permissions, new_directories)
+                    if progress is not None:
+                        progress(item, min(start + BATCH_SIZE, len(operations)), len(operations))
+            except asyncio.CancelledError:
+                if not existed and os.path.lexists(target):
+                    logging.info("Cancelled, removing the partially added %s" % target)
+                    await run_blocking(_remove, share, target)
+                else:
+                    await _set_acl_on_new_directories(permissions, new_directories)
+                raise
+            if os.path.isdir(item) and path_filter and not os.path.lexists(target):
+                results.record(item, FILTERED, "nothing passes the filter")
+                continue
+            status = LINKED if not existed else RELINKED if operations else PRESENT
+            results.record(item, status, "%d directories could not be fully linked" % len(failed) if failed else None)
+    finally:
+        await run_blocking(share.record_items, results.with_status(LINKED, RELINKED, PRESENT), path_filter, symlinks)
+    return results
+
+
+async def _set_acl_on_new_directories(permissions, new_directories):
+    """
+    Sets the ACL of the share on the directories that apply_operations created without it (the ones that were removed
+    again within the same batch are left out), and empties the list
+    """
+    directories = await run_blocking(lambda: [directory for directory in new_directories if os.path.isdir(directory)])
+    new_directories.clear()
+    if directories:
+        await change_acl(permissions, directories)
+
+
+def _remove(share, target):
+    if os.path.isdir(target) and not os.path.islink(target):
+        share._unshare_linked_tree(target)
+    else:
+        share._unshare_file(target)
+
+
+def _initialize_tracking(track_change_dir, share_directory):
+    if track_change_dir is not None:
+        track_changes.initialize_file_list(track_change_dir, share_directory)
+        track_changes.initialize_user_list(track_change_dir, share_directory)
+
+
+def _track(track_change_dir, share_directory, added=(), removed=(), users_added=False, users_removed=()):
+    if track_change_dir is None:
+        return
+    with track_changes.transaction(track_change_dir):
+        if added:
+            track_changes.track_file_addition(track_change_dir, share_directory, added)
+        if removed:
+            track_changes.track_file_deletion(track_change_dir, share_directory, removed)
+        if users_added:
+            track_changes.track_user_addition(track_change_dir, share_directory)
+        if users_removed:
+            track_changes.track_user_removal(track_change_dir, share_directory, users_removed)
+
+
+async def _ensure_exist(users=(), groups=(), items=()):
+    await run_blocking(manage.ensure_users_exist, list(users))
+    await run_blocking(manage.ensure_groups_exist, list(groups))
+    await run_blocking(manage.ensure_items_exist, list(items))
+
+
+async def create(share_directory, domain=None, user_apache_directive="{}", group_apache_directive="{}", items=None,
+                 users=None, groups=None, managing_users=None, managing_groups=None, lock=True,
+                 service_application_accounts=None, track_change_dir=None, include=None, exclude=None,
+                 symlinks='follow', wait=None, progress=None):
+    """
+    Creates a share like manage.create without blocking the event loop. progress(item, done, total) is called as the
+    items are linked. When cancelled, the share is removed again.
+    """
+    items, users, groups = items or [], users or [], groups or []
+    if managing_users is None and managing_groups is None:
+        raise RuntimeError("A share needs to have either a managing user or group!")
+    managing_users, managing_groups = managing_users or [], managing_groups or []
+    service_application_accounts = service_application_accounts or []
+    await _ensure_exist(users + managing_users + service_application_accounts, groups + managing_groups, items)
+    domain = await run_blocking(manage.resolve_domain, domain)
+    async with limits().operations, ShareLock(share_directory, timeout=wait):
+        share = await run_blocking(Share, str(share_directory))
+        try:
+            await change_acl(manage.generate_permissions(users=users + service_application_accounts, groups=groups,
+                                                         managing_users=managing_users,
+                                                         managing_groups=managing_groups, domain=domain,
+                                                         manage_permissions=share.MANAGE_PERMISSION_UNLOCK),
+                             [share.directory])
+            results = await _add_items(share, items, PathFilter(include, exclude), symlinks, progress)
+            await run_blocking(htaccess.create_at, share=share, users=users + managing_users,
+                               user_directive_template=user_apache_directive, groups=groups + managing_groups,
+                               group_directive_template=group_apache_directive)
+            if lock:
+                await _set_locked(share, True)
+        except asyncio.CancelledError:
+            logging.info("Cancelled, removing the partially created share %s" % share.directory)
+            await run_blocking(_destroy, share)
+            raise
+        await run_blocking(_initialize_tracking, track_change_dir, share.directory)
+        await run_blocking(_track, track_change_dir, share.directory, added=results.linked, users_added=True)
+    return share
+
+
+def _destroy(share, force=False):
+    share.unlock()
+    htaccess.remove_from(share, absent_ok=True)
+    checksum.remove_manifests(share)
+    share.self_destruct(force_file_removal=force)
+
+
+async def add(share_directory, domain=None, user_apache_directive="{}", group_apache_directive="{}", items=None,
+              users=None, groups=None, managing_users=None, managing_groups=None, lock=False,
+              service_application_accounts=None, track_change_dir=None, include=None, exclude=None,
+              symlinks='follow', wait=None, progress=None):
+    """
+    Adds items and users to a share like manage.add without blocking the event loop. Returns the ItemResults of the
+    items. progress(item, done, total) is called as the items are linked. When cancelled, the share is left with the
+    items that were completed (and locked again if lock is set).
+    """
+    items, users, groups = items or [], users or [], groups or []
+    managing_users, managing_groups = managing_users or [], managing_groups or []
+    service_application_accounts = service_application_accounts or []
+    await _ensure_exist(users, groups, items)
+    async with limits().operations, ShareLock(share_directory, timeout=wait):
+        share = await run_blocking(Share, str(share_directory), exist_ok=True)
+        await run_blocking(_initialize_tracking, track_change_dir, share.directory)
+        await _set_locked(share, False)
+        try:
+            results = await _add_items(share, items, PathFilter(include, exclude), symlinks, progress)
+            if users or groups:
+                domain = await run_blocking(manage.resolve_domain, domain)
+                await run_blocking(htaccess.append_at, share=share, users=users + managing_users,
+                                   user_directive_template=user_apache_directive, groups=groups + managing_groups,
+                                   group_directive_template=group_apache_directive)
+                permissions = await read_acl(share.directory)
+                await change_acl(permissions + manage.generate_permissions(
+                    users=users + service_application_accounts, groups=groups, managing_users=managing_users,
+                    managing_groups=managing_groups, domain=domain, manage_permissions=share.MANAGE_PERMISSION_UNLOCK),
+                    [share.directory])
+        finally:
+            if lock:
+                await _set_locked(share, True)
+        await run_blocking(_track, track_change_dir, share.directory, added=results.linked,
+                           users_added=bool(users or groups))
+    return results
+
+
+async def delete(share_directory, domain=None, force=False, items=None, users=None, groups=None,
+                 track_change_dir=None, lock=False, wait=None, progress=None, user_apache_directive="{}",
+                 group_apache_directive="{}"):
+    """
+    Removes items and users from a share, or the whole share when neither are given, like manage.delete without
+    blocking the event loop. progress(item, done, total) is called after every removed item. When cancelled, the items
+    that were removed so far stay removed (an item is never left half removed).
+    """
+    items, users, groups = items or [], users or [], groups or []
+    if not os.path.exists(str(share_directory)):
+        raise FileNotFoundError(share_directory)
+    async with limits().operations, ShareLock(share_directory, timeout=wait):
+        share = await run_blocking(Share, str(share_directory), exist_ok=True)
+        await run_blocking(_initialize_tracking, track_change_dir, share.directory)
+        if not items and not users and not groups:
+            await run_blocking(_destroy, share, force)
+            if track_change_dir is not None:
+                await run_blocking(track_changes.track_share_deletion, track_change_dir, share.directory)
+            return None
+        await _set_locked(share, False)
+        results = ItemResults()
+        removed_users = []
+        try:
+            targets = [os.path.join(share.directory, os.path.basename(str(item))) for item in items]
+            for index, target in enumerate(targets):
+                for result in await run_blocking(share.remove_items, [target], force):
+                    results.record(result.item, result.status, result.reason)
+                if progress is not None:
+                    progress(target, index + 1, len(targets))
+            if users or groups:
+                domain = await run_blocking(manage.resolve_domain, domain)
+                await run_blocking(htaccess.remove_at, share=share, target_users=users, target_groups=groups,
+                                   user_directive_template=user_apache_directive,
+                                   group_directive_template=group_apache_directive)
+                permissions = await read_acl(share.directory)
+                to_remove = manage.generate_permissions(users=users, groups=groups, managing_users=[],
+                                                        managing_groups=[], domain=domain,
+                                                        manage_permissions=share.MANAGE_PERMISSION_UNLOCK)
+                await change_acl(permissions - to_remove, [share.directory])
+                not_removed = {entry.identity for entry in to_remove - permissions}
+                removed_users = sorted(set(users + groups) - not_removed)
+        finally:
+            if lock:
+                await _set_locked(share, True)
+            await run_blocking(_track, track_change_dir, share.directory, removed=results.with_status(REMOVED),
+                               users_removed=removed_users)
+    return results
+
+
+async def lock(share_directory, wait=None):
+    """
+    Locks a share without blocking the event loop
+    """
+    async with limits().operations, ShareLock(share_directory, timeout=wait):
+        await _set_locked(Share(str(share_directory), exist_ok=True), True)
+
+
+async def unlock(share_directory, wait=None):
+    """
+    Unlocks a share without blocking the event loop
+    """
+    if not os.path.exists(str(share_directory)):
+        raise FileNotFoundError(share_directory)
+    async with limits().operations, ShareLock(share_directory, timeout=wait):
+        await _set_locked(Share(str(share_directory), exist_ok=True), False)
@@ -0,0 +1,152 @@
+import os
+import fcntl
+import hashlib
+import logging
+import tempfile
+
+# Consolidated Apache access map that is kept up to date whenever the access file of a share changes (None disables)
+apache_map = os.environ.get('NFS4_SHARE_APACHE_MAP') or None
+
+HEADER = "# Generated by nfs4_share from the access files of the shares, do not edit (see `nfs4_share apache-map -h`)\n"
+
+
+def fragment_directory(map_file):
+    """
+    Returns the directory with the per-share fragments a map is assembled from
+    """
+    return "%s.d" % map_file
+
+
+def fragment_file(map_file, share_directory):
+    share_directory = os.path.realpath(str(share_directory))
+    digest = hashlib.sha1(share_directory.encode()).hexdigest()[:12]
+    return os.path.join(fragment_directory(map_file), "%s-%s.conf" % (os.path.basename(share_directory), digest))
+
+
+def directory_block(share_directory, lines):
+    """
+    Returns the <Directory> block that applies the access lines of a share (as in its access file)
+    """
+    share_directory = os.path.realpath(str(share_directory))
+    lines = [line for line in lines if line]
+    if not [line for line in lines if line not in ('<RequireAny>', '</RequireAny>')]:
+        lines = ['Require all denied']  # Apache refuses an empty <RequireAny>
+    block = ['<Directory "%s">' % share_directory.replace('\\', '\\\\').replace('"', '\\"')]
+    block += ["    %s" % line for line in lines]
+    block.append('</Directory>')
+    return "".join("%s\n" % line for line in block)
+
+
+def replace_file(filename, content):
+    """
+    Atomically replaces the content of a file unless it is unchanged, returns whether it was written
+    """
+    try:
+        with open(filename, 'r') as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(tmp_filename, 0o644)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+    return True
+
+
+def assemble(map_file):
+    """
+    (Re)writes the map from its fragments. Concurrent updates are serialized with a lock file next to the map so the
+    map always reflects the latest fragments. Returns whether the map changed.
+    """
+    os.makedirs(fragment_directory(map_file), exist_ok=True)
+    with open("%s.lock" % map_file, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            content = [HEADER]
+            for name in sorted(os.listdir(fragment_directory(map_file))):
+                if name.endswith('.conf'):
+                    with open(os.path.join(fragment_directory(map_file), name), 'r') as f:
+                        content.append(f.read())
+            changed = replace_file(map_file, "\n".join(content))
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    if changed:
+        logging.info("Updated the Apache access map %s (reload Apache to apply it)" % map_file)
+    return changed
+
+
+def update_share(share_directory, lines, map_file=None):
+    """
+    Updates the access of a single share in the map (defaults to apache_map, a no-op when that is not set).
+    Returns whether the map changed.
+    """
+    map_file = map_file or apache_map
+    if not map_file:
+        return False
+    if not replace_file(fragment_file(map_file, share_directory), directory_block(share_directory, lines)):
+        return False
+    return assemble(map_file)
+
+
+def remove_share(share_directory, map_file=None):
+    """
+    Removes a share from the map (defaults to apache_map, a no-op when that is not set)
+    """
+    map_file = map_file or apache_map
+    if not map_file:
+        return False
+    try:
+        os.remove(fragment_file(map_file, share_directory))
+    except FileNotFoundError:
+        return False
+    return assemble(map_file)
+
+
+def generate(root, map_file):
+    """
+    Rebuilds the fragments of all shares below root from their access files, dropping the fragments of shares that
+    no longer exist, and assembles the map
+    """
+    from . import walk
+    from .htaccess import AccessFile, HTACCESS_FILENAME
+    root = os.path.realpath(str(root))
+    os.makedirs(fragment_directory(map_file), exist_ok=True)
+    expected = set()
+    for share_directory in sorted(walk.share_directories(root)):
+        access_file = AccessFile.read(os.path.join(share_directory, HTACCESS_FILENAME))
+        if access_file.original is None:
+            logging.debug("Skipping %s, it has no access file" % share_directory)
+            continue
+        expected.add(os.path.basename(fragment_file(map_file, share_directory)))
+        replace_file(fragment_file(map_file, share_directory), directory_block(share_directory, access_file.lines))
+    for name in os.listdir(fragment_directory(map_file)):
+        if name in expected or not name.endswith('.conf'):
+            continue
+        # Only fragments of shares below root are ours to remove
+        with open(os.path.join(fragment_directory(map_file), name), 'r') as f:
+            first_line = f.readline()
+        share_directory = first_line[len('<Directory "'):-len('">\n')].replace('\\"', '"').replace('\\\\', '\\')
+        if os.path.dirname(share_directory) == root:
+            os.remove(os.path.join(fragment_directory(map_file), name))
+    assemble(map_file)
+    logging.info("Apache access map %s covers %d shares below %s" % (map_file, len(expected), root))
+    return expected
+
+
+def apache_map_command(root, output=None):
+    """
+    Generates the consolidated Apache access map of the shares below root (entry point of `nfs4_share apache-map`)
+    """
+    output = output or apache_map
+    if not output:
+        raise RuntimeError("No output file given (use --output or set NFS4_SHARE_APACHE_MAP)")
+    generate(root, output)
+    print(output)
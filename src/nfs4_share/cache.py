@@ -0,0 +1,51 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+
+
+def cache_directory():
+    """
+    Returns the directory in which nfs4_share keeps its caches ($XDG_CACHE_HOME/nfs4_share or ~/.cache/nfs4_share)
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'nfs4_share')
+
+
+def default_cache_file(kind, key, extension='json'):
+    """
+    Returns the default cache file for a kind of cache (e.g. 'inventory') that belongs to a key (e.g. a shares root)
+    """
+    digest = hashlib.sha1(os.path.realpath(str(key)).encode()).hexdigest()[:12]
+    return os.path.join(cache_directory(), "%s-%s.%s" % (kind, digest, extension))
+
+
+def load_json(filename, default=None):
+    """
+    Loads a JSON cache file, returns default if it is absent or unreadable (a cache is never the source of truth)
+    """
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        logging.warning("Ignoring unreadable cache %s: %s" % (filename, e))
+        return default
+
+
+def dump_json(filename, data):
+    """
+    Atomically (temporary file + rename) writes data as JSON so readers never see a partially written cache
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
@@ -0,0 +1,159 @@
+import os
+import stat
+import json
+import logging
+import tempfile
+from contextlib import contextmanager
+
+from . import walk
+from . import hashing
+from .report import tabulate
+from .share import Share, IllegalShareSetupError, is_share_metadata, LOCK_ACE, LOCK_ACL, MANIFESTS
+
+
+def shared_files(share_directory, workers=8):
+    """
+    Returns {path: stat_result} of the regular files in a share, except its access file and manifests
+    """
+    files = {}
+    for _, directory, entries in walk.scan([share_directory], workers=workers):
+        for entry in entries:
+            if entry.is_file() and not (directory == share_directory and is_share_metadata(entry.name)):
+                files[entry.path] = entry.stat
+    return files
+
+
+def manifest_line(digest, relative_path):
+    """
+    Returns a manifest line; like sha256sum, names with a backslash or newline are escaped and the line gets a leading
+    backslash
+    """
+    if '\\' in relative_path or '\n' in relative_path:
+        return "\\%s  %s\n" % (digest, relative_path.replace('\\', '\\\\').replace('\n', '\\n'))
+    return "%s  %s\n" % (digest, relative_path)
+
+
+def is_shared_item(share, filename):
+    """
+    Returns whether a file in the share directory is a shared item rather than a manifest written by nfs4_share: it
+    was recorded as an item, or it is not a regular file with a single link
+    """
+    try:
+        stat_result = os.lstat(os.path.join(share.directory, filename))
+    except FileNotFoundError:
+        return False
+    return not stat.S_ISREG(stat_result.st_mode) or stat_result.st_nlink > 1 \
+        or any(os.path.basename(item) == filename for item in share.metadata['items'])
+
+
+@contextmanager
+def writable(share):
+    """
+    Context in which files can be created in the share directory of a locked share: the lock is lifted from the share
+    directory only (its subdirectories stay locked) and put back afterwards
+    """
+    locked_acl = share.permissions
+    if LOCK_ACE not in locked_acl:
+        yield
+        return
+    share.permissions = Share.manage_write_adjusted(locked_acl - LOCK_ACL, add_write=True)
+    try:
+        yield
+    finally:
+        share.permissions = locked_acl
+
+
+def write_manifest(share, filename, content):
+    """
+    Writes a manifest into a share unless its content is unchanged, atomically and with the permissions of the share
+    (like the access file). Returns whether it was written. Raises IllegalShareSetupError when a shared item has the
+    name of the manifest.
+    """
+    path = os.path.join(share.directory, filename)
+    if is_shared_item(share, filename):
+        raise IllegalShareSetupError("Not writing the manifest %s over the shared item of that name" % path)
+    try:
+        with open(path, 'r') as f:
+            if f.read() == content:
+                logging.debug("Manifest %s is unchanged" % path)
+                return False
+    except FileNotFoundError:
+        pass
+    with writable(share):
+        fd, tmp_path = tempfile.mkstemp(dir=share.directory, prefix=".%s." % filename)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            share.permissions.set(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    return True
+
+
+def remove_manifests(share):
+    """
+    Removes the manifests from a share (they are the only copy, so unsharing them would require force); shared items
+    with the name of a manifest are left alone
+    """
+    for filename in MANIFESTS.values():
+        if os.path.exists(os.path.join(share.directory, filename)) and not is_shared_item(share, filename):
+            os.remove(os.path.join(share.directory, filename))
+
+
+def checksum_share(share_directory, algorithm='sha256', workers=8, hash_cache=None, wait=None):
+    """
+    Writes the checksum manifest of a share (e.g. SHA256SUMS). Files are hashed in a pool of processes, and files whose
+    hash is in hash_cache (keyed by inode, size and mtime) are not read again: hard links in other shares, or files
+    that are unchanged since the previous run, cost a stat only.
+    """
+    share = Share(share_directory, exist_ok=True)
+    with share.flock(timeout=wait):
+        files = shared_files(share.directory, workers=workers)
+        digests = hashing.hash_files(files, algorithm, hash_cache, workers)
+        failed = sorted(set(files) - set(digests))
+        content = "".join(manifest_line(digests[path], os.path.relpath(path, share.directory))
+                          for path in sorted(digests, key=lambda path: os.path.relpath(path, share.directory)))
+        try:
+            written = write_manifest(share, MANIFESTS[algorithm], content)
+            error = None
+        except IllegalShareSetupError as e:
+            logging.error(str(e))
+            written, error = False, str(e)
+    logging.info("Checksummed %d files of %s (%d failed)" % (len(digests), share.directory, len(failed)))
+    return {'share': share.directory, 'manifest': os.path.join(share.directory, MANIFESTS[algorithm]),
+            'files': len(files), 'failed': failed, 'written': written, 'error': error}
+
+
+def format_report(reports):
+    """
+    Formats checksum reports as a plain-text table
+    """
+    rows = [['SHARE', 'MANIFEST', 'FILES', 'FAILED', 'UPDATED']]
+    for report in reports:
+        rows.append([os.path.basename(report['share']),
+                     os.path.basename(report['manifest']),
+                     str(report['files']),
+                     str(len(report['failed'])),
+                     'refused' if report['error'] else 'yes' if report['written'] else 'no'])
+    return tabulate(rows)
+
+
+def checksum_command(shares, root=False, algorithm='sha256', workers=8, cache_file=None, wait=None, output_json=False):
+    """
+    Writes checksum manifests into shares (entry point of `nfs4_share checksum`). Exits with 1 when files could not be
+    read or a manifest could not be written.
+    """
+    if root:
+        shares = [share for directory in shares for share in sorted(walk.share_directories(directory))]
+    with hashing.HashCache(cache_file) as hash_cache:
+        reports = [checksum_share(share, algorithm=algorithm, workers=workers, hash_cache=hash_cache, wait=wait)
+                   for share in shares]
+    if output_json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(format_report(reports))
+    if any(report['failed'] or report['error'] for report in reports):
+        raise SystemExit(1)
+    return reports
@@ -1,16 +1,27 @@
 #! /usr/bin/env python
 
 import argparse
+import importlib
 import logging
 import sys
-import subprocess
-from . import manage
-from . import acl
+from contextlib import ExitStack
 from pathlib import Path
 
 def path_object(input):
     return Path(input)
 
+
+def deferred(module, function):
+    """
+    Returns a stand-in for `module.function` that only imports the module once it is called. This keeps heavy
+    dependencies (e.g. GitPython) out of the start-up of the command-line interface.
+    """
+    def call(**kwargs):
+        return getattr(importlib.import_module('.' + module, __package__), function)(**kwargs)
+    call.__name__ = function
+    return call
+
+
 class ArgparseFormatter(argparse.HelpFormatter):
     # use defined argument order to display usage
     # Put positional argument before optional arguments in the usage line
@@ -45,7 +56,8 @@ def _cli_argument_parser():
         prog="share",
         description="Shares only work when items and share are on the same filesystem that supports NFSv4 ACL.")
 
-    default_domain = acl.get_nfs4_domain()
+    # The domain is resolved by the operation itself, and only when it needs it (see manage.resolve_domain)
+    default_domain = None
 
     default_args = {
         "share_directory": (
@@ -56,6 +68,14 @@ def _cli_argument_parser():
     }
     parser.add_argument("-v", "--verbose", action="count", default=0,
                         help="increases output verbosity (DEBUG is \'-vv\')", dest="verbosity")
+    parser.add_argument("--events", required=False, metavar='FILE',
+                        help="append a JSON line per file operation (link, unlink, mkdir, setfacl, ...) to FILE "
+                             "('-' is stdout, 'fd:N' an open file descriptor)")
+    parser.add_argument("--events-summary", action='store_true', default=False, dest='events_summary',
+                        help="only write the number of operations per directory to the --events FILE")
+    parser.add_argument("--metrics", required=False, metavar='FILE',
+                        help="add the metrics of this run (durations, file operations, ACL calls, errors) to FILE, "
+                             "a node_exporter textfile (e.g. /var/lib/node_exporter/nfs4_share.prom)")
     subparsers = parser.add_subparsers(title='subcommands',
                                        description='valid subcommands')
     # Sub-parser for creating a share
@@ -64,7 +84,7 @@ def _cli_argument_parser():
                                           formatter_class=ArgparseFormatter)
     # Following enables the use of extend action; so when doing "prog -i a b -i c" gives [a, b, c] instead of [[a,b], c]
     create_parser.register('action', 'extend', ExtendAction)
-    create_parser.set_defaults(func=manage.create)
+    create_parser.set_defaults(func=deferred('manage', 'create'))
     for arg in default_args:  # Add the default args (share and item)
         create_parser.add_argument(*default_args[arg][0], **default_args[arg][1])
     add_and_create_subparsers_arguments(create_parser, default_domain)
@@ -73,7 +93,7 @@ def _cli_argument_parser():
     add_parser = subparsers.add_parser('add',
                                        help='adds items, users or groups a share directory (help: \'add -h\')',
                                        formatter_class=ArgparseFormatter)
-    add_parser.set_defaults(func=manage.add)
+    add_parser.set_defaults(func=deferred('manage', 'add'))
     add_parser.register('action', 'extend', ExtendAction)
     for args in ['share_directory']:
         add_parser.add_argument(*default_args[args][0], **default_args[args][1])
@@ -83,11 +103,125 @@ def _cli_argument_parser():
     delete_parser = subparsers.add_parser('delete', aliases=['rm', 'remove', 'del'],
                                           help='deletes files from a directory or a share directory (help: \'delete -h\')',
                                           formatter_class=ArgparseFormatter)
-    delete_parser.set_defaults(func=manage.delete)
+    delete_parser.set_defaults(func=deferred('manage', 'delete'))
     for args in ['share_directory']:
         delete_parser.add_argument(*default_args[args][0], **default_args[args][1])
     delete_subparser_arguments(delete_parser, default_domain)
-    
+
+    # Sub-parser for listing the shares below a directory
+    list_parser = subparsers.add_parser('list', aliases=['ls'],
+                                        help='lists the shares below a directory (help: \'list -h\')',
+                                        formatter_class=ArgparseFormatter)
+    list_parser.set_defaults(func=deferred('inventory', 'list_command'))
+    list_subparser_arguments(list_parser)
+
+    # Sub-parser for storage accounting of shares
+    usage_parser = subparsers.add_parser('usage', aliases=['du'],
+                                         help='reports the storage used by shares (help: \'usage -h\')',
+                                         formatter_class=ArgparseFormatter)
+    usage_parser.set_defaults(func=deferred('usage', 'usage_command'))
+    usage_subparser_arguments(usage_parser)
+
+    # Sub-parser for finding the files of which a share holds the last copy
+    sole_copies_parser = subparsers.add_parser('sole-copies', aliases=['orphans'],
+                                               help='finds files in shares that have lost their source '
+                                                    '(help: \'sole-copies -h\')',
+                                               formatter_class=ArgparseFormatter)
+    sole_copies_parser.set_defaults(func=deferred('solecopy', 'sole_copies_command'))
+    sole_copies_subparser_arguments(sole_copies_parser)
+
+    # Sub-parser for generating the consolidated Apache access map of the shares
+    apache_map_parser = subparsers.add_parser('apache-map',
+                                              help='generates one Apache include with the access of all shares '
+                                                   '(help: \'apache-map -h\')',
+                                              formatter_class=ArgparseFormatter)
+    apache_map_parser.set_defaults(func=deferred('apache', 'apache_map_command'))
+    apache_map_subparser_arguments(apache_map_parser)
+
+    # Sub-parser for removing redundant entries from the ACLs of shares
+    optimize_parser = subparsers.add_parser('optimize',
+                                            help='consolidates the ACLs of shares (help: \'optimize -h\')',
+                                            formatter_class=ArgparseFormatter)
+    optimize_parser.set_defaults(func=deferred('optimize', 'optimize_command'))
+    optimize_subparser_arguments(optimize_parser)
+
+    # Sub-parser for finding (and repairing) directories whose ACL drifted from that of their share
+    verify_parser = subparsers.add_parser('verify',
+                                          help='reports ACL and lock drift within shares (help: \'verify -h\')',
+                                          formatter_class=ArgparseFormatter)
+    verify_parser.set_defaults(func=deferred('verify', 'verify_command'))
+    verify_subparser_arguments(verify_parser)
+
+    # Sub-parser for checking whether users/groups can read the files of shares or items
+    check_parser = subparsers.add_parser('check',
+                                         help='reports files that users or groups cannot access (help: \'check -h\')',
+                                         formatter_class=ArgparseFormatter)
+    check_parser.register('action', 'extend', ExtendAction)
+    check_parser.set_defaults(func=deferred('evaluate', 'check_command'))
+    check_subparser_arguments(check_parser)
+
+    # Sub-parsers for exporting a share to a snapshot file and rebuilding it from one
+    snapshot_parser = subparsers.add_parser('snapshot',
+                                            help='exports the structure, sources, ACLs and access file of a share '
+                                                 '(help: \'snapshot -h\')',
+                                            formatter_class=ArgparseFormatter)
+    snapshot_parser.register('action', 'extend', ExtendAction)
+    snapshot_parser.set_defaults(func=deferred('snapshot', 'snapshot_command'))
+    snapshot_subparser_arguments(snapshot_parser)
+    restore_parser = subparsers.add_parser('restore',
+                                           help='rebuilds a share from a snapshot (help: \'restore -h\')',
+                                           formatter_class=ArgparseFormatter)
+    restore_parser.set_defaults(func=deferred('snapshot', 'restore_command'))
+    restore_subparser_arguments(restore_parser)
+
+    # Sub-parser for bringing the items of shares up to date with their sources
+    sync_parser = subparsers.add_parser('sync',
+                                        help='links new files of the shared items and removes vanished ones '
+                                             '(help: \'sync -h\')',
+                                        formatter_class=ArgparseFormatter)
+    sync_parser.register('action', 'extend', ExtendAction)
+    sync_parser.set_defaults(func=deferred('sync', 'sync_command'))
+    sync_subparser_arguments(sync_parser)
+
+    # Sub-parser for the workers of distributed share builds (see --queue)
+    worker_parser = subparsers.add_parser('worker',
+                                          help='links the work units that create/add --queue put in a queue '
+                                               '(help: \'worker -h\')',
+                                          formatter_class=ArgparseFormatter)
+    worker_parser.set_defaults(func=deferred('workqueue', 'worker_command'))
+    worker_subparser_arguments(worker_parser)
+
+    # Sub-parser for removing the shares that were deleted with --trash
+    reap_parser = subparsers.add_parser('reap',
+                                        help='removes the shares in the trash of a directory (help: \'reap -h\')',
+                                        formatter_class=ArgparseFormatter)
+    reap_parser.set_defaults(func=deferred('trash', 'reap_command'))
+    reap_subparser_arguments(reap_parser)
+
+    # Sub-parser for exporting per-share gauges to Prometheus
+    metrics_parser = subparsers.add_parser('metrics',
+                                           help='exports per-share metrics as a node_exporter textfile '
+                                                '(help: \'metrics -h\')',
+                                           formatter_class=ArgparseFormatter)
+    metrics_parser.set_defaults(func=deferred('metrics', 'metrics_command'))
+    metrics_subparser_arguments(metrics_parser)
+
+    # Sub-parser for finding copies of files that could be hard links
+    dedupe_parser = subparsers.add_parser('dedupe',
+                                          help='finds identical copies of files and can replace them by hard links '
+                                               '(help: \'dedupe -h\')',
+                                          formatter_class=ArgparseFormatter)
+    dedupe_parser.set_defaults(func=deferred('dedupe', 'dedupe_command'))
+    dedupe_subparser_arguments(dedupe_parser)
+
+    # Sub-parser for writing checksum manifests into shares
+    checksum_parser = subparsers.add_parser('checksum',
+                                            help='writes a checksum manifest (e.g. SHA256SUMS) into shares '
+                                                 '(help: \'checksum -h\')',
+                                            formatter_class=ArgparseFormatter)
+    checksum_parser.set_defaults(func=deferred('checksum', 'checksum_command'))
+    checksum_subparser_arguments(checksum_parser)
+
     return parser
 
 def delete_subparser_arguments(subparser, default_domain):
@@ -102,19 +236,32 @@ def delete_subparser_arguments(subparser, default_domain):
     subparser.add_argument('-f', '--force', action="store_true", default=False,
                            help="forces files to be un-shared even if they have only one hard link (i.e. delete "
                                "files)")
+    subparser.add_argument('--trash', action="store_true", default=False,
+                           help="move the share to the trash of its shares root and return right away; it is removed "
+                                "from there by a reaper in the background (see also 'reap')")
+    subparser.add_argument('--no-reap', action="store_false", default=True, dest='reap',
+                           help="with --trash, do not start a reaper (e.g. when 'reap' runs periodically)")
     subparser.add_argument('-git', '--track-change-dir', required=False, 
                            help="Local git repository that is used to track changes in shares",
                            dest='track_change_dir',
                            type=path_object)
+    subparser.add_argument('--group-commit', required=False, type=float, default=0, metavar='SECONDS',
+                           dest='group_commit_window',
+                           help="queue the tracked changes and commit them together with those of concurrent runs "
+                                "that arrive within SECONDS (default: commit immediately)")
+    subparser.add_argument('--wait', required=False, type=float, default=None, metavar='SECONDS',
+                           help="give up when the share is still in use by another run after SECONDS "
+                                "(default: wait until it is released)")
     subparser.add_argument('-d', '--domain', required=False, dest='domain', default=default_domain,
                            help="general domain used to build the user and group principles (NFSv4 ACLs) "
-                                "if not provided it is looked up using command dnsdomainname")
+                                "if not provided it is looked up in /etc/idmapd.conf or using command dnsdomainname")
     subparser.add_argument('-u', '--user', '--users', action='extend', nargs="*", required=False, metavar='USER',
                            dest='users',
                            help='users to be removed from the share')
     subparser.add_argument('-g', '--group', '--groups', action='extend', nargs="*", required=False, metavar='GROUP',
                            dest='groups',
                            help='groups to be removed from the share')
+    apache_directive_arguments(subparser)
 
 def add_and_create_subparsers_arguments(subparser, default_domain):
     """
@@ -141,11 +288,49 @@ def add_and_create_subparsers_arguments(subparser, default_domain):
                            help='give permission to group to manage share (can be defined multiple times)')
     subparser.add_argument('-d', '--domain', required=False, dest='domain', default=default_domain,
                            help="general domain used to build the user and group principles (NFSv4 ACLs) "
-                               "if not provided it is looked up using command dnsdomainname")
+                                "if not provided it is looked up in /etc/idmapd.conf or using command dnsdomainname")
+    subparser.add_argument('--include', action='extend', nargs="*", required=False, metavar='PATTERN',
+                           help="only share the files within the items that match a pattern, e.g. '*.bam' (a glob "
+                                "matching the name, or the relative path when it contains a '/'; 're:' marks a "
+                                "regular expression; can be defined multiple times)")
+    subparser.add_argument('--exclude', action='extend', nargs="*", required=False, metavar='PATTERN',
+                           help="do not share the files and directories within the items that match a pattern, e.g. "
+                                "'tmp/' (a trailing '/' only matches directories, which are then skipped entirely; "
+                                "can be defined multiple times)")
+    subparser.add_argument('--symlinks', choices=['follow', 'skip', 'mirror'], default='follow',
+                           help="how to handle symbolic links within shared directories: share what they point to "
+                                "(every directory and file only once), leave them out or recreate them in the share "
+                                "(default: follow)")
+    subparser.add_argument('--queue', required=False, metavar='QUEUE',
+                           help="have workers (`nfs4_share worker QUEUE`, e.g. on other nodes) link the directory items: "
+                                "they are split into work units in QUEUE, a directory on the shared filesystem")
+    subparser.add_argument('--split-depth', required=False, type=int, default=2, dest='split_depth',
+                           help="depth of the directories below which a work unit covers the whole subtree (default: 2)")
+    subparser.add_argument('--queue-timeout', required=False, type=float, default=None, metavar='SECONDS',
+                           dest='queue_timeout',
+                           help="give up when the workers did not finish after SECONDS (default: wait indefinitely)")
     subparser.add_argument('-saa', '--service-application-accounts ', action='extend', nargs="*", required=False,
                            dest='service_application_accounts',
                            help="service application accounts under which the services (e.g. HTTP) are running "
                                 "that should have access to the share (NFSv4 ACLs)")
+    apache_directive_arguments(subparser)
+    subparser.add_argument('-git', '--track-change-dir', required=False, 
+                           help="Local git directory that is used to track changes in shares",
+                           dest='track_change_dir',
+                           type=path_object)
+    subparser.add_argument('--group-commit', required=False, type=float, default=0, metavar='SECONDS',
+                           dest='group_commit_window',
+                           help="queue the tracked changes and commit them together with those of concurrent runs "
+                                "that arrive within SECONDS (default: commit immediately)")
+    subparser.add_argument('--wait', required=False, type=float, default=None, metavar='SECONDS',
+                           help="give up when the share is still in use by another run after SECONDS "
+                                "(default: wait until it is released)")
+
+
+def apache_directive_arguments(subparser):
+    """
+    Add python args in subparser for the directive templates used in the htaccess file of a share
+    """
     subparser.add_argument('-uad', '--user-apache-directive', required=False,
                            default="Require ldap-user {}",
                            help="This directive template specifies an user who is allowed access "
@@ -158,10 +343,243 @@ def add_and_create_subparsers_arguments(subparser, default_domain):
                                 "to a share via htaccess. "
                                 "Default: 'Require ldap-group cn={},cn=groups,cn=accounts,dc=researchidt,"
                                 "dc=prinsesmaximacentrum,dc=nl' where {} is replaced by the group")
-    subparser.add_argument('-git', '--track-change-dir', required=False, 
+
+
+def list_subparser_arguments(subparser):
+    """
+    Add python args in subparser for listing the shares below a root directory
+    """
+    subparser.add_argument('root', metavar='ROOT', help="directory containing the shares")
+    subparser.add_argument('--json', action='store_true', default=False, dest='output_json',
+                           help="output the inventory as JSON instead of a table")
+    subparser.add_argument('--cache', required=False, dest='cache_file',
+                           help="file used to cache the share summaries (default: in ~/.cache/nfs4_share)")
+    subparser.add_argument('--refresh', action='store_true', default=False,
+                           help="ignore the cached summaries and rescan every share")
+    subparser.add_argument('-w', '--workers', type=int, default=8,
+                           help="number of shares that are scanned in parallel")
+    apache_directive_arguments(subparser)
+
+
+def usage_subparser_arguments(subparser):
+    """
+    Add python args in subparser for the storage accounting of shares
+    """
+    subparser.add_argument('shares', metavar='SHARE', nargs='+', help="share directories to account")
+    subparser.add_argument('-r', '--root', action='store_true', default=False,
+                           help="treat the given directories as roots and account every share below them")
+    subparser.add_argument('--json', action='store_true', default=False, dest='output_json',
+                           help="output the report as JSON instead of a table")
+    subparser.add_argument('-w', '--workers', type=int, default=8,
+                           help="number of directories that are listed and stat-ed in parallel")
+
+
+def sole_copies_subparser_arguments(subparser):
+    """
+    Add python args in subparser for finding sole copies (files with a single hard link) in shares
+    """
+    subparser.add_argument('root', metavar='ROOT', help="directory containing the shares")
+    subparser.add_argument('--json', action='store_true', default=False, dest='output_json',
+                           help="output the sole copies as JSON instead of a table")
+    subparser.add_argument('-l', '--list-files', action='store_true', default=False, dest='list_files',
+                           help="also list the paths of the sole copies")
+    subparser.add_argument('--cache', required=False, dest='cache_file',
+                           help="file used to cache the directory listings (default: in ~/.cache/nfs4_share)")
+    subparser.add_argument('--full', action='store_true', default=False,
+                           help="ignore the cached directory listings of the previous scan")
+    subparser.add_argument('-w', '--workers', type=int, default=8,
+                           help="number of directories that are listed and stat-ed in parallel")
+
+
+def apache_map_subparser_arguments(subparser):
+    """
+    Add python args in subparser for generating the Apache access map
+    """
+    subparser.add_argument('root', metavar='ROOT', help="directory containing the shares")
+    subparser.add_argument('-o', '--output', required=False,
+                           help="Apache include file to write (default: $NFS4_SHARE_APACHE_MAP). When that variable is "
+                                "set, create/add/delete keep the map up to date so Apache can run with "
+                                "AllowOverride None")
+
+
+def optimize_subparser_arguments(subparser):
+    """
+    Add python args in subparser for optimizing the ACLs of shares
+    """
+    subparser.add_argument('shares', metavar='SHARE', nargs='+', help="share directories to optimize")
+    subparser.add_argument('-r', '--root', action='store_true', default=False,
+                           help="treat the given directories as roots and optimize every share below them")
+    subparser.add_argument('--apply', action='store_true', default=False,
+                           help="set the optimized ACLs (default: only report the savings)")
+    subparser.add_argument('--json', action='store_true', default=False, dest='output_json',
+                           help="output the report as JSON instead of a table")
+
+
+def verify_subparser_arguments(subparser):
+    """
+    Add python args in subparser for verifying the ACLs of the directories in shares
+    """
+    subparser.add_argument('shares', metavar='SHARE', nargs='+', help="share directories to verify")
+    subparser.add_argument('-r', '--root', action='store_true', default=False,
+                           help="treat the given directories as roots and verify every share below them")
+    subparser.add_argument('--repair', action='store_true', default=False,
+                           help="set the ACL of the share on the directories that drifted (default: only report them)")
+    subparser.add_argument('-w', '--workers', type=int, default=8,
+                           help="number of nfs4_getfacl calls that run in parallel")
+    subparser.add_argument('--json', action='store_true', default=False, dest='output_json',
+                           help="output the report (including the drifted directories) as JSON instead of a table")
+
+
+def check_subparser_arguments(subparser):
+    """
+    Add python args in subparser for checking the access of users/groups to the files of shares or items
+    """
+    subparser.add_argument('targets', metavar='SHARE_OR_ITEM', nargs='+',
+                           help="share directories, or items before they are shared")
+    subparser.add_argument('-u', '--user', '--users', action='extend', nargs="*", required=False, metavar='USER',
+                           dest='users',
+                           help='user whose access is checked (can be defined multiple times)')
+    subparser.add_argument('-g', '--group', '--groups', action='extend', nargs="*", required=False, metavar='GROUP',
+                           dest='groups',
+                           help='group whose access is checked, i.e. of members that only have access through the '
+                                'group (can be defined multiple times)')
+    subparser.add_argument('-p', '--permissions', default='r',
+                           help="NFSv4 permissions that are required (default: 'r')")
+    subparser.add_argument('--json', action='store_true', default=False, dest='output_json',
+                           help="output the report as JSON instead of a table")
+    subparser.add_argument('-l', '--list-files', action='store_true', default=False, dest='list_files',
+                           help="also list the files that cannot be accessed")
+
+
+def snapshot_subparser_arguments(subparser):
+    """
+    Add python args in subparser for taking a snapshot of a share
+    """
+    for arg in ['share_directory']:
+        subparser.add_argument(arg, metavar="SHARE_DIRECTORY", help="The path to the directory representing the share")
+    subparser.add_argument('-s', '--source', '--sources', action='extend', nargs="*", required=False, metavar='SOURCE',
+                           dest='sources',
+                           help="directory below which the sources of the shared files are looked up, so the share "
+                                "can be restored by linking them (can be defined multiple times)")
+    subparser.add_argument('-o', '--output', default='-',
+                           help="snapshot file to write, compressed when it ends with .gz (default: stdout)")
+    subparser.add_argument('-w', '--workers', type=int, default=8,
+                           help="number of directories that are listed and stat-ed in parallel")
+
+
+def restore_subparser_arguments(subparser):
+    """
+    Add python args in subparser for restoring a share from a snapshot
+    """
+    subparser.add_argument('snapshot_file', metavar='SNAPSHOT', help="snapshot file to restore ('-' reads stdin)")
+    subparser.add_argument('-t', '--target', required=False, dest='share_directory',
+                           help="directory to restore the share to (default: its original location)")
+
+
+def sync_subparser_arguments(subparser):
+    """
+    Add python args in subparser for syncing shares with their sources
+    """
+    subparser.add_argument('root', metavar='ROOT', help="directory containing the shares")
+    subparser.add_argument('-s', '--share', '--shares', action='extend', nargs="*", required=False, metavar='SHARE',
+                           dest='shares',
+                           help="only sync these shares below ROOT (can be defined multiple times)")
+    subparser.add_argument('--force', action='store_true', default=False,
+                           help="also remove files of which the share holds the last copy (their source vanished)")
+    subparser.add_argument('-n', '--dry-run', action='store_true', default=False, dest='dry_run',
+                           help="only report what would change (the operations are logged with -v)")
+    subparser.add_argument('--full', action='store_true', default=False,
+                           help="ignore the source directory listings remembered by the previous sync")
+    subparser.add_argument('-git', '--track-change-dir', required=False,
                            help="Local git directory that is used to track changes in shares",
                            dest='track_change_dir',
                            type=path_object)
+    subparser.add_argument('--wait', required=False, type=float, default=0, metavar='SECONDS',
+                           help="wait up to SECONDS for a share that is in use by another run (default: skip it)")
+    subparser.add_argument('-w', '--workers', type=int, default=4,
+                           help="number of shares that are synced in parallel")
+    subparser.add_argument('--json', action='store_true', default=False, dest='output_json',
+                           help="output the report as JSON instead of a table")
+
+
+def worker_subparser_arguments(subparser):
+    """
+    Add python args in subparser for running a work queue worker
+    """
+    subparser.add_argument('queue', metavar='QUEUE', help="queue directory on the shared filesystem")
+    subparser.add_argument('--idle-timeout', required=False, type=float, default=None, metavar='SECONDS',
+                           dest='idle_timeout',
+                           help="stop when the queue has been empty for SECONDS (default: keep waiting for work)")
+    subparser.add_argument('--max-units', required=False, type=int, default=None, dest='max_units',
+                           help="stop after processing this many work units")
+
+
+def reap_subparser_arguments(subparser):
+    """
+    Add python args in subparser for reaping trashed shares
+    """
+    subparser.add_argument('root', metavar='ROOT', help="directory containing the shares (and their trash)")
+    subparser.add_argument('-f', '--force', action='store_true', default=False,
+                           help="also delete files of which a trashed share holds the last copy")
+    subparser.add_argument('--json', action='store_true', default=False, dest='output_json',
+                           help="output the report as JSON instead of a table")
+
+
+def metrics_subparser_arguments(subparser):
+    """
+    Add python args in subparser for exporting the metrics of the shares below a directory
+    """
+    subparser.add_argument('root', metavar='ROOT', help="directory containing the shares")
+    subparser.add_argument('-o', '--output', default='-', metavar='FILE',
+                           help="textfile to (atomically) replace, e.g. /var/lib/node_exporter/nfs4_share_inventory.prom "
+                                "(default: '-', stdout)")
+    subparser.add_argument('-w', '--workers', type=int, default=8,
+                           help="number of shares that are scanned in parallel")
+    subparser.add_argument('--refresh', action='store_true', default=False,
+                           help="ignore the cached share summaries and rescan every share")
+    subparser.add_argument('--no-sole-copies', action='store_false', default=True, dest='sole_copies',
+                           help="do not export the sole-copy bytes (saves walking the shares)")
+
+
+def dedupe_subparser_arguments(subparser):
+    """
+    Add python args in subparser for finding (and linking) duplicate files
+    """
+    subparser.add_argument('paths', metavar='PATH', nargs='+', help="files or directories to search for duplicates")
+    subparser.add_argument('--link', action='store_true', default=False,
+                           help="replace duplicates by hard links to one copy (only copies with the same owner, mode "
+                                "and ACL; default: only report the reclaimable bytes)")
+    subparser.add_argument('--min-size', type=int, default=1, metavar='BYTES', dest='min_size',
+                           help="ignore files smaller than BYTES (default: 1, i.e. empty files are ignored)")
+    subparser.add_argument('-w', '--workers', type=int, default=8,
+                           help="number of directories listed, and files hashed, in parallel")
+    subparser.add_argument('--cache', required=False, dest='cache_file', metavar='FILE',
+                           help="hash cache (default: ~/.cache/nfs4_share/hashes.sqlite)")
+    subparser.add_argument('--json', action='store_true', default=False, dest='output_json',
+                           help="output the report (including the duplicates) as JSON instead of a table")
+    subparser.add_argument('-l', '--list', action='store_true', default=False, dest='list_files',
+                           help="list the duplicates")
+
+
+def checksum_subparser_arguments(subparser):
+    """
+    Add python args in subparser for writing checksum manifests into shares
+    """
+    subparser.add_argument('shares', metavar='SHARE', nargs='+', help="share directories to checksum")
+    subparser.add_argument('-r', '--root', action='store_true', default=False,
+                           help="treat the given directories as roots and checksum every share below them")
+    subparser.add_argument('-a', '--algorithm', choices=['md5', 'sha1', 'sha256', 'sha512'], default='sha256',
+                           help="hash algorithm, which also names the manifest (default: sha256, i.e. SHA256SUMS)")
+    subparser.add_argument('-w', '--workers', type=int, default=8,
+                           help="number of files hashed in parallel")
+    subparser.add_argument('--cache', required=False, dest='cache_file', metavar='FILE',
+                           help="hash cache (default: ~/.cache/nfs4_share/hashes.sqlite)")
+    subparser.add_argument('--wait', required=False, type=float, default=None, metavar='SECONDS',
+                           help="give up when a share is still in use by another run after SECONDS "
+                                "(default: wait until it is released)")
+    subparser.add_argument('--json', action='store_true', default=False, dest='output_json',
+                           help="output the report as JSON instead of a table")
+
 
 class ExtendAction(argparse.Action):
 
@@ -197,9 +615,19 @@ def main(parser):
     logging.debug("Parsed args: %s" % args_dict)
 
     # Unpack the dictionary to the selected function (e.g. 'create', 'remove' (excluding the 'func' key)
-    share = args.func(**{x: args_dict[x] for x in args_dict if x not in ['func', 'verbosity']})
+    kwargs = {x: args_dict[x] for x in args_dict if x not in ['func', 'verbosity', 'events', 'events_summary', 'metrics']}
+    with ExitStack() as stack:
+        if args.events:
+            from . import events
+            stack.enter_context(events.recording(args.events, summary=args.events_summary))
+        if args.metrics:
+            from . import metrics
+            operation = args.func.__name__
+            stack.enter_context(metrics.recording(args.metrics, operation[:-len('_command')]
+                                                  if operation.endswith('_command') else operation))
+        share = args.func(**kwargs)
 
-    if args.func.__name__ != 'delete':
+    if args.func.__name__ in ['create', 'add']:
         logging.info("Filesystem path to share is: %s" % share.directory)
         data_dir = '/data/groups/pmc_omics'
         fqdn_url = 'https://files.bioinf.prinsesmaximacentrum.nl'
@@ -0,0 +1,240 @@
+import os
+import json
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from . import acl
+from . import walk
+from . import events
+from . import hashing
+from .report import human_readable_size, tabulate
+
+
+def regular_files(paths, workers=8, min_size=1):
+    """
+    Returns {(st_dev, st_ino): (stat_result, [paths])} for the regular files of at least min_size bytes in paths (files,
+    or directories that are walked without following symlinks)
+    """
+    inodes = {}
+
+    def add(path, stat_result):
+        if stat_result.st_size >= min_size:
+            inodes.setdefault((stat_result.st_dev, stat_result.st_ino), (stat_result, []))[1].append(path)
+
+    directories = []
+    for path in paths:
+        path = str(path)
+        if os.path.isfile(path) and not os.path.islink(path):
+            add(path, os.lstat(path))
+        elif os.path.isdir(path):
+            directories.append(path)
+    for _, _, entries in walk.scan(directories, workers=workers):
+        for entry in entries:
+            if entry.is_file():
+                add(entry.path, entry.stat)
+    for _, paths_of_inode in inodes.values():
+        paths_of_inode.sort()
+    return inodes
+
+
+def _groups(inodes, key):
+    groups = {}
+    for inode, (stat_result, paths) in inodes.items():
+        groups.setdefault(key(inode, stat_result, paths), {})[inode] = (stat_result, paths)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def _partial_hashes(inodes, hash_cache, workers):
+    """
+    Returns {inode: partial hash}, reading the head and tail blocks in parallel threads (the reads are latency-bound)
+    """
+    partials = {}
+    missing = []
+    for inode, (stat_result, paths) in inodes.items():
+        digest = hash_cache.get(stat_result, 'partial') if hash_cache is not None else None
+        if digest is not None:
+            partials[inode] = digest
+        else:
+            missing.append(inode)
+
+    def read(inode):
+        stat_result, paths = inodes[inode]
+        try:
+            return inode, hashing.partial_hash(paths[0], stat_result.st_size)
+        except OSError as e:
+            logging.error("Could not read %s: %s" % (paths[0], e))
+            return inode, None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for inode, digest in executor.map(read, missing):
+            if digest is not None:
+                partials[inode] = digest
+                if hash_cache is not None:
+                    hash_cache.put(inodes[inode][0], 'partial', digest)
+    return partials
+
+
+def find_duplicates(paths, hash_cache=None, workers=8, min_size=1):
+    """
+    Finds byte-identical regular files (distinct inodes on the same filesystem) in paths. Candidates are narrowed down
+    in stages so most files are never read completely: same size, then same hash of the head and tail blocks, then same
+    full hash (computed in a pool of processes). Hashes are taken from and stored in hash_cache.
+
+    Returns a list of groups {'size', 'digest', 'inodes': [{'paths', 'links', 'mtime_ns'}]} of identical files.
+    """
+    inodes = regular_files(paths, workers=workers, min_size=min_size)
+    by_size = _groups(inodes, lambda inode, stat_result, paths: (stat_result.st_dev, stat_result.st_size))
+    candidates = {inode: value for group in by_size for inode, value in group.items()}
+    logging.info("%d of %d files share their size with another file" % (len(candidates), len(inodes)))
+
+    partials = _partial_hashes(candidates, hash_cache, workers)
+    by_partial = _groups({inode: value for inode, value in candidates.items() if inode in partials},
+                         lambda inode, stat_result, paths: (stat_result.st_dev, stat_result.st_size, partials[inode]))
+    to_hash = {value[1][0]: value[0] for group in by_partial for inode, value in group.items()
+               if not hashing.covers_whole_file(value[0].st_size)}
+    logging.info("%d files share their head and tail blocks with another file, %d need a full hash" %
+                 (sum(len(group) for group in by_partial), len(to_hash)))
+    digests = hashing.hash_files(to_hash, 'sha256', hash_cache, workers)
+
+    duplicates = []
+    for group in by_partial:
+        by_digest = {}
+        for inode, (stat_result, paths) in group.items():
+            if hashing.covers_whole_file(stat_result.st_size):
+                digest = partials[inode]
+            elif paths[0] in digests:
+                digest = digests[paths[0]]
+            else:  # Could not be read
+                continue
+            by_digest.setdefault(digest, []).append((stat_result, paths))
+        for digest, identical in sorted(by_digest.items()):
+            if len(identical) > 1:
+                duplicates.append({'size': identical[0][0].st_size,
+                                   'digest': digest,
+                                   'inodes': [{'paths': paths, 'links': stat_result.st_nlink,
+                                               'mtime_ns': stat_result.st_mtime_ns}
+                                              for stat_result, paths in sorted(identical, key=lambda value: value[1])]})
+    return duplicates
+
+
+def access_signatures(paths):
+    """
+    Returns {path: signature} of the access to files: owner, group, mode and the NFSv4 ACL. Hard links share their
+    access, so only files with the same signature can be replaced by links to one another. Without nfs4_getfacl (or
+    on another filesystem) only the POSIX part is compared.
+    """
+    acls = {}
+    try:
+        acls = {path: ",".join(repr(entry) for entry in entries) for path, entries in acl.read_entries_batch(paths)}
+    except (OSError, AssertionError, subprocess.CalledProcessError) as e:
+        logging.debug("Comparing owner, group and mode only, could not read the ACLs: %s" % e)
+    signatures = {}
+    for path in paths:
+        stat_result = os.lstat(path)
+        signatures[path] = (stat_result.st_uid, stat_result.st_gid, stat_result.st_mode, acls.get(path))
+    return signatures
+
+
+def link_duplicates(group):
+    """
+    Replaces the duplicate files of a group by hard links to one inode: per access signature, the inode with the most
+    links is kept. Every path is replaced atomically (link to a temporary name, then rename over the path), and only
+    when the file did not change since it was hashed. Returns the number of replaced paths and the reclaimed bytes.
+    """
+    signatures = access_signatures([inode['paths'][0] for inode in group['inodes']])
+    by_signature = {}
+    for inode in group['inodes']:
+        by_signature.setdefault(signatures[inode['paths'][0]], []).append(inode)
+    replaced = reclaimed = 0
+    for inodes in by_signature.values():
+        if len(inodes) < 2:
+            continue
+        inodes = sorted(inodes, key=_keep_order)
+        keep = inodes[0]['paths'][0]
+        keep_stat = os.lstat(keep)
+        if _changed(inodes[0], keep_stat, group['size']):
+            logging.warning("Not linking to %s, it changed since it was hashed" % keep)
+            continue
+        for inode in inodes[1:]:
+            duplicate_stat = os.lstat(inode['paths'][0])
+            if _changed(inode, duplicate_stat, group['size']):
+                logging.warning("Not linking %s, it changed since it was hashed" % inode['paths'][0])
+                continue
+            done = 0
+            for path in inode['paths']:
+                temporary = os.path.join(os.path.dirname(path), '.%s.nfs4_share-dedupe' % os.path.basename(path))
+                try:
+                    os.link(keep, temporary)
+                    os.rename(temporary, path)
+                except OSError as e:
+                    logging.error("Could not replace %s by a link to %s: %s" % (path, keep, e))
+                    if os.path.lexists(temporary) and os.path.samestat(os.lstat(temporary), keep_stat):
+                        os.remove(temporary)
+                    continue
+                if events.sink is not None:
+                    events.emit('link', path, source=keep)
+                done += 1
+            replaced += done
+            if done == duplicate_stat.st_nlink:
+                reclaimed += group['size']
+    if len(by_signature) > 1:
+        logging.info("Kept %d copies of %s apart, their access differs" % (len(by_signature), group['inodes'][0]['paths'][0]))
+    return replaced, reclaimed
+
+
+def _keep_order(inode):
+    return -inode['links'], inode['paths']
+
+
+def _changed(inode, stat_result, size):
+    return (stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_nlink) != (size, inode['mtime_ns'], inode['links'])
+
+
+def reclaimable(group):
+    """
+    Returns the bytes that linking a group would free: the inodes that are not kept and whose links were all found.
+    Files whose access differs are not linked (see link_duplicates), so this is an upper bound.
+    """
+    inodes = sorted(group['inodes'], key=_keep_order)[1:]
+    return group['size'] * len([inode for inode in inodes if inode['links'] == len(inode['paths'])])
+
+
+def format_report(report, list_files=False):
+    """
+    Formats a dedupe report as a plain-text table (and, with list_files, the duplicates)
+    """
+    rows = [['GROUPS', 'DUPLICATES', 'RECLAIMABLE', 'LINKED', 'RECLAIMED']]
+    rows.append([str(len(report['groups'])),
+                 str(sum(len(group['inodes']) - 1 for group in report['groups'])),
+                 human_readable_size(report['reclaimable']),
+                 str(report['linked']),
+                 human_readable_size(report['reclaimed'])])
+    text = tabulate(rows)
+    if list_files:
+        for group in report['groups']:
+            text += "\n\n%s (%s)\n" % (group['digest'], human_readable_size(group['size']))
+            text += "\n".join("  " + "  ".join(inode['paths']) for inode in group['inodes'])
+    return text
+
+
+def dedupe_command(paths, link=False, min_size=1, workers=8, cache_file=None, output_json=False, list_files=False):
+    """
+    Finds duplicate files in paths and reports the reclaimable bytes (entry point of `nfs4_share dedupe`); with link,
+    duplicates are replaced by hard links
+    """
+    with hashing.HashCache(cache_file) as hash_cache:
+        groups = find_duplicates(paths, hash_cache=hash_cache, workers=workers, min_size=min_size)
+    report = {'groups': groups, 'reclaimable': sum(reclaimable(group) for group in groups), 'linked': 0, 'reclaimed': 0}
+    if link:
+        for group in groups:
+            replaced, reclaimed = link_duplicates(group)
+            report['linked'] += replaced
+            report['reclaimed'] += reclaimed
+        logging.info("Replaced %d duplicates by hard links, reclaiming %s" %
+                     (report['linked'], human_readable_size(report['reclaimed'])))
+    if output_json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report, list_files=list_files))
+    return report
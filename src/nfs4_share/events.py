@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# The attached event sink, None when nothing consumes the events. Hot paths check it before building an event:
+#
+#     if events.sink is not None:
+#         events.emit('link', target, source=source)
+sink = None
+
+
+class JsonLinesSink:
+    """
+    Writes every event as one compact JSON line, e.g. {"t":1700000000.123456,"op":"link","path":"...","source":"..."}
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def emit(self, operation, path, fields):
+        record = {'t': round(time.time(), 6), 'op': operation, 'path': path}
+        record.update(fields)
+        line = json.dumps(record, separators=(',', ':'), default=str) + "\n"
+        with self._lock:
+            self.stream.write(line)
+
+    def close(self):
+        self.stream.flush()
+
+
+class SummarySink:
+    """
+    Counts the events per directory and operation and writes the counts as JSON lines ({"dir", "op", "count"}) when
+    it is closed
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def emit(self, operation, path, fields):
+        key = (os.path.dirname(path), operation)
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def close(self):
+        for (directory, operation), count in sorted(self.counts.items()):
+            self.stream.write(json.dumps({'dir': directory, 'op': operation, 'count': count},
+                                         separators=(',', ':')) + "\n")
+        self.stream.flush()
+
+
+def emit(operation, path, **fields):
+    """
+    Sends an event about an operation on path to the attached sink, if any
+    """
+    if sink is not None:
+        sink.emit(operation, str(path), fields)
+
+
+def open_stream(target):
+    """
+    Opens the stream events are written to: '-' is stdout, 'fd:N' an inherited file descriptor and anything else a
+    file that is appended to
+    """
+    if target == '-':
+        return sys.stdout
+    if str(target).startswith('fd:'):
+        return os.fdopen(int(str(target)[len('fd:'):]), 'a', closefd=False)
+    return open(target, 'a')
+
+
+@contextmanager
+def recording(target, summary=False):
+    """
+    Context in which the events are written to target (see open_stream), one line per event or, with summary, one
+    line per directory and operation when the context exits
+    """
+    global sink
+    stream = open_stream(target)
+    previous = sink
+    sink = SummarySink(stream) if summary else JsonLinesSink(stream)
+    try:
+        yield sink
+    finally:
+        sink.close()
+        sink = previous
+        if stream is not sys.stdout:
+            stream.close()
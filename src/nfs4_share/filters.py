@@ -0,0 +1,71 @@
+import re
+import fnmatch
+
+# Prefix that marks a pattern as a regular expression instead of a glob
+REGEX_PREFIX = 're:'
+
+
+def translate(pattern):
+    """
+    Translates an include/exclude pattern to a regular expression that matches a path relative to the item:
+    * 're:<regex>' is searched for in the relative path
+    * a glob without a slash matches the name of a file or directory at any depth (e.g. '*.bam')
+    * a glob with a slash matches the whole relative path (e.g. 'run1/*.vcf.gz')
+    A trailing slash limits a pattern to directories (e.g. 'tmp/').
+    """
+    if pattern.startswith(REGEX_PREFIX):
+        return "(?:.*?(?:%s))" % pattern[len(REGEX_PREFIX):]
+    directories_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if '/' in pattern:
+        regex = fnmatch.translate(pattern.lstrip('/'))
+    else:
+        regex = "(?:.*/)?" + fnmatch.translate(pattern)
+    # Directory paths are matched with a trailing '/' (see PathFilter)
+    return "(?:%s%s\\Z)" % (regex[:-len('\\Z')], '/' if directories_only else '/?')
+
+
+def compile_patterns(patterns):
+    """
+    Compiles patterns into a single regular expression (None if there are no patterns)
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(translate(pattern) for pattern in patterns), re.DOTALL)
+
+
+class PathFilter:
+    """
+    Include/exclude filter for the files and directories within an item. All patterns are compiled into one regular
+    expression per kind, so a path is tested once regardless of the number of patterns. Excluded directories are
+    pruned (never descended into); the include patterns only apply to files.
+    """
+
+    def __init__(self, include=None, exclude=None):
+        self.include = list(include or [])
+        self.exclude = list(exclude or [])
+        self._include = compile_patterns(self.include)
+        self._exclude = compile_patterns(self.exclude)
+
+    def __repr__(self):
+        return "PathFilter(include={!r}, exclude={!r})".format(self.include, self.exclude)
+
+    def __bool__(self):
+        return bool(self.include or self.exclude)
+
+    def to_dict(self):
+        return {'include': self.include, 'exclude': self.exclude}
+
+    def includes_directory(self, relative_path):
+        """
+        Returns whether to descend into a directory (given by its path relative to the item, using '/')
+        """
+        return self._exclude is None or not self._exclude.match(relative_path + '/')
+
+    def includes_file(self, relative_path):
+        """
+        Returns whether to share a file (given by its path relative to the item, using '/')
+        """
+        if self._exclude is not None and self._exclude.match(relative_path):
+            return False
+        return self._include is None or bool(self._include.match(relative_path))
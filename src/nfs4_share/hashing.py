@@ -0,0 +1,153 @@
+import os
+import hashlib
+import sqlite3
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import cache
+
+# Bytes read per call when hashing a whole file
+READ_SIZE = 4 << 20
+# Bytes at the head and at the tail of a file that make up its partial hash
+BLOCK_SIZE = 64 << 10
+# Hashes stored between two commits of the hash cache; an interrupted run loses at most this many
+COMMIT_INTERVAL = 64
+
+
+def default_cache_file():
+    """
+    Returns the hash cache that is shared by all commands ($XDG_CACHE_HOME/nfs4_share/hashes.sqlite)
+    """
+    return os.path.join(cache.cache_directory(), 'hashes.sqlite')
+
+
+def cache_key(stat_result):
+    return stat_result.st_dev, stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns
+
+
+class HashCache:
+    """
+    Persistent (SQLite) cache of file hashes keyed by (st_dev, st_ino, size, mtime): all hard links of a file share one
+    entry, and the entry no longer matches once the file is modified. Partial hashes are stored as algorithm 'partial'.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename or default_cache_file()
+        os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+        self.connection = sqlite3.connect(self.filename, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS hashes (dev INTEGER, ino INTEGER, size INTEGER, "
+                                "mtime_ns INTEGER, algorithm TEXT, digest TEXT, "
+                                "PRIMARY KEY (dev, ino, size, mtime_ns, algorithm))")
+        self.connection.commit()
+        self._uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def get(self, stat_result, algorithm):
+        row = self.connection.execute("SELECT digest FROM hashes WHERE dev=? AND ino=? AND size=? AND mtime_ns=? "
+                                      "AND algorithm=?", cache_key(stat_result) + (algorithm,)).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, stat_result, algorithm, digest):
+        dev, ino, size, mtime_ns = cache_key(stat_result)
+        # Entries of an earlier version of the file (or of an earlier file with the same inode) are outdated
+        self.connection.execute("DELETE FROM hashes WHERE dev=? AND ino=? AND (size!=? OR mtime_ns!=?)",
+                                (dev, ino, size, mtime_ns))
+        self.connection.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)",
+                                (dev, ino, size, mtime_ns, algorithm, digest))
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_INTERVAL:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def hash_file(path, algorithm='sha256', read_size=None):
+    """
+    Returns the hex digest of a file, read in large chunks into a reused buffer
+    """
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(read_size or READ_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            length = f.readinto(buffer)
+            if not length:
+                break
+            digest.update(view[:length])
+    return digest.hexdigest()
+
+
+def partial_hash(path, size, block_size=None):
+    """
+    Returns a digest of the first and last block of a file. For files of up to two blocks it covers the whole content.
+    """
+    block_size = block_size or BLOCK_SIZE
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        digest.update(f.read(block_size))
+        if size > block_size:
+            f.seek(max(block_size, size - block_size))
+            digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+def covers_whole_file(size, block_size=None):
+    return size <= 2 * (block_size or BLOCK_SIZE)
+
+
+def _hash_in_worker(path, algorithm, read_size):
+    """
+    Hashes a file in a worker process; returns the stat result from after hashing so a file that changed meanwhile
+    is not cached
+    """
+    digest = hash_file(path, algorithm, read_size)
+    return digest, os.stat(path)
+
+
+def hash_files(files, algorithm='sha256', hash_cache=None, workers=8):
+    """
+    Hashes files (given as {path: stat_result}) in a pool of processes and returns {path: digest}. Every inode is
+    hashed once, and hashes in hash_cache are not computed again; new hashes are stored in it as they complete, so an
+    interrupted run resumes where it stopped. Files that cannot be read are logged and left out.
+    """
+    digests = {}
+    missing = {}  # cache key -> [paths]
+    stats = {}
+    for path, stat_result in files.items():
+        digest = hash_cache.get(stat_result, algorithm) if hash_cache is not None else None
+        if digest is not None:
+            digests[path] = digest
+        else:
+            missing.setdefault(cache_key(stat_result), []).append(path)
+            stats[cache_key(stat_result)] = stat_result
+    logging.info("Hashing %d of %d files (%s), the others are cached" % (len(missing), len(files), algorithm))
+    if not missing:
+        return digests
+    with ProcessPoolExecutor(max_workers=max(1, min(workers, len(missing)))) as executor:
+        futures = {executor.submit(_hash_in_worker, paths[0], algorithm, READ_SIZE): key
+                   for key, paths in missing.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                digest, stat_after = future.result()
+            except OSError as e:
+                logging.error("Could not hash %s: %s" % (missing[key][0], e))
+                continue
+            for path in missing[key]:
+                digests[path] = digest
+            if hash_cache is not None and cache_key(stat_after) == key:
+                hash_cache.put(stats[key], algorithm, digest)
+    if hash_cache is not None:
+        hash_cache.commit()
+    return digests
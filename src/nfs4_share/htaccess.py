@@ -2,82 +2,190 @@
 import os
 import logging
 import warnings
-import parse
-from .share import Share
+import functools
+import string
+import tempfile
+from .share import Share, HTACCESS_FILENAME
+from . import apache
 import re
 
 
+class AccessFile:
+    """
+    In-memory model of the access file of a share: its lines plus, per directive template, the set of names its lines
+    give access to. The set is built in one pass over the lines when the template is first used and kept up to date by
+    add() and remove(), so checking whether a name already has a line costs O(1). Directive templates (e.g.
+    'Require ldap-user {}') are compiled once, see compile_template(); the <RequireAny> block lines never match one.
+    """
+
+    def __init__(self, lines=None, original=None):
+        self.lines = ['<RequireAny>', '</RequireAny>'] if lines is None else list(lines)
+        self.original = original  # Content of the file when read, None if it did not exist
+        self._targets = {}  # Directive template -> names given access by its lines, see targets()
+
+    @classmethod
+    def read(cls, path):
+        """
+        Parses an access file, returns an empty model when it does not exist
+        """
+        try:
+            with open(path, 'r') as htaccess_file:
+                content = htaccess_file.read()
+        except FileNotFoundError:
+            return cls()
+        return cls([line.strip() for line in content.splitlines()], original=content)
+
+    def targets(self, directive_template):
+        """
+        Returns the set of names given access by lines made with directive_template
+        """
+        return set(self._target_set(directive_template))
+
+    def _target_set(self, directive_template):
+        if directive_template not in self._targets:
+            self._targets[directive_template] = set(extract_targets(self.lines, directive_template))
+        return self._targets[directive_template]
+
+    def add(self, names, directive_template):
+        """
+        Adds a directive line for every name that does not have one yet, after the existing lines of the same template
+        """
+        matcher = compile_template(directive_template)
+        existing = self._target_set(directive_template)
+        new_lines = []
+        for name in names:
+            if name not in existing:
+                existing.add(name)
+                new_lines.append(directive_template.format(name))
+        if not new_lines:
+            return
+        matching = [index for index, line in enumerate(self.lines) if line not in BLOCK_LINES and matcher.match(line)]
+        if '</RequireAny>' in self.lines:
+            end = len(self.lines) - self.lines[::-1].index('</RequireAny>') - 1
+        else:
+            end = len(self.lines)
+        position = min(matching[-1] + 1, end) if matching else end
+        self.lines[position:position] = new_lines
+
+    def remove(self, names, directive_template):
+        """
+        Removes the lines made with directive_template for one of names (the field of the line has to be the name
+        exactly), returns the names that were found
+        """
+        matcher = compile_template(directive_template)
+        names = set(names)
+        found = set()
+        kept = []
+        for line in self.lines:
+            parsed = None if line in BLOCK_LINES else matcher.match(line)
+            mentioned = names.intersection(parsed.groups()) if parsed is not None else set()
+            if mentioned:
+                found.update(mentioned)
+            else:
+                kept.append(line)
+        self.lines = kept
+        for template in list(self._targets):
+            if template == directive_template:
+                self._targets[template].difference_update(found)
+            elif found:  # Another template may match the removed lines as well
+                self._targets[template] = set(extract_targets(self.lines, template))
+        return found
+
+    def render(self):
+        return "".join("%s\n" % line for line in self.lines)
+
+    def write(self, share, path):
+        """
+        Writes the access file unless its content is unchanged. The file is replaced atomically by a temporary file that
+        already has the permissions of the share, so readers (e.g. apache) never see a partial file or missing ACL.
+        Returns whether the file was written.
+        """
+        content = self.render()
+        if content == self.original:
+            logging.debug("Access file %s is unchanged" % path)
+            return False
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".%s." % os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            share.permissions.set(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.original = content
+        return True
+
+
+# The lines that enclose the directives; they are not directives themselves, also not of the catch-all template '{}'
+BLOCK_LINES = ('<RequireAny>', '</RequireAny>')
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(directive_template):
+    """
+    Compiles a directive template into a regular expression that matches the lines made with it, capturing the
+    values of its fields (matching like parse.parse, i.e. case-insensitive and the whole line)
+    """
+    pattern = ''
+    for literal_text, field_name, _, _ in string.Formatter().parse(directive_template):
+        pattern += re.escape(literal_text)
+        if field_name is not None:
+            pattern += '(.+?)'
+    return re.compile(pattern + r'\Z', re.IGNORECASE | re.DOTALL)
+
+
 def create_at(share, users, user_directive_template, groups, group_directive_template,
               filename='.htaccess.files.bioinf'):
     """
     Creates an .htaccess (or alternative filename) to give access for an apache server to provide access to a share
     """
-    htaccess = ['<RequireAny>']
-    for user in users:
-        htaccess.append(user_directive_template.format(user))
-    for group in groups:
-        htaccess.append(group_directive_template.format(group))
-    htaccess.append('</RequireAny>')
     htaccess_file_path = os.path.join(share.directory, filename)
-    with open(htaccess_file_path, 'w') as f:
-        for line in htaccess:
-            f.write("%s\n" % line)
-    share.permissions.set(htaccess_file_path)
-    logging.debug("Generated and placed htaccess file at %s: %s" % (htaccess_file_path, htaccess))
+    access_file = AccessFile()
+    access_file.original = AccessFile.read(htaccess_file_path).original
+    access_file.add(users, user_directive_template)
+    access_file.add(groups, group_directive_template)
+    if access_file.write(share, htaccess_file_path):
+        logging.debug("Generated and placed htaccess file at %s: %s" % (htaccess_file_path, access_file.lines))
+    apache.update_share(share.directory, access_file.lines)
 
 
 def append_at(share: Share, users: list, user_directive_template: str, groups: list, group_directive_template: str,
               filename: str = '.htaccess.files.bioinf'):
     """
-    Creates a new .htaccess file containing the existing users/groups plus the new ones.
-    WARNING: the directive_template has to be the same as the one used during creation otherwise you might lose
-    permissions for some users/groups
+    Adds users/groups to the .htaccess file, keeping the existing ones.
+    WARNING: the directive_template has to be the same as the one used during creation otherwise users/groups that
+    already have access are added a second time
     """
-    # Try to extract existing htaccess users and groups
-    try:
-        # Create path to htaccess file
-        htaccess_file_path = os.path.join(share.directory, filename)
-        # Try to open it
-        with open(htaccess_file_path, 'r') as htaccess_file:
-            htaccess_lines = htaccess_file.readlines()
-        # Remove unwanted characters
-        htaccess_lines = [line.strip() for line in htaccess_lines]
-        # extract users and groups
-        users += extract_targets(htaccess_lines, user_directive_template)
-        groups += extract_targets(htaccess_lines, group_directive_template)
-    except FileNotFoundError:
+    htaccess_file_path = os.path.join(share.directory, filename)
+    access_file = AccessFile.read(htaccess_file_path)
+    if access_file.original is None:
         warnings.warn(f"No file found called {filename} to append new users/groups to, will create it instead.")
+    access_file.add(users, user_directive_template)
+    access_file.add(groups, group_directive_template)
+    if access_file.write(share, htaccess_file_path):
+        logging.debug("Placed updated htaccess file at %s" % htaccess_file_path)
+    apache.update_share(share.directory, access_file.lines)
 
-    # Recreate htaccess file
-    # list(set()) just to make sure the list is unique to avoid duplications
-    create_at(share, list(set(users)), user_directive_template, list(set(groups)), group_directive_template, filename)
 
 def remove_at(share: Share, target_users: list, target_groups: list,
-              filename: str = '.htaccess.files.bioinf'):
+              filename: str = '.htaccess.files.bioinf', user_directive_template: str = "{}",
+              group_directive_template: str = "{}"):
     """
-    Creates a new .htaccess file containing the existing users/groups minus target_users/target_groups.
-    WARNING: the directive_template has to be the same as the one used during creation otherwise you might lose
-    permissions for some users/groups
+    Removes the lines of target_users/target_groups from the .htaccess file.
+    WARNING: the directive templates have to be the same as the ones used during creation, only lines made with them
+    are removed
     """
-    # Try to extract existing htaccess users and groups
-    try:
-        # Create path to htaccess file
-        htaccess_file_path = os.path.join(share.directory, filename)
-        # Try to open it
-        with open(htaccess_file_path, 'r') as htaccess_file:
-            htaccess_lines = htaccess_file.readlines()
-        # Remove unwanted characters
-        htaccess_lines = [line.strip() for line in htaccess_lines]
-        # Remove users/groups
-        htaccess_lines = [line for line in htaccess_lines if not re.search(rf'\b({"|".join(target_groups+target_users)})\b', line)]
-
-        with open(htaccess_file_path, 'w') as f:
-            for line in htaccess_lines:
-                f.write("%s\n" % line)
-        share.permissions.set(htaccess_file_path)
-        logging.debug("Placed updated htaccess file at %s" % (htaccess_file_path))
-    except FileNotFoundError:
+    htaccess_file_path = os.path.join(share.directory, filename)
+    access_file = AccessFile.read(htaccess_file_path)
+    if access_file.original is None:
         warnings.warn(f"No file found called {filename}")
+        return
+    access_file.remove(target_users, user_directive_template)
+    access_file.remove(target_groups, group_directive_template)
+    if access_file.write(share, htaccess_file_path):
+        logging.debug("Placed updated htaccess file at %s" % htaccess_file_path)
+    apache.update_share(share.directory, access_file.lines)
 
 
 def extract_targets(lines: list, format_string: str):
@@ -85,13 +193,16 @@ def extract_targets(lines: list, format_string: str):
 
     :param lines: List of strings to search in
     :param format_string: Format string used in the past to parse values into a string
-    :return: list of values found with the parse function
+    :return: list of values found with the compiled format string
     """
+    matcher = compile_template(format_string)
     found_targets = []
     for line in lines:
-        parsed = parse.parse(format_string, line)
+        if line in BLOCK_LINES:
+            continue
+        parsed = matcher.match(line)
         if parsed is not None:
-            found_targets += list(parsed)
+            found_targets += list(parsed.groups())
     return found_targets
 
 
@@ -105,3 +216,4 @@ def remove_from(share, filename='.htaccess.files.bioinf', absent_ok=False):
         os.remove(htaccess)
     elif not absent_ok:
         logging.warning("Could not locate htaccess file: %s" % os.path.join(share.directory, filename))
+    apache.remove_share(share.directory)
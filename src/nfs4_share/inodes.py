@@ -0,0 +1,98 @@
+from array import array
+
+_EMPTY = 0
+_NO_SHARE = 0xFFFFFFFF
+
+
+class InodeTable:
+    """
+    Open-addressing hash table of inode numbers (of one device) backed by flat arrays. Every slot costs 17 bytes (inode,
+    first share, links seen and a flag) instead of the >150 bytes a dict of tuples needs, which keeps accounting of
+    100M inodes within a few GiB. Only inodes with more than one hard link are stored: a single-link inode can never be
+    encountered twice.
+    """
+    MAX_LOAD = 0.7
+
+    def __init__(self, capacity=1 << 16):
+        self._allocate(capacity)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _allocate(self, capacity):
+        self._mask = capacity - 1
+        self.keys = array('Q', bytes(8 * capacity))  # inode number + 1, 0 marks an empty slot
+        self.owners = array('I', [_NO_SHARE]) * capacity  # Index of the first share that links the inode
+        self.seen = array('I', bytes(array('I').itemsize * capacity))  # Number of links encountered
+        self.shared = array('B', bytes(capacity))  # 1 when the inode is linked from more than one share
+
+    def _probe(self, key):
+        mask = self._mask
+        slot = ((key * 0x9E3779B97F4A7C15) >> 16) & mask
+        keys = self.keys
+        while keys[slot] != _EMPTY and keys[slot] != key:
+            slot = (slot + 1) & mask
+        return slot
+
+    def _grow(self):
+        keys, owners, seen, shared = self.keys, self.owners, self.seen, self.shared
+        self._allocate(2 * len(keys))
+        for old_slot, key in enumerate(keys):
+            if key != _EMPTY:
+                slot = self._probe(key)
+                self.keys[slot] = key
+                self.owners[slot] = owners[old_slot]
+                self.seen[slot] = seen[old_slot]
+                self.shared[slot] = shared[old_slot]
+
+    def slot(self, inode):
+        """
+        Returns the slot of an inode, inserting the inode when it is new (check `seen[slot] == 0`)
+        """
+        key = inode + 1
+        slot = self._probe(key)
+        if self.keys[slot] == _EMPTY:
+            if self.size + 1 > self.MAX_LOAD * len(self.keys):
+                self._grow()
+                slot = self._probe(key)
+            self.keys[slot] = key
+            self.size += 1
+        return slot
+
+    def __contains__(self, inode):
+        return self.keys[self._probe(inode + 1)] != _EMPTY
+
+
+class InodeSet:
+    """
+    Set of (st_dev, st_ino) pairs made of one InodeTable per device
+    """
+
+    def __init__(self):
+        self.tables = {}
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables.values())
+
+    def __contains__(self, dev_ino):
+        table = self.tables.get(dev_ino[0])
+        return table is not None and dev_ino[1] in table
+
+    def add(self, dev_ino):
+        """
+        Adds an inode, returns True when it was not yet in the set
+        """
+        table = self.tables.get(dev_ino[0])
+        if table is None:
+            table = self.tables[dev_ino[0]] = InodeTable()
+        slot = table.slot(dev_ino[1])
+        new = table.seen[slot] == 0
+        table.seen[slot] = 1
+        return new
+
+    def table(self, dev):
+        table = self.tables.get(dev)
+        if table is None:
+            table = self.tables[dev] = InodeTable()
+        return table
@@ -0,0 +1,146 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import cache
+from . import walk
+from . import htaccess
+from .htaccess import HTACCESS_FILENAME
+from .report import human_readable_size, tabulate
+from .share import Share, is_share_metadata, LOCK_ACE
+
+
+def list_shares(root, cache_file=None, workers=8, refresh=False, user_apache_directive="{}",
+                group_apache_directive="{}"):
+    """
+    Returns a summary (dict) of every share directly below root. Shares are scanned in parallel and their summaries are
+    cached; a cached summary is reused as long as the mtime and ctime of the share directory are unchanged. Every
+    change made by nfs4_share unlocks/locks (or otherwise changes the ACL of) the share directory, which updates its
+    ctime, so deeper changes invalidate the summary as well.
+    """
+    root = os.path.realpath(str(root))
+    if cache_file is None:
+        cache_file = cache.default_cache_file('inventory', root)
+    cached = {} if refresh else cache.load_json(cache_file, default={})
+
+    share_stats = walk.share_directories(root)
+
+    summaries = {}
+    outdated = []
+    for share_directory, share_stat in share_stats.items():
+        entry = cached.get(share_directory)
+        if entry is not None and (entry['mtime_ns'], entry['ctime_ns']) == (share_stat.st_mtime_ns, share_stat.st_ctime_ns):
+            summaries[share_directory] = entry['summary']
+        else:
+            outdated.append(share_directory)
+    logging.info("Scanning %d of %d shares below %s (others are cached)" % (len(outdated), len(share_stats), root))
+
+    def scan(share_directory):
+        return share_directory, summarize_share(share_directory, user_apache_directive, group_apache_directive)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for share_directory, summary in executor.map(scan, outdated):
+            summaries[share_directory] = summary
+            share_stat = share_stats[share_directory]
+            cached[share_directory] = {'mtime_ns': share_stat.st_mtime_ns,
+                                       'ctime_ns': share_stat.st_ctime_ns,
+                                       'summary': summary}
+
+    # Forget shares that no longer exist
+    cached = {share_directory: cached[share_directory] for share_directory in share_stats}
+    if outdated or len(cached) != len(share_stats):
+        cache.dump_json(cache_file, cached)
+    return [summaries[share_directory] for share_directory in sorted(summaries)]
+
+
+def summarize_share(share_directory, user_apache_directive="{}", group_apache_directive="{}"):
+    """
+    Summarizes the users, groups, managers, items, size and lock state of a single share
+    """
+    share = Share(share_directory, exist_ok=True)
+    with share.flock(exclusive=False):
+        return _summarize_share(share, user_apache_directive, group_apache_directive)
+
+
+def _summarize_share(share, user_apache_directive, group_apache_directive):
+    summary = {
+        'share': share.directory,
+        'name': os.path.basename(share.directory),
+        'users': [],
+        'groups': [],
+        'managing_users': [],
+        'managing_groups': [],
+        'web_users': [],
+        'web_groups': [],
+        'locked': False,
+        'items': 0,
+        'files': 0,
+        'size': 0,
+    }
+    try:
+        permissions = share.permissions
+    except (OSError, AssertionError) as e:  # AssertionError: the nfs4 binaries are absent
+        logging.warning("Could not read the permissions of %s: %s" % (share.directory, e))
+        permissions = []
+    manage_permissions = [sorted(share.MANAGE_PERMISSION_LOCK), sorted(share.MANAGE_PERMISSION_UNLOCK)]
+    for entry in permissions:
+        if entry == LOCK_ACE:
+            summary['locked'] = True
+            continue
+        if entry.entry_type != 'A' or entry.identity == 'EVERYONE':
+            continue
+        managing = sorted(entry.permissions) in manage_permissions
+        if 'g' in entry.flags:
+            summary['managing_groups' if managing else 'groups'].append(entry.identity)
+        else:
+            summary['managing_users' if managing else 'users'].append(entry.identity)
+
+    try:
+        with open(os.path.join(share.directory, HTACCESS_FILENAME), 'r') as htaccess_file:
+            lines = [line.strip() for line in htaccess_file]
+        summary['web_users'] = sorted(set(htaccess.extract_targets(lines, user_apache_directive)))
+        summary['web_groups'] = sorted(set(htaccess.extract_targets(lines, group_apache_directive)))
+    except FileNotFoundError:
+        pass
+
+    summary['items'] = len([item for item in os.listdir(share.directory) if not is_share_metadata(item)])
+    for _, directory, entries in walk.scan([share.directory], workers=4):
+        for entry in entries:
+            if entry.is_file() and not (directory == share.directory and is_share_metadata(entry.name)):
+                summary['files'] += 1
+                summary['size'] += entry.stat.st_size
+    return summary
+
+
+def format_table(summaries):
+    """
+    Formats share summaries as a plain-text table
+    """
+    header = ['SHARE', 'LOCKED', 'ITEMS', 'FILES', 'SIZE', 'USERS', 'GROUPS', 'MANAGERS']
+    rows = [header]
+    for summary in summaries:
+        rows.append([summary['name'],
+                     'yes' if summary['locked'] else 'no',
+                     str(summary['items']),
+                     str(summary['files']),
+                     human_readable_size(summary['size']),
+                     ','.join(summary['users']) or '-',
+                     ','.join(summary['groups']) or '-',
+                     ','.join(summary['managing_users'] + summary['managing_groups']) or '-'])
+    return tabulate(rows)
+
+
+def list_command(root, output_json=False, cache_file=None, workers=8, refresh=False, user_apache_directive="{}",
+                 group_apache_directive="{}"):
+    """
+    Prints the inventory of the shares below root (entry point of `nfs4_share list`)
+    """
+    summaries = list_shares(root, cache_file=cache_file, workers=workers, refresh=refresh,
+                            user_apache_directive=user_apache_directive,
+                            group_apache_directive=group_apache_directive)
+    if output_json:
+        print(json.dumps(summaries, indent=2))
+    else:
+        print(format_table(summaries))
+    return summaries
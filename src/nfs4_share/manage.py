@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import errno
 import logging
 import pwd
 import grp
@@ -7,13 +8,19 @@ import os
 
 from pathlib import Path
 from . import htaccess
-from .share import Share
-from .acl import AccessControlList, AccessControlEntity
+from . import checksum
+from .share import Share, share_flock, REMOVED
+from .filters import PathFilter
+from .acl import AccessControlList, AccessControlEntity, get_nfs4_domain
 from . import track_changes
+from . import workqueue
+from . import metrics
+from . import trash as trash_module
 
 def create(share_directory, domain, user_apache_directive="{}", group_apache_directive="{}",
            items=None, users=None, groups=None, managing_users=None, managing_groups=None, lock=True,
-           service_application_accounts=None, track_change_dir=None):
+           service_application_accounts=None, track_change_dir=None, group_commit_window=0, wait=None, include=None,
+           exclude=None, symlinks='follow', queue=None, split_depth=2, queue_timeout=None):
     """
     Creates a share. The directory representing the share should be non-existent.
             For more information on input variables run ./share remove --help
@@ -38,40 +45,44 @@ def create(share_directory, domain, user_apache_directive="{}", group_apache_dir
     ensure_users_exist(users + managing_users + service_application_accounts)
     ensure_groups_exist(groups + managing_groups)
     ensure_items_exist(items)
-    try:
-        share = Share(share_directory)
-        if track_change_dir is not None:
-            track_changes.initialize_file_list(track_change_dir, share_directory)
-            track_changes.initialize_user_list(track_change_dir, share_directory)
-    except FileExistsError as e:
-        logging.exception('Share directory %s already exists!' % share_directory)  # Stack traces by default
-        raise e
-    share.permissions = generate_permissions(users=users + service_application_accounts,
-                                             groups=groups,
-                                             managing_users=managing_users,
-                                             managing_groups=managing_groups,
-                                             domain=domain,
-                                             manage_permissions=share.MANAGE_PERMISSION_UNLOCK)
-    new_items=share.add(items)
-    htaccess.create_at(share=share,
-                       users=users + managing_users,
-                       user_directive_template=user_apache_directive,
-                       groups=groups + managing_groups,
-                       group_directive_template=group_apache_directive)
+    domain = resolve_domain(domain)
+    with share_flock(share_directory, timeout=wait), track_changes.transaction(track_change_dir, group_commit_window=group_commit_window):
+        try:
+            share = Share(share_directory)
+            if track_change_dir is not None:
+                track_changes.initialize_file_list(track_change_dir, share_directory)
+                track_changes.initialize_user_list(track_change_dir, share_directory)
+        except FileExistsError as e:
+            logging.exception('Share directory %s already exists!' % share_directory)  # Stack traces by default
+            raise e
+        share.permissions = generate_permissions(users=users + service_application_accounts,
+                                                 groups=groups,
+                                                 managing_users=managing_users,
+                                                 managing_groups=managing_groups,
+                                                 domain=domain,
+                                                 manage_permissions=share.MANAGE_PERMISSION_UNLOCK)
+        results = add_items(share, items, PathFilter(include, exclude), symlinks, queue, split_depth, queue_timeout)
+        htaccess.create_at(share=share,
+                           users=users + managing_users,
+                           user_directive_template=user_apache_directive,
+                           groups=groups + managing_groups,
+                           group_directive_template=group_apache_directive)
     
-    if track_change_dir is not None:
-        track_changes.track_file_addition(track_change_dir, share_directory, new_items)
-        track_changes.track_user_addition(track_change_dir, share_directory)
-        logging.info(f'Updated shares info in {track_change_dir}')
+        if track_change_dir is not None:
+            track_changes.track_file_addition(track_change_dir, share_directory, results.linked)
+            track_changes.track_user_addition(track_change_dir, share_directory)
+            logging.info(f'Updated shares info in {track_change_dir}')
 
-    logging.info("Finished creating share at %s" % share.directory)
-    if lock:
-        share.lock()
-    return share
+        logging.info("Finished creating share at %s" % share.directory)
+        if lock:
+            share.lock()
+        return share
 
 
 def add(share_directory, user_apache_directive="{}", group_apache_directive="{}", domain=None, items=None, users=None,
-        groups=None, managing_users=None, managing_groups=None, lock=False, service_application_accounts=None, track_change_dir=None):
+        groups=None, managing_users=None, managing_groups=None, lock=False, service_application_accounts=None, track_change_dir=None,
+        group_commit_window=0, wait=None, include=None, exclude=None, symlinks='follow', queue=None, split_depth=2,
+        queue_timeout=None):
     """
         Updates a share. The directory representing the share should exist.
             For more information on input variables run nfs4_share add --help
@@ -92,109 +103,159 @@ def add(share_directory, user_apache_directive="{}", group_apache_directive="{}"
     ensure_users_exist(users)
     ensure_groups_exist(groups)
     ensure_items_exist(items)
-    share = Share(share_directory, exist_ok=True)
+    with share_flock(share_directory, timeout=wait), track_changes.transaction(track_change_dir, group_commit_window=group_commit_window):
+        share = Share(share_directory, exist_ok=True)
     
-    # create an initial file list for tracking changes if the list is not in track change dir yet
-    if track_change_dir is not None:
-        track_changes.initialize_file_list(track_change_dir, share_directory)
-        track_changes.initialize_user_list(track_change_dir, share_directory)
-
-    # Just to be sure,unlock the share (does no harm if no locked)
-    share.unlock()
-    if items:
-        new_items=share.add(items)
+        # create an initial file list for tracking changes if the list is not in track change dir yet
         if track_change_dir is not None:
-            track_changes.track_file_addition(track_change_dir, share_directory, new_items)
-            logging.info(f'Updated shares info in {track_change_dir}')
+            track_changes.initialize_file_list(track_change_dir, share_directory)
+            track_changes.initialize_user_list(track_change_dir, share_directory)
 
-    # Add the users
-    if users or groups:
-        assert domain, "domain cannot be left empty if trying to add users or groups"
-        htaccess.append_at(share=share,
-                           users=users + managing_users,
-                           user_directive_template=user_apache_directive,
-                           groups=groups + managing_groups,
-                           group_directive_template=group_apache_directive)
-        acl = share.permissions
-        updated_acl = acl + generate_permissions(users=users + service_application_accounts,
-                                                 groups=groups,
-                                                 managing_groups=managing_groups,
-                                                 managing_users=managing_users,
-                                                 domain=domain,
-                                                 manage_permissions=share.MANAGE_PERMISSION_UNLOCK)
-        share.permissions = updated_acl
+        # Just to be sure,unlock the share (does no harm if no locked)
+        share.unlock()
+        if items:
+            results = add_items(share, items, PathFilter(include, exclude), symlinks, queue, split_depth, queue_timeout)
+            if track_change_dir is not None:
+                track_changes.track_file_addition(track_change_dir, share_directory, results.linked)
+                logging.info(f'Updated shares info in {track_change_dir}')
 
-        if track_change_dir is not None:
-            track_changes.track_user_addition(track_change_dir, share_directory)
-            logging.info(f'Updated shares info in {track_change_dir}')
+        # Add the users
+        if users or groups:
+            domain = resolve_domain(domain)
+            htaccess.append_at(share=share,
+                               users=users + managing_users,
+                               user_directive_template=user_apache_directive,
+                               groups=groups + managing_groups,
+                               group_directive_template=group_apache_directive)
+            acl = share.permissions
+            updated_acl = acl + generate_permissions(users=users + service_application_accounts,
+                                                     groups=groups,
+                                                     managing_groups=managing_groups,
+                                                     managing_users=managing_users,
+                                                     domain=domain,
+                                                     manage_permissions=share.MANAGE_PERMISSION_UNLOCK)
+            share.permissions = updated_acl
 
-    if lock:
-        share.lock()
-    return share
+            if track_change_dir is not None:
+                track_changes.track_user_addition(track_change_dir, share_directory)
+                logging.info(f'Updated shares info in {track_change_dir}')
+
+        if lock:
+            share.lock()
+        return share
 
 
 def delete(share_directory, domain=None,
-           force=False, items=None, users=None, groups=None,track_change_dir=None, lock=False):
+           force=False, items=None, users=None, groups=None, track_change_dir=None, lock=False, group_commit_window=0,
+           wait=None, trash=False, reap=True, user_apache_directive="{}", group_apache_directive="{}"):
     """
         Deletes a share. The directory representing the share should exist.
                  For more information on input variables run nfs4_share delete --help
+        With trash, the share is moved to the trash of its shares root and removed from there by a reaper in the
+        background (or, without reap, by a later `nfs4_share reap`).
     """
-    share = unlock(share_directory)
-    # create an initial file list for tracking changes if the list is not in track change dir yet
-    if track_change_dir is not None:
-        track_changes.initialize_file_list(track_change_dir, share_directory)
-        track_changes.initialize_user_list(track_change_dir, share_directory)
-    if items is None:
-        items=[]
-    if users is None:
-        users=[]
-    if groups is None:
-        groups=[]
-
-    if not users and not groups and not items:
-        htaccess.remove_from(share, absent_ok=True)
-        share.self_destruct(force_file_removal=force)
-        logging.info("Removed share at %s" % share.directory)
+    with share_flock(share_directory, timeout=wait), track_changes.transaction(track_change_dir, group_commit_window=group_commit_window):
+        if trash and not force and not users and not groups and not items:
+            # The reaper keeps the last copies, but the share would be gone already
+            trash_module.check_sole_copies(share_directory)
+        share = unlock(share_directory)
+        # create an initial file list for tracking changes if the list is not in track change dir yet
         if track_change_dir is not None:
-            track_changes.track_share_deletion(track_change_dir, share_directory)
-        return
+            track_changes.initialize_file_list(track_change_dir, share_directory)
+            track_changes.initialize_user_list(track_change_dir, share_directory)
+        if items is None:
+            items = []
+        if users is None:
+            users = []
+        if groups is None:
+            groups = []
+
+        if not users and not groups and not items:
+            htaccess.remove_from(share, absent_ok=True)
+            checksum.remove_manifests(share)
+            with metrics.phase('remove'):
+                if trash:
+                    trash_share(share, force, reap)
+                else:
+                    share.self_destruct(force_file_removal=force)
+            logging.info("Removed share at %s" % share.directory)
+            if track_change_dir is not None:
+                track_changes.track_share_deletion(track_change_dir, share_directory)
+            return
         
-    if items:
-        # just to be sure that we remove file from share and not somewhere else
-        items=[Path(share_directory, Path(item).name) for item in items]
-        share.remove_items(items, force)
-        if track_change_dir is not None:
-            track_changes.track_file_deletion(track_change_dir, share_directory,items)
+        if items:
+            # just to be sure that we remove file from share and not somewhere else
+            items = [Path(share_directory, Path(item).name) for item in items]
+            with metrics.phase('remove'):
+                results = share.remove_items(items, force)
+            logging.info("Removed items from %s: %s" % (share.directory, results))
+            if track_change_dir is not None:
+                track_changes.track_file_deletion(track_change_dir, share_directory, results.with_status(REMOVED))
 
-    if users or groups:
-        assert domain, "domain cannot be left empty if trying to remove users or groups"
-        # update htaccess
-        logging.info(f"Will attempt to remove {','.join(groups+users)} from {share_directory}")
-        htaccess.remove_at(share=share,
-                           target_users=users,
-                           target_groups=groups)
-        acl = share.permissions
-        # only allow user/groups removal at the moment
-        acl_tobe_removed=generate_permissions(users=users,
-                                              groups=groups,
-                                              managing_groups=[],
-                                              managing_users=[],
-                                              domain=domain,
-                                              manage_permissions=share.MANAGE_PERMISSION_UNLOCK)
-        share.permissions = AccessControlList(set(acl)-set(acl_tobe_removed))
-        not_removed=[user.identity for user in list(set(acl_tobe_removed)-set(acl))]
-        logging.debug(f'users not removed: {not_removed}')
-        if not_removed:
-            for entry in not_removed:
-                logging.warning(f'{entry} ACL permission does not exist in {share_directory}')
-        removed_users=list(set(users+groups)-set(not_removed))
-        logging.info(f'Removed users: {removed_users}')
-        if track_change_dir is not None:
-            track_changes.track_user_removal(track_change_dir, share_directory, removed_users)
-    if lock:
-        share.lock()
+        if users or groups:
+            domain = resolve_domain(domain)
+            # update htaccess
+            logging.info(f"Will attempt to remove {','.join(groups+users)} from {share_directory}")
+            htaccess.remove_at(share=share,
+                               target_users=users,
+                               target_groups=groups,
+                               user_directive_template=user_apache_directive,
+                               group_directive_template=group_apache_directive)
+            acl = share.permissions
+            # only allow user/groups removal at the moment
+            acl_tobe_removed = generate_permissions(users=users,
+                                                    groups=groups,
+                                                    managing_groups=[],
+                                                    managing_users=[],
+                                                    domain=domain,
+                                                    manage_permissions=share.MANAGE_PERMISSION_UNLOCK)
+            share.permissions = acl - acl_tobe_removed
+            not_removed = [user.identity for user in acl_tobe_removed - acl]
+            logging.debug(f'users not removed: {not_removed}')
+            if not_removed:
+                for entry in not_removed:
+                    logging.warning(f'{entry} ACL permission does not exist in {share_directory}')
+            removed_users = list(set(users+groups)-set(not_removed))
+            logging.info(f'Removed users: {removed_users}')
+            if track_change_dir is not None:
+                track_changes.track_user_removal(track_change_dir, share_directory, removed_users)
+        if lock:
+            share.lock()
     
 
+def trash_share(share, force=False, reap=True):
+    """
+    Moves a share to the trash, and starts a background reaper. Falls back to removing the share right away when the
+    trash is on another filesystem.
+    """
+    try:
+        trash_module.move_to_trash(share, force)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        logging.warning("Cannot move %s to the trash (%s), removing it right away" % (share.directory, e))
+        share.self_destruct(force_file_removal=force)
+        return
+    if reap:
+        trash_module.start_background_reaper(os.path.dirname(share.directory))
+
+
+def add_items(share, items, path_filter, symlinks='follow', queue=None, split_depth=2, queue_timeout=None):
+    """
+    Adds items to a share, or with a queue has workers (`nfs4_share worker QUEUE`) link the directory items
+    """
+    with metrics.phase('add'):
+        if queue is None:
+            results = share.add(items, path_filter, symlinks)
+        else:
+            results = workqueue.add_distributed(share, items, path_filter, symlinks, queue, split_depth=split_depth,
+                                                timeout=queue_timeout)
+    for status, count in results.counts().items():
+        metrics.count('nfs4_share_items_total', count, status=status)
+    logging.info("Added items to %s: %s" % (share.directory, results))
+    return results
+
+
 def unlock(share_directory):
     """
         Unlocks a share. The directory representing the share should exist.
@@ -207,6 +268,16 @@ def unlock(share_directory):
     return share
 
 
+def resolve_domain(domain):
+    """
+    Returns the given domain or, when it is left empty, the NFSv4 domain of this machine
+    """
+    if not domain:
+        domain = get_nfs4_domain()
+    assert domain, "domain cannot be left empty and could not be looked up"
+    return domain
+
+
 def ensure_users_exist(users):
     """
     Exits if one of the users does not exist
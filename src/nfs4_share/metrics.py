@@ -0,0 +1,307 @@
+import os
+import re
+import sys
+import time
+import fcntl
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from . import events
+
+# The collector of the running operation, None when no metrics are recorded. Instrumented code checks it first:
+#
+#     with metrics.phase('add'):
+#         ...
+collector = None
+
+# Upper bounds (seconds) of the duration histogram buckets
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+# The metric families recorded by operations: name -> (type, help)
+FAMILIES = {
+    'nfs4_share_operations_total': ('counter', "Operations that were run, by operation and status (ok/error)"),
+    'nfs4_share_operation_duration_seconds': ('histogram', "Duration of operations"),
+    'nfs4_share_phase_duration_seconds': ('histogram', "Duration of the phases of operations (add, lock, commit, ...)"),
+    'nfs4_share_lock_wait_seconds': ('histogram', "Time spent waiting for the advisory lock of a share"),
+    'nfs4_share_items_total': ('counter', "Items that were added, by status (linked, filtered, ...)"),
+    'nfs4_share_filesystem_operations_total': ('counter', "Files and directories linked, created, removed or given "
+                                                          "an ACL, by operation"),
+    'nfs4_share_acl_calls_total': ('counter', "Calls of the nfs4_getfacl and nfs4_setfacl binaries"),
+    'nfs4_share_errors_total': ('counter', "Errors that were logged, by operation and module"),
+}
+
+# The metric families exported by the inventory mode (see metrics_command)
+INVENTORY_FAMILIES = {
+    'nfs4_share_shares': ('gauge', "Shares below the root"),
+    'nfs4_share_share_users': ('gauge', "Users with access to the share (ACL or access file)"),
+    'nfs4_share_share_groups': ('gauge', "Groups with access to the share (ACL or access file)"),
+    'nfs4_share_share_managers': ('gauge', "Managing users and groups of the share"),
+    'nfs4_share_share_items': ('gauge', "Items in the share"),
+    'nfs4_share_share_files': ('gauge', "Files in the share"),
+    'nfs4_share_share_bytes': ('gauge', "Size of the files in the share"),
+    'nfs4_share_share_locked': ('gauge', "Whether the share is locked"),
+    'nfs4_share_share_sole_copy_bytes': ('gauge', "Size of the files of which the share holds the last copy"),
+}
+
+_sample = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in sorted(labels.items()))
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Collector:
+    """
+    Counters and histograms of one operation, kept in memory until they are merged into the textfile
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.samples = {}  # (name, label text) -> value
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.samples[key] = self.samples.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        with self._lock:
+            for bound in DURATION_BUCKETS + ('+Inf',):
+                if bound == '+Inf' or seconds <= bound:
+                    key = (name + '_bucket', _labels(dict(labels, le=bound)))
+                    self.samples[key] = self.samples.get(key, 0) + 1
+            for suffix, value in [('_sum', seconds), ('_count', 1)]:
+                key = (name + suffix, _labels(labels))
+                self.samples[key] = self.samples.get(key, 0) + value
+
+
+class MetricsSink:
+    """
+    Event sink (see events.py) that counts the filesystem operations, passing the events on to the sink it replaced
+    """
+
+    def __init__(self, collector, previous=None):
+        self.collector = collector
+        self.previous = previous
+
+    def emit(self, operation, path, fields):
+        self.collector.count('nfs4_share_filesystem_operations_total', operation=self.collector.operation, op=operation)
+        if self.previous is not None:
+            self.previous.emit(operation, path, fields)
+
+    def close(self):
+        pass
+
+
+class ErrorCounter(logging.Handler):
+    """
+    Counts the errors that are logged, per module
+    """
+
+    def __init__(self, collector):
+        super().__init__(level=logging.ERROR)
+        self.collector = collector
+
+    def emit(self, record):
+        self.collector.count('nfs4_share_errors_total', operation=self.collector.operation, module=record.module)
+
+
+def count(name, value=1, **labels):
+    """
+    Adds value to a counter of the running operation, if metrics are recorded
+    """
+    if collector is not None:
+        collector.count(name, value, operation=collector.operation, **labels)
+
+
+def observe(name, seconds, **labels):
+    """
+    Adds a duration to a histogram of the running operation, if metrics are recorded
+    """
+    if collector is not None:
+        collector.observe(name, seconds, operation=collector.operation, **labels)
+
+
+@contextmanager
+def phase(name):
+    """
+    Context whose duration is recorded as a phase of the running operation
+    """
+    if collector is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        collector.observe('nfs4_share_phase_duration_seconds', time.monotonic() - start,
+                          operation=collector.operation, phase=name)
+
+
+def parse(text):
+    """
+    Parses a textfile into its samples ({(name, label text): value}) and its HELP/TYPE lines ({name: [lines]})
+    """
+    samples = {}
+    headers = {}
+    for line in text.splitlines():
+        if line.startswith('# HELP ') or line.startswith('# TYPE '):
+            headers.setdefault(line.split(' ')[2], []).append(line)
+            continue
+        match = _sample.match(line)
+        if match is not None:
+            samples[(match.group(1), match.group(2) or '')] = float(match.group(3))
+    return samples, headers
+
+
+def render(samples, headers=None):
+    """
+    Renders samples in the Prometheus text format, with the HELP/TYPE lines of the known families
+    """
+    headers = dict(headers or {})
+    for name, (metric_type, description) in FAMILIES.items():
+        headers[name] = ["# HELP %s %s" % (name, description), "# TYPE %s %s" % (name, metric_type)]
+    families = {}
+    for name, label_text in samples:
+        family = next((family for family in headers if name == family or name in
+                       (family + '_bucket', family + '_sum', family + '_count')), name)
+        families.setdefault(family, []).append((name, label_text))
+    lines = []
+    for family in sorted(families):
+        lines.extend(headers.get(family, []))
+        for name, label_text in sorted(families[family], key=_sample_order):
+            lines.append("%s%s %s" % (name, label_text, _format_value(samples[(name, label_text)])))
+    return "\n".join(lines) + "\n"
+
+
+def _sample_order(key):
+    name, label_text = key
+    match = re.search(r'le="([^"]*)"', label_text)
+    if match is None:
+        return name, label_text, 0
+    bound = float('inf') if match.group(1) == '+Inf' else float(match.group(1))
+    return name, re.sub(r',?le="[^"]*"', '', label_text), bound
+
+
+def write_textfile(filename, samples, merge=True, headers=None):
+    """
+    Writes samples to a node_exporter textfile: under an advisory lock, so concurrent processes do not lose each
+    other's updates, and atomically (temporary file + rename), so the collector never reads a partial file. With merge,
+    the samples are added to those already in the file (all recorded metrics are cumulative).
+    """
+    filename = os.path.abspath(str(filename))
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    with open(filename + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            headers = dict(headers or {})
+            if merge:
+                try:
+                    with open(filename, 'r') as f:
+                        existing, existing_headers = parse(f.read())
+                except FileNotFoundError:
+                    existing, existing_headers = {}, {}
+                headers = dict(existing_headers, **headers)
+                for key, value in samples.items():
+                    existing[key] = existing.get(key, 0) + value
+                samples = existing
+            fd, tmp_filename = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(filename))
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(render(samples, headers))
+                os.chmod(tmp_filename, 0o644)
+                os.replace(tmp_filename, filename)
+            except BaseException:
+                os.unlink(tmp_filename)
+                raise
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def recording(textfile, operation):
+    """
+    Context in which the metrics of an operation are recorded; they are merged into textfile when the context exits.
+    Records the duration and outcome of the operation, the filesystem operations (through the event stream) and the
+    errors that are logged.
+    """
+    global collector
+    previous = collector
+    collector = Collector(operation)
+    previous_sink = events.sink
+    events.sink = MetricsSink(collector, previous_sink)
+    error_counter = ErrorCounter(collector)
+    logging.getLogger().addHandler(error_counter)
+    start = time.monotonic()
+    status = 'error'
+    try:
+        yield collector
+        status = 'ok'
+    except SystemExit as e:
+        status = 'ok' if not e.code else 'error'
+        raise
+    finally:
+        logging.getLogger().removeHandler(error_counter)
+        events.sink = previous_sink
+        collector.count('nfs4_share_operations_total', operation=operation, status=status)
+        collector.observe('nfs4_share_operation_duration_seconds', time.monotonic() - start, operation=operation)
+        try:
+            write_textfile(textfile, collector.samples)
+        except OSError as e:
+            logging.warning("Could not write the metrics to %s: %s" % (textfile, e))
+        collector = previous
+
+
+def inventory_samples(root, workers=8, refresh=False, sole_copies=True):
+    """
+    Returns per-share gauges for the shares below root, computed from the cached scans of `list` (see
+    inventory.list_shares) and `sole-copies` (see solecopy.find_sole_copies)
+    """
+    from .inventory import list_shares
+    from .solecopy import find_sole_copies
+    samples = {}
+    summaries = list_shares(root, workers=workers, refresh=refresh)
+    samples[('nfs4_share_shares', _labels({'root': os.path.realpath(str(root))}))] = len(summaries)
+    for summary in summaries:
+        labels = _labels({'share': summary['name']})
+        samples[('nfs4_share_share_users', labels)] = len(set(summary['users'] + summary['web_users']))
+        samples[('nfs4_share_share_groups', labels)] = len(set(summary['groups'] + summary['web_groups']))
+        samples[('nfs4_share_share_managers', labels)] = len(summary['managing_users'] + summary['managing_groups'])
+        samples[('nfs4_share_share_items', labels)] = summary['items']
+        samples[('nfs4_share_share_files', labels)] = summary['files']
+        samples[('nfs4_share_share_bytes', labels)] = summary['size']
+        samples[('nfs4_share_share_locked', labels)] = int(summary['locked'])
+        if sole_copies:
+            samples[('nfs4_share_share_sole_copy_bytes', labels)] = 0
+    if sole_copies:
+        for share, items in find_sole_copies(root, workers=workers).items():
+            samples[('nfs4_share_share_sole_copy_bytes', _labels({'share': share}))] = \
+                sum(item['bytes'] for item in items.values())
+    return samples
+
+
+def metrics_command(root, output='-', workers=8, refresh=False, sole_copies=True):
+    """
+    Exports per-share gauges for the shares below root as a node_exporter textfile (entry point of `nfs4_share
+    metrics`); '-' prints them
+    """
+    samples = inventory_samples(root, workers=workers, refresh=refresh, sole_copies=sole_copies)
+    headers = {name: ["# HELP %s %s" % (name, description), "# TYPE %s %s" % (name, metric_type)]
+               for name, (metric_type, description) in INVENTORY_FAMILIES.items()}
+    if output == '-':
+        sys.stdout.write(render(samples, headers))
+    else:
+        write_textfile(output, samples, merge=False, headers=headers)
+    return samples
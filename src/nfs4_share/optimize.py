@@ -0,0 +1,148 @@
+import os
+import json
+import logging
+
+from . import walk
+from .acl import AccessControlList, group_members, user_groups, read_entries
+from .htaccess import HTACCESS_FILENAME
+from .report import tabulate
+from .share import Share
+
+
+def is_group(entry):
+    return 'g' in entry.flags
+
+
+def applies_to(entry, user, groups=user_groups):
+    """
+    Returns whether an ACE applies to a user (who is identified by name). The groups of the user are looked up with
+    groups (see acl.user_groups, which does not depend on enumerating the users of a group); when they are unknown,
+    a group ACE is assumed to apply.
+    """
+    if entry.identity == 'EVERYONE':
+        return True
+    if is_group(entry):
+        try:
+            return entry.identity in groups(user)
+        except KeyError:
+            return True
+    return entry.identity == user
+
+
+def ace_size(entry):
+    """
+    Returns the size in bytes of an ACE as sent by the NFS server (type, flags, mask and the padded who string)
+    """
+    who = "%s@" % entry.identity if entry.identity == 'EVERYONE' else "%s@%s" % (entry.identity, entry.domain)
+    return 16 + (len(who.encode()) + 3) // 4 * 4
+
+
+def covering_group_entry(entries, index, members=group_members, groups=user_groups):
+    """
+    Returns the index of an ALLOW group ACE that grants (at least) the permissions of the user ALLOW ACE at index to
+    the same user, with the same inheritance flags, such that dropping the user ACE does not change access: either the
+    group ACE comes first, or no DENY ACE in between applies to the user for any of the permissions involved. Returns
+    None if there is no such group ACE. A user that members does not list is not covered, and a DENY ACE that may apply
+    to the user (see applies_to) keeps the user ACE, so an incomplete user directory only makes the result less small.
+    """
+    user_entry = entries[index]
+    flags = set(user_entry.flags)
+    for group_index, entry in enumerate(entries):
+        if entry.entry_type != 'A' or not is_group(entry) or entry.domain != user_entry.domain \
+                or set(entry.flags) - {'g'} != flags or not set(user_entry.permissions) <= set(entry.permissions) \
+                or user_entry.identity not in members(entry.identity):
+            continue
+        in_between = entries[index + 1:group_index]
+        if any(deny.entry_type == 'D' and set(deny.permissions) & set(user_entry.permissions)
+               and applies_to(deny, user_entry.identity, groups) for deny in in_between):
+            continue
+        return group_index
+    return None
+
+
+def optimize_acl(acl, members=group_members, groups=user_groups):
+    """
+    Returns an equivalent ACL without redundant entries, and the removed entries of acl (an iterable of entries, e.g.
+    as returned by acl.read_entries):
+    * duplicates of an earlier entry
+    * ALLOW entries of users whose access is already granted by an ALLOW entry of one of their groups
+    members is a function that returns the members of a group (see acl.group_members), groups one that returns the
+    groups of a user (see acl.user_groups)
+    """
+    entries = []
+    removed = []
+    seen = set()
+    for entry in acl:
+        if entry in seen:
+            removed.append(entry)
+        else:
+            seen.add(entry)
+            entries.append(entry)
+    index = 0
+    while index < len(entries):
+        entry = entries[index]
+        if entry.entry_type == 'A' and not is_group(entry) and entry.identity != 'EVERYONE' \
+                and covering_group_entry(entries, index, members, groups) is not None:
+            removed.append(entries.pop(index))
+            continue
+        index += 1
+    return AccessControlList(entries), removed
+
+
+def optimize_share(share_directory, apply=False, members=group_members, groups=user_groups):
+    """
+    Optimizes the ACL of a share and reports the ACE count and bytes before and after. With apply, the optimized ACL
+    is set on the share and its access file, and on its subdirectories with the manage entries unlocked (lock() only
+    takes the write permission of the managers away on the share directory itself). Shared files keep their own ACL.
+    """
+    share = Share(share_directory, exist_ok=True)
+    with share.flock(exclusive=apply):
+        acl = read_entries(share.directory)  # Not share.permissions, which drops duplicates
+        optimized, removed = optimize_acl(acl, members, groups)
+        report = {
+            'share': share.directory,
+            'entries_before': len(acl),
+            'entries_after': len(optimized),
+            'bytes_before': sum(ace_size(entry) for entry in acl),
+            'bytes_after': sum(ace_size(entry) for entry in optimized),
+            'removed': [repr(entry) for entry in removed],
+            'applied': False,
+        }
+        if apply and removed:
+            optimized.set(share.directory)
+            Share.manage_write_adjusted(optimized, add_write=True).set_many(share._subdirectories())
+            if os.path.exists(os.path.join(share.directory, HTACCESS_FILENAME)):
+                optimized.set(os.path.join(share.directory, HTACCESS_FILENAME))
+            report['applied'] = True
+            logging.info("Removed %d redundant ACEs from %s: %s" % (len(removed), share.directory, report['removed']))
+    return report
+
+
+def format_report(reports):
+    """
+    Formats optimization reports as a plain-text table
+    """
+    rows = [['SHARE', 'ACES', 'OPTIMIZED', 'BYTES', 'OPTIMIZED', 'SAVED', 'APPLIED']]
+    for report in reports:
+        rows.append([os.path.basename(report['share']),
+                     str(report['entries_before']),
+                     str(report['entries_after']),
+                     str(report['bytes_before']),
+                     str(report['bytes_after']),
+                     str(report['bytes_before'] - report['bytes_after']),
+                     'yes' if report['applied'] else 'no'])
+    return tabulate(rows)
+
+
+def optimize_command(shares, root=False, apply=False, output_json=False):
+    """
+    Proposes (or with apply, sets) smaller equivalent ACLs for shares (entry point of `nfs4_share optimize`)
+    """
+    if root:
+        shares = [share for directory in shares for share in sorted(walk.share_directories(directory))]
+    reports = [optimize_share(share, apply=apply) for share in shares]
+    if output_json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(format_report(reports))
+    return reports
@@ -0,0 +1,17 @@
+def human_readable_size(size):
+    """
+    Formats a number of bytes using binary units (e.g. '1.5 GiB')
+    """
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB']:
+        if size < 1024 or unit == 'PiB':
+            break
+        size /= 1024.0
+    return ("%d %s" if unit == 'B' else "%.1f %s") % (size, unit)
+
+
+def tabulate(rows):
+    """
+    Formats rows (lists of strings, the first being the header) as a plain-text table with aligned columns
+    """
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
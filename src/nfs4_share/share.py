@@ -1,8 +1,103 @@
+import errno
+import fcntl
 import logging
 import os
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
+from . import events
+from . import metrics
+from . import walk
+from . inodes import InodeSet
 from . acl import AccessControlList, AccessControlEntity
+from . cache import load_json, dump_json
+
+# How symbolic links within shared directories are handled:
+# * follow: share what they point to, traversing every directory (and linking every file) only once
+# * skip: leave them out
+# * mirror: create the same symbolic link in the share
+SYMLINK_POLICIES = ('follow', 'skip', 'mirror')
+# Seconds to wait for a share that is in use by another process (None waits indefinitely, 0 fails immediately)
+lock_timeout = None
+LOCK_POLL_INTERVAL = 0.1
+# Directories that are locked or unlocked per nfs4_setfacl call
+LOCK_BATCH_SIZE = 256
+# Advisory locks held by this process per thread and share, see share_flock()
+_held_flocks = {}
+# Files kept in a share directory next to the shared items (see is_share_metadata): the access file (see htaccess.py)
+# and the checksum manifest per algorithm, in the format of sha256sum and friends (see checksum.py)
+HTACCESS_FILENAME = '.htaccess.files.bioinf'
+MANIFESTS = {'md5': 'MD5SUMS', 'sha1': 'SHA1SUMS', 'sha256': 'SHA256SUMS', 'sha512': 'SHA512SUMS'}
+
+# Outcomes of adding and removing items, see ItemResults
+LINKED = 'linked'  # Newly shared
+RELINKED = 'relinked'  # Shared before, linked again
+PRESENT = 'present'  # Already in the share
+FILTERED = 'filtered'  # Left out by the filter
+PERMISSION_DENIED = 'permission-denied'
+CROSS_DEVICE = 'cross-device'  # On another filesystem than the share
+UNHANDLED = 'unhandled'  # Not a file or directory
+REMOVED = 'removed'
+MISSING = 'missing'  # Not in the share
+
+
+class ItemResult:
+    """
+    The outcome of adding or removing a single item: one of the statuses above and why, when it is not obvious
+    """
+    __slots__ = ('item', 'status', 'reason')
+
+    def __init__(self, item, status, reason=None):
+        self.item = item
+        self.status = status
+        self.reason = reason
+
+    def __repr__(self):
+        return "ItemResult({!r}, {!r})".format(str(self.item), self.status)
+
+
+class ItemResults:
+    """
+    The outcomes of an add or remove per item, in the order the items were handled
+    """
+
+    def __init__(self, results=()):
+        self.results = {}
+        for result in results:
+            self.results[result.item] = result
+
+    def __repr__(self):
+        return "ItemResults(%s)" % ", ".join("%s=%d" % count for count in sorted(self.counts().items()))
+
+    def __iter__(self):
+        return iter(self.results.values())
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, item):
+        return self.results[item]
+
+    def record(self, item, status, reason=None):
+        self.results[item] = ItemResult(item, status, reason)
+
+    def with_status(self, *statuses):
+        return [result.item for result in self.results.values() if result.status in statuses]
+
+    @property
+    def linked(self):
+        """
+        The items that are new in the share
+        """
+        return self.with_status(LINKED)
+
+    def counts(self):
+        counts = {}
+        for result in self.results.values():
+            counts[result.status] = counts.get(result.status, 0) + 1
+        return counts
 
 
 class Share:
@@ -23,7 +118,7 @@ class Share:
     def __init__(self, directory, exist_ok=False):
         self.directory = os.path.realpath(directory)
         if os.path.exists(directory):
-            logging.debug("\'%s\' exists." % os.path.basename(directory))
+            logging.debug("\'%s\' exists.", os.path.basename(directory))
         if os.path.exists(directory) and os.path.isfile(directory):
             raise IllegalShareSetupError("%s should be not non-existent or a directory!" % directory)
         os.makedirs(self.directory, exist_ok=exist_ok)
@@ -31,93 +126,194 @@ class Share:
     def __repr__(self):
         return "Share({!r})".format(os.path.basename(self.directory))
 
+    def flock(self, exclusive=True, timeout=None):
+        """
+        Context holding the advisory lock of this share, see share_flock()
+        """
+        return share_flock(self.directory, exclusive=exclusive, timeout=timeout)
+
     @property
     def permissions(self):
         return AccessControlList.from_file(self.directory)
 
     @permissions.setter
     def permissions(self, acl):
-        logging.debug("Setting permissions on %s: %s" % (self.directory, acl))
+        logging.debug("Setting permissions on %s: %s", self.directory, acl)
         acl.set(self.directory)
 
-    def add(self, items):
-        """
-        Adds items to the share
-        """
-        logging.debug("Adding items to %s: %s" % (self.directory, items))
-        files = [i for i in items if os.path.isfile(i)]
-        directories = [i for i in items if os.path.isdir(i)]
-        # shared_items is used to get a final list of shared files
-        # will be used to track filelist changes
-        shared_items = items
-        for file in files:
-            target_file = os.path.join(self.directory, os.path.basename(file))
-            # remove from shared items if file already exist in share
-            shared_items = self._link_files(file, target_file, shared_items)
-        for directory in directories:
+    def add(self, items, path_filter=None, symlinks='follow'):
+        """
+        Adds items to the share and returns their ItemResults. A PathFilter (see filters.py) limits which files and
+        directories within the items are shared; it is recorded in the metadata of the share (see record_items).
+        symlinks is the policy for symbolic links within directories (see SYMLINK_POLICIES).
+        """
+        return ItemResults(self.iter_add(items, path_filter, symlinks))
+
+    def iter_add(self, items, path_filter=None, symlinks='follow'):
+        """
+        Adds items (any iterable) one by one and yields an ItemResult per item, so a huge list of items can be
+        streamed. The items are recorded in the metadata once the generator is exhausted or closed.
+        """
+        linked_inodes = InodeSet()
+        recorded = []
+        try:
+            for item in items:
+                result = self._add_item(item, path_filter, symlinks, linked_inodes)
+                if result.status != UNHANDLED and not (result.status == FILTERED and os.path.isfile(item)):
+                    recorded.append(item)
+                yield result
+        finally:
+            self.record_items(recorded, path_filter, symlinks)
+
+    def _add_item(self, item, path_filter, symlinks, linked_inodes):
+        logging.debug("Adding %s to %s", item, self.directory)
+        if os.path.isfile(item):
+            if path_filter and not path_filter.includes_file(os.path.basename(item)):
+                logging.debug("Not sharing %s, it is filtered out", item)
+                return ItemResult(item, FILTERED)
+            return ItemResult(item, *self._link_files(item, os.path.join(self.directory, os.path.basename(item))))
+        if os.path.isdir(item):
+            status = LINKED
             try:
-                self._duplicate_as_linked_tree(directory)
+                shared, failed = self._duplicate_as_linked_tree(item, path_filter, symlinks, linked_inodes)
             except FileExistsError as e:
-                logging.debug("Directory %s already exists! Going to remove and re-add it!" % e.filename)
+                logging.debug("Directory %s already exists! Going to remove and re-add it!", e.filename)
                 # It is already there, either by having been added before or within an update
                 self._unshare_linked_tree(e.filename)
-                self._duplicate_as_linked_tree(directory)
-                # remove source directory from new items, if they exist in the share
-                shared_items.remove(directory)
-        for unhandled_item in set(items) - set(directories).union(set(files)):
-            shared_items.remove(unhandled_item)
-            logging.error("Did not handle input item '%s'" % unhandled_item)
-        return shared_items
+                shared, failed = self._duplicate_as_linked_tree(item, path_filter, symlinks, linked_inodes)
+                status = RELINKED
+            if not shared and failed:
+                return ItemResult(item, failed[0], "none of the %d files that pass the filter could be linked" %
+                                  len(failed))
+            if not shared:
+                return ItemResult(item, FILTERED, "nothing passes the filter")
+            return ItemResult(item, status, "%d files could not be linked" % len(failed) if failed else None)
+        logging.error("Did not handle input item '%s'", item)
+        return ItemResult(item, UNHANDLED, "not a file or directory")
 
-    def _duplicate_as_linked_tree(self, source_root):
+    def _duplicate_as_linked_tree(self, source_root, path_filter=None, symlinks='follow', linked_inodes=None):
         """
-        Traverses the directory tree, creating new directories but hard-linking files.
+        Traverses the directory tree, creating new directories but hard-linking files. With a path_filter, excluded
+        directories are not descended into and directories are only created once a file is linked within them.
+
+        Symbolic links are handled according to symlinks (see SYMLINK_POLICIES). Every directory is visited at most
+        once, at the path walk.item_directories() picks (real directories before symlinked ones), so symlink loops and
+        subtrees that are reachable through several paths are not traversed again, and a file that is reached through
+        a symlink is not linked again when its inode has already been linked (linked_inodes, an inodes.InodeSet, is
+        shared by the items of one add).
+        Returns whether anything was shared and the statuses of the files that could not be linked (see _link_files).
         """
-        logging.debug("Started traversing %s \'s tree for file linkage and directory duplication." % self.directory)
+        if symlinks not in SYMLINK_POLICIES:
+            raise ValueError("Unknown symlink policy '%s' (use one of %s)" % (symlinks, ", ".join(SYMLINK_POLICIES)))
+        if linked_inodes is None:
+            linked_inodes = InodeSet()
+        logging.debug("Started traversing %s \'s tree for file linkage and directory duplication.", self.directory)
         #  Create the containing directory that resides within the share
         within_share_dir_path = os.path.join(self.directory, os.path.basename(source_root))
         self._makedir(within_share_dir_path)
-        for root, subdirectories, files in os.walk(source_root, followlinks=True):
-            share_root = root.replace(str(source_root), within_share_dir_path, 1)
-            for subdir in subdirectories:
-                target = os.path.join(share_root, subdir)
-                self._makedir(target)
-            for file in files:
-                source = os.path.join(root, file)
-                target = os.path.join(share_root, file)
-                self._link_files(source, target)
+        created = {within_share_dir_path}
+        linked = False
+        failed = []
+
+        def skipped(path, _):
+            logging.warning("Not traversing %s, the same directory was reached through another path (e.g. a symlink "
+                            "loop) or it does not resolve to a directory", path)
+
+        for root, relative_root, _, share_root, subdirectories in walk.item_directories(
+                source_root, context=within_share_dir_path, skipped=skipped):
+            if not path_filter and share_root not in created:
+                self._makedir(share_root)
+                created.add(share_root)
+            with os.scandir(root) as iterator:
+                entries = sorted(iterator, key=lambda entry: entry.name)
+            for entry in entries:
+                is_directory = entry.is_dir()  # Follows symlinks
+                if path_filter and not (path_filter.includes_directory(relative_root + entry.name) if is_directory
+                                        else path_filter.includes_file(relative_root + entry.name)):
+                    continue
+                if entry.is_symlink() and symlinks != 'follow':
+                    if symlinks == 'mirror':
+                        if share_root not in created:
+                            self._makedirs(share_root, created)
+                        self._mirror_symlink(entry.path, os.path.join(share_root, entry.name))
+                        linked = True
+                    continue
+                if is_directory:
+                    subdirectories.append((entry.name, os.path.join(share_root, entry.name)))
+                    continue
+                try:
+                    source_stat = os.stat(entry.path)
+                except FileNotFoundError:  # A dangling symlink
+                    logging.warning("Skipping %s, it does not resolve to a file", entry.path)
+                    continue
+                if not linked_inodes.add((source_stat.st_dev, source_stat.st_ino)) and entry.is_symlink():
+                    logging.debug("Not linking %s, its file is already linked through another path", entry.path)
+                    continue
+                if share_root not in created:
+                    self._makedirs(share_root, created)
+                link_status = self._link_files(entry.path, os.path.join(share_root, entry.name))[0]
+                if link_status in (LINKED, PRESENT):
+                    linked = True
+                else:
+                    failed.append(link_status)
+        if path_filter and not linked:
+            logging.info("Nothing in %s passes the filter or could be linked, not sharing it", source_root)
+        if path_filter and failed:
+            # The directories were created for files that could not be linked; the ones that stayed empty are removed
+            for directory in sorted(created, reverse=True):
+                if not os.listdir(directory):
+                    self._unshare_dir(directory)
+        elif path_filter and not linked:
+            self._unshare_dir(within_share_dir_path)
+        return linked or not path_filter, failed
+
+    @staticmethod
+    def _mirror_symlink(source, target):
+        """
+        Creates a symlink in the share that points where the symlink in the source points to
+        """
+        logging.debug("Mirroring symlink %s at %s", source, target)
+        os.symlink(os.readlink(source), target)
+        if events.sink is not None:
+            events.emit('symlink', target, source=source)
 
     def _unshare_linked_tree(self, directory, force_file_removal=False):
         """
         will have the share remove itself
         """
-        logging.debug("Started traversing %s\'s tree from bottom up for un-sharing" % self.directory)
-        for root, subdirectories, files in os.walk(directory, topdown=False, followlinks=True):
+        logging.debug("Started traversing %s\'s tree from bottom up for un-sharing", self.directory)
+        # Symlinks are never followed: they are removed themselves, not what they point to
+        for root, subdirectories, files in os.walk(directory, topdown=False, followlinks=False):
             for shared_file in files:
                 self._unshare_file(os.path.join(root, shared_file), force=force_file_removal)
             for sub_dir in subdirectories:
-                self._unshare_dir(os.path.join(root, sub_dir))
-        os.rmdir(directory)
+                if os.path.islink(os.path.join(root, sub_dir)):
+                    self._unshare_file(os.path.join(root, sub_dir))
+                else:
+                    self._unshare_dir(os.path.join(root, sub_dir))
+        self._unshare_dir(directory)
 
     def lock(self):
         """
         locks down the share for changing anything other than the access
         """
-        logging.debug("Locking %s (and subdirectories)" % self.directory)
-        self._adjust_manage_write_permissions(add_write=False)
-        LOCK_ACL.append(target=self.directory)
-        for subdirectory in self._subdirectories():
-            LOCK_ACL.append(target=subdirectory)
+        logging.debug("Locking %s (and subdirectories)", self.directory)
+        with metrics.phase('lock'):
+            self._adjust_manage_write_permissions(add_write=False)
+            targets = [self.directory] + list(self._subdirectories())
+            for start in range(0, len(targets), LOCK_BATCH_SIZE):
+                LOCK_ACL.append(target=targets[start:start + LOCK_BATCH_SIZE])
 
     def unlock(self):
         """
         unlocks the share for changing anything other than the access
         """
-        logging.debug("Unlocking %s (and subdirectories)" % self.directory)
-        self._adjust_manage_write_permissions(add_write=True)
-        LOCK_ACL.unset(target=self.directory)
-        for subdirectory in self._subdirectories():
-            LOCK_ACL.unset(target=subdirectory)
+        logging.debug("Unlocking %s (and subdirectories)", self.directory)
+        with metrics.phase('unlock'):
+            self._adjust_manage_write_permissions(add_write=True)
+            targets = [self.directory] + list(self._subdirectories())
+            for start in range(0, len(targets), LOCK_BATCH_SIZE):
+                LOCK_ACL.unset(target=targets[start:start + LOCK_BATCH_SIZE])
 
     def _adjust_manage_write_permissions(self, add_write: bool):
         """
@@ -125,83 +321,271 @@ class Share:
         :param add_write: If True find MANAGE_PERMISSION_LOCK and change to MANAGE_PERMISSION_UNLOCK; if False visa versa
         :type add_write: Bool
         """
-        new_entries = []
-        target = self.MANAGE_PERMISSION_LOCK if add_write else self.MANAGE_PERMISSION_UNLOCK
-        replacement = self.MANAGE_PERMISSION_UNLOCK if add_write else self.MANAGE_PERMISSION_LOCK
-        for entry in self.permissions.entries:
-            permission = entry.permissions
-            if sorted(list(permission)) == sorted(list(target)):
-                permission = replacement
-                entry.permissions = permission
-            new_entries.append(entry)
-        self.permissions = AccessControlList(new_entries)
+        self.permissions = self.manage_write_adjusted(self.permissions, add_write)
+
+    @classmethod
+    def manage_write_adjusted(cls, acl, add_write):
+        """
+        Returns acl with the write permission added to (or removed from) the entries with manage permissions
+        """
+        target = cls.MANAGE_PERMISSION_LOCK if add_write else cls.MANAGE_PERMISSION_UNLOCK
+        replacement = cls.MANAGE_PERMISSION_UNLOCK if add_write else cls.MANAGE_PERMISSION_LOCK
+        for entry in acl.entries:
+            if sorted(list(entry.permissions)) == sorted(list(target)):
+                acl = acl.replace(entry, AccessControlEntity(entry.entry_type, entry.flags, entry.identity, entry.domain,
+                                                             replacement))
+        return acl
 
     def _subdirectories(self):
         """
-        Generator for all subdirectories in a share
+        Generator for all subdirectories in a share, at any depth (symlinks are not followed)
         """
-        for o in os.listdir(self.directory):
-            if os.path.isdir(os.path.join(self.directory, o)):
-                yield os.path.join(self.directory, o)
+        for root, subdirectories, _ in os.walk(self.directory):
+            for subdirectory in subdirectories:
+                if not os.path.islink(os.path.join(root, subdirectory)):
+                    yield os.path.join(root, subdirectory)
 
-    def _makedir(self, directory):
+    def _makedir(self, directory, permissions=True):
         """
-        Created a directory and outputs to log
+        Created a directory and outputs to log. Without permissions, the caller sets the ACL of the share on it.
         """
-        logging.debug("Creating %s" % directory)
+        logging.debug("Creating %s", directory)
         os.makedirs(directory)
-        self.permissions.set(target=directory)
+        if events.sink is not None:
+            events.emit('mkdir', directory)
+        if permissions:
+            self.permissions.set(target=directory)
+
+    def _makedirs(self, directory, created, permissions=True):
+        """
+        Creates a directory and the parents that are not in created (a set that is updated) and do not exist, returns
+        the directories that were created
+        """
+        missing = []
+        while directory not in created and not os.path.isdir(directory):
+            missing.append(directory)
+            directory = os.path.dirname(directory)
+        for directory in reversed(missing):
+            self._makedir(directory, permissions)
+            created.add(directory)
+        return missing[::-1]
+
+    @property
+    def metadata(self):
+        """
+        Metadata of the share (e.g. where its items came from), kept next to the share as the share may be locked
+        """
+        return load_json(metadata_file(self.directory), default={'items': {}})
+
+    def record_items(self, items, path_filter=None, symlinks='follow'):
+        """
+        Records the source paths of items, the filter and the symlink policy they were shared with in the metadata, for
+        later re-syncs (see sync.py)
+        """
+        if not items:
+            return
+        metadata = self.metadata
+        for item in items:
+            settings = path_filter.to_dict() if path_filter else {}
+            settings['symlinks'] = symlinks
+            metadata['items'][os.path.realpath(str(item))] = settings
+        dump_json(metadata_file(self.directory), metadata)
 
-    def _link_files(self, source, target, shared_item_list=[]):
+    def _link_files(self, source, target):
         """
-        Creates a hard link between two files and outputs to log
+        Creates a hard link between two files and outputs to log. Returns the status (LINKED, PRESENT,
+        PERMISSION_DENIED or CROSS_DEVICE) and the reason when it was not linked.
         """
         try:
-            logging.debug("Linking %s and %s" % (source, target))
+            logging.debug("Linking %s and %s", source, target)
             os.link(os.path.realpath(source), target)
         except PermissionError as e:
             msg = "ERROR: Insufficient rights on {}! " \
                   "Possible cause; source file need to be writable/appendable when fs.protect_hardlinks is enabled. " \
                   "Permissions: {}"
             logging.error(msg.format(e.filename, str(AccessControlList.from_file(source))))
-            shared_item_list.remove(e.filename)
+            return PERMISSION_DENIED, str(e)
         except FileExistsError as e:
-            logging.debug("File %s already exists!" % e.filename)    
-            shared_item_list.remove(e.filename)
-        return shared_item_list
+            logging.debug("File %s already exists!", e.filename2)
+            return PRESENT, None
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            logging.error("Cannot link %s into %s: hard links cannot cross filesystems", source, self.directory)
+            return CROSS_DEVICE, str(e)
+        if events.sink is not None:
+            events.emit('link', target, source=source)
+        return LINKED, None
 
     def self_destruct(self, force_file_removal=False):
         """
         will have the share remove itself
         """
         self._unshare_linked_tree(directory=self.directory, force_file_removal=force_file_removal)
+        if os.path.exists(metadata_file(self.directory)):
+            os.remove(metadata_file(self.directory))
     
     def remove_items(self, items, force_file_removal=False):
         """
-        Remove items from share
+        Remove items (files or directories) from share, returns their ItemResults
         """
-        for item in items:
-            self._unshare_file(item, force=force_file_removal)
+        results = ItemResults()
+        try:
+            for item in items:
+                if not os.path.lexists(item):
+                    logging.warning("Cannot remove %s, it is not in the share", item)
+                    results.record(item, MISSING)
+                elif os.path.isdir(item) and not os.path.islink(item):
+                    self._unshare_linked_tree(item, force_file_removal=force_file_removal)
+                    results.record(item, REMOVED)
+                else:
+                    self._unshare_file(item, force=force_file_removal)
+                    results.record(item, REMOVED)
+        finally:
+            self.forget_items(results.with_status(REMOVED))
+        return results
+
+    def forget_items(self, items):
+        """
+        Removes items (given by source or share path; they are matched by name) from the metadata
+        """
+        if os.path.exists(metadata_file(self.directory)):
+            names = {os.path.basename(str(item)) for item in items}
+            metadata = self.metadata
+            metadata['items'] = {source: settings for source, settings in metadata['items'].items()
+                                 if os.path.basename(source) not in names}
+            dump_json(metadata_file(self.directory), metadata)
 
     @staticmethod
     def _unshare_dir(target):
         """
         Removes a directory from this share, fails when directory is not empty
         """
-        logging.debug("Un-sharing directory %s" % target)
+        logging.debug("Un-sharing directory %s", target)
         os.rmdir(target)
+        if events.sink is not None:
+            events.emit('rmdir', target)
 
     @staticmethod
     def _unshare_file(target, force=False):
         """
         Removes a file from this share
         """
-        logging.debug("Un-sharing file %s" % target)
-        if not force and os.stat(target).st_nlink == 1:
+        logging.debug("Un-sharing file %s", target)
+        if not force and not os.path.islink(target) and os.stat(target).st_nlink == 1:
             msg = "File %s has ONE hard link. Un-sharing this file will delete it! Apply \'--force\' to do so." % target
             logging.error(msg)
             raise FileNotFoundError(msg)
         os.unlink(target)
+        if events.sink is not None:
+            events.emit('unlink', target)
+
+
+def is_share_metadata(name):
+    """
+    Returns whether a name in a share directory (not in its subdirectories) is a file kept there by nfs4_share, i.e.
+    not a shared item
+    """
+    return name == HTACCESS_FILENAME or name in MANIFESTS.values()
+
+
+# Files kept next to a share directory (e.g. /shares/.foobar.json and /shares/.foobar.lock for /shares/foobar), as a
+# locked share does not allow creating files within: its metadata (see metadata_file) and its advisory lock file (see
+# flock_file)
+def metadata_file(directory):
+    """
+    Returns the metadata file of a share: a hidden file next to the share directory
+    """
+    directory = os.path.realpath(directory)
+    return os.path.join(os.path.dirname(directory), ".%s.json" % os.path.basename(directory))
+
+
+def flock_file(directory):
+    """
+    Returns the advisory lock file of a share: a hidden file next to the share directory, as a locked share does not
+    allow creating files within. It is left behind when the share is removed: removing it would let a new process lock
+    a new file while a waiting process still gets the lock on the removed one.
+    """
+    directory = os.path.realpath(directory)
+    return os.path.join(os.path.dirname(directory), ".%s.lock" % os.path.basename(directory))
+
+
+def open_flock_file(directory, exclusive=True):
+    """
+    Opens the advisory lock file of a share for share_flock(). For the exclusive lock it is created when missing. The
+    shared lock opens it read-only (flock does not need write access), so read-only commands also work for users that
+    cannot write to the directory that holds the shares; when the lock file does not exist and cannot be created,
+    None is returned and the shared lock is skipped.
+    """
+    filename = flock_file(directory)
+    if exclusive:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        return open(filename, 'a')
+    try:
+        return open(filename, 'r')
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logging.info("Reading %s without its advisory lock: %s", directory, e)
+        return None
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        open(filename, 'a').close()
+        return open(filename, 'r')
+    except OSError as e:  # E.g. no write access, or a read-only filesystem
+        logging.info("Reading %s without its advisory lock, it cannot be created: %s", directory, e)
+        return None
+
+
+@contextmanager
+def share_flock(directory, exclusive=True, timeout=None):
+    """
+    Context holding an advisory (flock) lock on a share, so that operations on the same share are serialized while
+    operations on different shares run in parallel. Mutations should take the exclusive lock, read-only operations the
+    shared lock (which is skipped when its lock file cannot be created, see open_flock_file). Raises ShareBusyError when
+    the lock is not obtained within timeout seconds (defaults to lock_timeout). Nested calls in the same thread join the
+    lock that is already held.
+    """
+    key = (threading.get_ident(), os.path.realpath(directory))
+    held = _held_flocks.get(key)
+    if held is not None and (held or not exclusive):
+        yield
+        return
+    if held is not None:
+        raise ShareBusyError("Cannot upgrade the shared lock on %s to an exclusive lock" % directory)
+    if timeout is None:
+        timeout = lock_timeout
+    lock_file = open_flock_file(directory, exclusive)
+    if lock_file is None:
+        _held_flocks[key] = exclusive
+        try:
+            yield
+        finally:
+            del _held_flocks[key]
+        return
+    with lock_file:
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        while True:
+            try:
+                fcntl.flock(lock_file, mode | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                logging.debug("Waiting for %s to be released by another process", directory)
+                if deadline is None:
+                    fcntl.flock(lock_file, mode)
+                    break
+                if time.monotonic() >= deadline:
+                    raise ShareBusyError("Share %s is in use by another process (waited %ss)" % (directory, timeout))
+                time.sleep(LOCK_POLL_INTERVAL)
+        metrics.observe('nfs4_share_lock_wait_seconds', time.monotonic() - start)
+        _held_flocks[key] = exclusive
+        try:
+            yield
+        finally:
+            del _held_flocks[key]
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
 class IllegalShareSetupError(RuntimeError):
@@ -210,6 +594,11 @@ class IllegalShareSetupError(RuntimeError):
         super().__init__(message)
 
 
+class ShareBusyError(RuntimeError):
+    def __init__(self, message):
+        super().__init__(message)
+
+
 LOCK_ACE = AccessControlEntity(entry_type="D",
                                flags="",
                                identity="EVERYONE",
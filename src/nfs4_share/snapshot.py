@@ -0,0 +1,188 @@
+import os
+import sys
+import gzip
+import json
+import logging
+
+from . import walk
+from . import apache
+from .cache import load_json, dump_json
+from .acl import AccessControlList, AccessControlEntity, read_entries_batch
+from .htaccess import HTACCESS_FILENAME, AccessFile
+from .share import LOCK_ACE, is_share_metadata, share_flock, metadata_file
+
+SNAPSHOT_VERSION = 1
+
+
+def open_snapshot(filename, mode):
+    """
+    Opens a snapshot file for text reading/writing; '-' is stdin/stdout and a .gz suffix compresses the snapshot
+    """
+    if filename == '-':
+        return sys.stdout if 'w' in mode else sys.stdin
+    if str(filename).endswith('.gz'):
+        return gzip.open(filename, mode + 't')
+    return open(filename, mode)
+
+
+def snapshot(share_directory, sources=(), workers=8):
+    """
+    Returns the records (dicts, written as JSON lines) of a snapshot of a share:
+    * share: the share path and whether it was locked (always first)
+    * acl: an ACL, referred to by id from the records that follow it (the share has only a few distinct ACLs)
+    * dir: a directory of the share (relative path) and its ACL
+    * file: a shared file, its inode (dev, ino), size and a source path that links the same inode (None if no
+      source was found below the source directories, e.g. because the share holds the last copy)
+    * htaccess: the content and ACL of the access file
+    * metadata: the metadata kept next to the share (see Share.metadata), e.g. where its items came from
+    The shared files keep the ACL of their source, so only the ACLs of the directories and access file are recorded.
+    """
+    share_directory = os.path.realpath(str(share_directory))
+    with share_flock(share_directory, exclusive=False):
+        return _snapshot(share_directory, sources, workers)
+
+
+def _snapshot(share_directory, sources, workers):
+    directories = []
+    files = {}  # (dev, ino) -> [relative paths]
+    sizes = {}
+    for _, directory, entries in walk.scan([share_directory], workers=workers):
+        directories.append(directory)
+        for entry in entries:
+            if not entry.is_file() or (directory == share_directory and is_share_metadata(entry.name)):
+                continue
+            dev_ino = (entry.stat.st_dev, entry.stat.st_ino)
+            files.setdefault(dev_ino, []).append(os.path.relpath(entry.path, share_directory))
+            sizes[dev_ino] = entry.stat.st_size
+
+    source_paths = {}
+    for _, _, entries in walk.scan([os.path.realpath(str(source)) for source in sources], workers=workers):
+        for entry in entries:
+            dev_ino = (entry.stat.st_dev, entry.stat.st_ino)
+            if entry.is_file() and dev_ino in files and dev_ino not in source_paths:
+                source_paths[dev_ino] = entry.path
+
+    directories.sort()
+    htaccess_path = os.path.join(share_directory, HTACCESS_FILENAME)
+    acl_targets = directories + ([htaccess_path] if os.path.exists(htaccess_path) else [])
+    acls = dict(read_entries_batch(acl_targets))
+    acl_ids = {}
+
+    records = []
+
+    def add_acl_record(path):
+        text = ",".join(repr(entry) for entry in acls[path])
+        if text not in acl_ids:
+            acl_ids[text] = len(acl_ids)
+            records.append({'type': 'acl', 'id': acl_ids[text], 'acl': text})
+        return acl_ids[text]
+
+    records.append({'type': 'share', 'version': SNAPSHOT_VERSION, 'share': share_directory,
+                    'locked': LOCK_ACE in acls[share_directory]})
+    for directory in directories:
+        acl_id = add_acl_record(directory)
+        records.append({'type': 'dir', 'path': os.path.relpath(directory, share_directory), 'acl': acl_id})
+    missing = 0
+    for dev_ino in sorted(files):
+        if dev_ino not in source_paths:
+            missing += len(files[dev_ino])
+        for path in sorted(files[dev_ino]):
+            records.append({'type': 'file', 'path': path, 'dev': dev_ino[0], 'ino': dev_ino[1], 'size': sizes[dev_ino],
+                            'source': source_paths.get(dev_ino)})
+    if os.path.exists(htaccess_path):
+        acl_id = add_acl_record(htaccess_path)
+        with open(htaccess_path, 'r') as htaccess_file:
+            records.append({'type': 'htaccess', 'content': htaccess_file.read(), 'acl': acl_id})
+    metadata = load_json(metadata_file(share_directory))
+    if metadata is not None:
+        records.append({'type': 'metadata', 'metadata': metadata})
+    if missing:
+        logging.warning("No source found for %d files of %s, they cannot be restored by linking" %
+                        (missing, share_directory))
+    return records
+
+
+def restore(records, share_directory=None):
+    """
+    Rebuilds a share and its metadata from snapshot records (at its original location unless share_directory is given)
+    by linking the recorded source paths, without walking the sources. A source is only linked if it still is the recorded inode.
+    The ACLs are applied last, with one nfs4_setfacl call per ACL and batch of paths, so a locked share is restored
+    locked. Returns the relative paths of the files that could not be restored.
+    """
+    records = iter(records)
+    header = next(records)
+    if header.get('type') != 'share' or header.get('version') != SNAPSHOT_VERSION:
+        raise ValueError("Not a share snapshot (version %s)" % SNAPSHOT_VERSION)
+    share_directory = os.path.realpath(str(share_directory or header['share']))
+    with share_flock(share_directory):
+        return _restore(records, share_directory)
+
+
+def _restore(records, share_directory):
+    os.makedirs(share_directory)  # Fails when the share exists
+    acls = {}
+    acl_targets = {}
+    not_restored = []
+    for record in records:
+        if record['type'] == 'acl':
+            # The special principal EVERYONE@ is the only one left untranslated in a snapshot
+            acls[record['id']] = AccessControlList(AccessControlEntity.from_string(entry, filename=share_directory)
+                                                   for entry in record['acl'].split(','))
+        elif record['type'] == 'dir':
+            path = os.path.normpath(os.path.join(share_directory, record['path']))
+            os.makedirs(path, exist_ok=True)
+            acl_targets.setdefault(record['acl'], []).append(path)
+        elif record['type'] == 'file':
+            target = os.path.join(share_directory, record['path'])
+            source = record['source']
+            try:
+                stat_result = os.lstat(source) if source else None
+            except FileNotFoundError:
+                stat_result = None
+            if stat_result is None or (stat_result.st_dev, stat_result.st_ino) != (record['dev'], record['ino']):
+                logging.error("Cannot restore %s: its source %s is gone or replaced" % (target, source))
+                not_restored.append(record['path'])
+                continue
+            os.link(source, target)
+        elif record['type'] == 'htaccess':
+            path = os.path.join(share_directory, HTACCESS_FILENAME)
+            with open(path, 'w') as htaccess_file:
+                htaccess_file.write(record['content'])
+            acl_targets.setdefault(record['acl'], []).append(path)
+            apache.update_share(share_directory, AccessFile.read(path).lines)
+        elif record['type'] == 'metadata':
+            dump_json(metadata_file(share_directory), record['metadata'])
+    for acl_id, targets in acl_targets.items():
+        acls[acl_id].set_many(targets)
+    logging.info("Restored %s (%d files could not be restored)" % (share_directory, len(not_restored)))
+    return not_restored
+
+
+def snapshot_command(share_directory, sources=None, output='-', workers=8):
+    """
+    Writes a snapshot of a share (entry point of `nfs4_share snapshot`)
+    """
+    snapshot_file = open_snapshot(output, 'w')
+    try:
+        for record in snapshot(share_directory, sources=sources or [], workers=workers):
+            snapshot_file.write(json.dumps(record, separators=(',', ':')) + "\n")
+    finally:
+        if snapshot_file is not sys.stdout:
+            snapshot_file.close()
+
+
+def restore_command(snapshot_file, share_directory=None):
+    """
+    Rebuilds a share from a snapshot (entry point of `nfs4_share restore`). Exits with 1 when files could not be
+    restored.
+    """
+    records = open_snapshot(snapshot_file, 'r')
+    try:
+        not_restored = restore((json.loads(line) for line in records if line.strip()), share_directory)
+    finally:
+        if records is not sys.stdin:
+            records.close()
+    for path in not_restored:
+        print(path)
+    if not_restored:
+        raise SystemExit(1)
@@ -0,0 +1,77 @@
+import os
+import json
+import logging
+
+from . import cache
+from . import walk
+from .report import human_readable_size, tabulate
+from .share import is_share_metadata
+
+
+def find_sole_copies(root, cache_file=None, workers=8, incremental=True, share=None):
+    """
+    Finds every regular file below the shares of root that has a single hard link, i.e. whose source has been removed
+    so the share holds the last copy (`Share._unshare_file` refuses to remove those without force).
+
+    Returns {share: {item: {'files': [(path, size), ...], 'bytes': int}}} where item is the top-level entry of the share
+    that contains the files. With incremental, the directory listings of the previous scan are reused for directories
+    that did not change; the files themselves are always stat-ed again because a removed source only changes the link
+    count of the file, not the directory it is in. With share (a share directory below root), only that share is
+    scanned, with a cache of its own.
+    """
+    root = os.path.realpath(str(root))
+    if cache_file is None:
+        cache_file = cache.default_cache_file('solecopies', root if share is None else share)
+    listings = cache.load_json(cache_file, default={}) if incremental else {}
+    share_directories = sorted(walk.share_directories(root)) if share is None else [os.path.realpath(str(share))]
+
+    sole_copies = {}
+    for share_directory, directory, entries in walk.scan(share_directories, workers=workers, listings=listings):
+        for entry in entries:
+            if not entry.is_file() or entry.stat.st_nlink != 1:
+                continue
+            if directory == share_directory and is_share_metadata(entry.name):
+                continue
+            share = os.path.basename(share_directory)
+            item = os.path.relpath(entry.path, share_directory).split(os.sep)[0]
+            item_sole_copies = sole_copies.setdefault(share, {}).setdefault(item, {'files': [], 'bytes': 0})
+            item_sole_copies['files'].append((entry.path, entry.stat.st_size))
+            item_sole_copies['bytes'] += entry.stat.st_size
+    cache.dump_json(cache_file, listings)
+    logging.info("Found sole copies in %d of %d shares below %s" % (len(sole_copies), len(share_directories), root))
+    for items in sole_copies.values():
+        for item_sole_copies in items.values():
+            item_sole_copies['files'].sort()
+    return sole_copies
+
+
+def format_report(sole_copies, list_files=False):
+    """
+    Formats the sole copies (as returned by find_sole_copies) as a plain-text table
+    """
+    rows = [['SHARE', 'ITEM', 'FILES', 'BYTES']]
+    for share in sorted(sole_copies):
+        for item in sorted(sole_copies[share]):
+            item_sole_copies = sole_copies[share][item]
+            rows.append([share, item, str(len(item_sole_copies['files'])), human_readable_size(item_sole_copies['bytes'])])
+    total_files = sum(len(item['files']) for items in sole_copies.values() for item in items.values())
+    total_bytes = sum(item['bytes'] for items in sole_copies.values() for item in items.values())
+    rows.append(['TOTAL', '', str(total_files), human_readable_size(total_bytes)])
+    text = tabulate(rows)
+    if list_files:
+        files = [path for items in sole_copies.values() for item in items.values() for path, _ in item['files']]
+        text += "\n\n" + "\n".join(sorted(files))
+    return text
+
+
+def sole_copies_command(root, output_json=False, list_files=False, cache_file=None, workers=8, full=False):
+    """
+    Prints the files below the shares of root that are the last copy of their data (entry point of
+    `nfs4_share sole-copies`)
+    """
+    sole_copies = find_sole_copies(root, cache_file=cache_file, workers=workers, incremental=not full)
+    if output_json:
+        print(json.dumps(sole_copies, indent=2))
+    else:
+        print(format_report(sole_copies, list_files=list_files))
+    return sole_copies
@@ -0,0 +1,301 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import cache
+from . import events
+from . import walk
+from . import track_changes
+from .filters import PathFilter
+from .report import tabulate
+from .share import Share, ShareBusyError, LOCK_ACE
+
+
+def scan_item(source_root, target_root, path_filter=None, symlinks='follow', previous=None, relative_root='',
+              recursive=True):
+    """
+    Compares an item that was added to a share (source_root, a file or directory) with its linked copy in the share
+    (target_root) and returns the operations that bring the copy up to date, as (action, source, target, directory)
+    tuples in the order they are to be applied:
+    * link: hard-link the source file at target
+    * mirror: create a symlink at target that points where the source symlink points to
+    * mkdir: create the (empty) directory target
+    * unshare: remove target (a file, symlink or linked tree), e.g. because its source vanished
+    * prune: remove the directory target and its parents while they are empty (only for filtered items, whose
+      directories only exist to hold the files that pass the filter)
+    directory is the source directory whose listing led to the operation (source_root for the item itself).
+
+    previous holds {source directory: [mtime_ns, ctime_ns, [subdirectories]]} as seen by the last sync. A directory
+    whose mtime and ctime are unchanged still has the same entries, so it is neither listed nor compared with the
+    share; only its subdirectories are stat-ed to find changes deeper down (directory mtimes do not propagate to their
+    parents). Returns the operations, the directories for the next sync and the number of directories that were listed.
+
+    A subtree of an item can be scanned on its own (see workqueue.py): relative_root is then its path within the item
+    (ending with '/'), which the filter patterns are matched against, and without recursive only the entries of
+    source_root itself are compared.
+    """
+    previous = previous or {}
+    path_filter = path_filter or PathFilter()
+    operations = []
+    directories = {}
+    if not os.path.exists(source_root):
+        if os.path.lexists(target_root):
+            operations.append(('unshare', None, target_root, source_root))
+        return operations, directories, 0
+    if not os.path.isdir(source_root):
+        if not _same_file(source_root, target_root):
+            if os.path.lexists(target_root):
+                operations.append(('unshare', None, target_root, source_root))
+            operations.append(('link', source_root, target_root, source_root))
+        return operations, directories, 0
+
+    listed = 0
+    # A target that is not a directory (e.g. the source file was replaced by a directory) is unshared and not listed
+    replaced = os.path.lexists(target_root) and (os.path.islink(target_root) or not os.path.isdir(target_root))
+    if replaced:
+        operations.append(('unshare', None, target_root, source_root))
+
+    def skipped(_, context):
+        target, replaced, directory = context
+        if not replaced and os.path.lexists(target):  # Shared under this path before, e.g. when it was found through a symlink first
+            operations.append(('unshare', None, target, directory))
+            if path_filter:
+                operations.append(('prune', None, os.path.dirname(target), directory))
+
+    for source, relative, source_stat, (target, replaced, _), traversed in walk.item_directories(
+            source_root, relative_root, context=(target_root, replaced, source_root), skipped=skipped):
+        cached = previous.get(source)
+        if not replaced and cached is not None and cached[:2] == [source_stat.st_mtime_ns, source_stat.st_ctime_ns]:
+            directories[source] = cached
+            traversed.extend((name, (os.path.join(target, name), False, source)) for name in cached[2])
+            continue
+
+        listed += 1
+        wanted = {}
+        subdirectories = []
+        with os.scandir(source) as iterator:
+            entries = sorted(iterator, key=lambda entry: entry.name)
+        for entry in entries:
+            is_directory = entry.is_dir()  # Follows symlinks
+            if is_directory and not path_filter.includes_directory(relative + entry.name):
+                continue
+            if not is_directory and not path_filter.includes_file(relative + entry.name):
+                continue
+            if entry.is_symlink() and symlinks != 'follow':
+                if symlinks == 'mirror':
+                    wanted[entry.name] = ('mirror', os.readlink(entry.path))
+                continue
+            if is_directory:
+                wanted[entry.name] = ('directory', None)
+                subdirectories.append(entry.name)
+            elif entry.is_file():
+                wanted[entry.name] = ('link', entry.stat())
+        directories[source] = [source_stat.st_mtime_ns, source_stat.st_ctime_ns, subdirectories]
+
+        existing = None if replaced else _listing(target)
+        if existing is None:
+            existing = {}
+            if not path_filter:  # With a filter, directories are only created once a file is linked within them
+                operations.append(('mkdir', None, target, source))
+        for name in sorted(wanted):
+            action, value = wanted[name]
+            source_path = os.path.join(source, name)
+            target_path = os.path.join(target, name)
+            current = existing.pop(name, None)
+            if action == 'directory':
+                not_a_directory = current is not None and not current.is_dir(follow_symlinks=False)
+                if not_a_directory:
+                    operations.append(('unshare', None, target_path, source))
+                if recursive:
+                    traversed.append((name, (target_path, not_a_directory, source)))
+                continue
+            if action == 'link' and current is not None and current.is_file(follow_symlinks=False) \
+                    and (current.stat(follow_symlinks=False).st_dev, current.inode()) == (value.st_dev, value.st_ino):
+                continue
+            if action == 'mirror' and current is not None and current.is_symlink() and os.readlink(current.path) == value:
+                continue
+            if current is not None:
+                operations.append(('unshare', None, target_path, source))
+            operations.append((action, source_path, target_path, source))
+        unshared = bool(existing) or any(operation[0] == 'unshare' and operation[3] == source for operation in operations)
+        for name in sorted(existing):
+            operations.append(('unshare', None, existing[name].path, source))
+        if path_filter and unshared:
+            operations.append(('prune', None, target, source))
+    return operations, directories, listed
+
+
+def _listing(target):
+    """
+    Returns {name: DirEntry} of a target directory, or None when it does not exist
+    """
+    try:
+        with os.scandir(target) as iterator:
+            return {entry.name: entry for entry in iterator}
+    except FileNotFoundError:
+        return None
+
+
+def _same_file(source, target):
+    try:
+        return os.path.samestat(os.stat(source), os.lstat(target))
+    except FileNotFoundError:
+        return False
+
+
+def apply_operations(share, operations, force=False, new_directories=None):
+    """
+    Applies the operations of scan_item to a share (which should be unlocked); directories are created with the ACL of
+    the share, or without it when new_directories is a list: they are then appended to it for the caller to set the ACL
+    on (e.g. in batches, see aio.py). Returns the source directories of the operations that failed, so they are listed
+    again by the next sync.
+    """
+    failed = set()
+    created = {share.directory}
+
+    def makedirs(directory):
+        made = share._makedirs(directory, created, permissions=new_directories is None)
+        if new_directories is not None:
+            new_directories.extend(made)
+
+    for action, source, target, directory in operations:
+        try:
+            if action == 'mkdir':
+                makedirs(target)
+            elif action == 'unshare':
+                if os.path.isdir(target) and not os.path.islink(target):
+                    share._unshare_linked_tree(target, force_file_removal=force)
+                else:
+                    share._unshare_file(target, force=force)
+            elif action == 'prune':
+                while target != share.directory and os.path.isdir(target) and not os.listdir(target):
+                    share._unshare_dir(target)
+                    target = os.path.dirname(target)
+            else:
+                makedirs(os.path.dirname(target))
+                if action == 'link':
+                    os.link(os.path.realpath(source), target)
+                    if events.sink is not None:
+                        events.emit('link', target, source=source)
+                else:
+                    share._mirror_symlink(source, target)
+        except OSError as e:
+            logging.error("Could not %s %s: %s" % (action, target, e))
+            failed.add(directory)
+    return failed
+
+
+def sync_share(share_directory, force=False, dry_run=False, full=False, track_change_dir=None, wait=None):
+    """
+    Brings the items of a share up to date with their sources, as recorded in the metadata of the share (see
+    Share.record_items): new files are linked, files and directories whose source vanished are removed and items whose
+    source vanished are removed from the share. Unlike re-adding the items, nothing is unshared and linked again.
+    The directory listings of the sources are remembered (in ~/.cache/nfs4_share) so the next sync only lists the
+    directories that changed; full ignores them. A locked share is unlocked for the changes and locked again.
+    Single-link files (the share holds the last copy) are only removed with force.
+    """
+    share = Share(share_directory, exist_ok=True)
+    report = {'share': share.directory, 'items': 0, 'listed': 0, 'directories': 0, 'linked': 0, 'removed': 0,
+              'vanished': [], 'failed': 0, 'applied': False}
+    with share.flock(timeout=wait), track_changes.transaction(track_change_dir):
+        items = share.metadata['items']
+        if not items:
+            logging.debug("Not syncing %s, it has no recorded items" % share.directory)
+            return report
+        state_file = cache.default_cache_file('sync', share.directory)
+        state = {} if full else cache.load_json(state_file, default={})
+        new_state = {}
+        plans = []
+        for source, settings in sorted(items.items()):
+            previous = state.get(source, {})
+            operations, directories, listed = scan_item(
+                source, os.path.join(share.directory, os.path.basename(source)),
+                PathFilter(settings.get('include'), settings.get('exclude')), settings.get('symlinks', 'follow'),
+                previous.get('directories') if previous.get('settings') == settings else None)
+            plans.append((source, operations))
+            new_state[source] = {'settings': settings, 'directories': directories}
+            report['items'] += 1
+            report['listed'] += listed
+            report['directories'] += len(directories)
+            report['linked'] += len([operation for operation in operations if operation[0] in ('link', 'mirror')])
+            report['removed'] += len([operation for operation in operations if operation[0] == 'unshare'])
+            if not os.path.exists(source):
+                report['vanished'].append(source)
+        operations = [operation for _, plan in plans for operation in plan]
+        logging.info("Syncing %s: listed %d of %d source directories, %d operations" %
+                     (share.directory, report['listed'], report['directories'], len(operations)))
+        if dry_run:
+            for action, source, target, _ in operations:
+                logging.info("Would %s %s" % (action, target if source is None else "%s -> %s" % (source, target)))
+            return report
+        if operations:
+            locked = LOCK_ACE in share.permissions
+            share.unlock()
+            try:
+                failed = apply_operations(share, operations, force=force)
+            finally:
+                if locked:
+                    share.lock()
+            report['failed'] = len([operation for operation in operations if operation[3] in failed])
+            report['applied'] = True
+            for source, plan in plans:
+                if any(operation[3] in failed for operation in plan) and source in report['vanished']:
+                    report['vanished'].remove(source)  # Kept until its last copies are removed (with force)
+                for directory in failed:
+                    new_state[source]['directories'].pop(directory, None)
+        if report['vanished']:
+            share.forget_items(report['vanished'])
+            for source in report['vanished']:
+                del new_state[source]
+            if track_change_dir is not None:
+                track_changes.track_file_deletion(track_change_dir, share.directory, report['vanished'])
+        cache.dump_json(state_file, new_state)
+    return report
+
+
+def format_report(reports):
+    """
+    Formats sync reports as a plain-text table
+    """
+    rows = [['SHARE', 'ITEMS', 'LISTED', 'DIRECTORIES', 'LINKED', 'REMOVED', 'VANISHED', 'FAILED']]
+    for report in reports:
+        rows.append([os.path.basename(report['share']),
+                     str(report['items']),
+                     str(report['listed']),
+                     str(report['directories']),
+                     str(report['linked']),
+                     str(report['removed']),
+                     str(len(report['vanished'])),
+                     str(report['failed'])])
+    return tabulate(rows)
+
+
+def sync_command(root, shares=None, force=False, dry_run=False, full=False, track_change_dir=None, wait=0,
+                 workers=4, output_json=False):
+    """
+    Syncs the shares below root (or only the given ones) with their sources, several shares in parallel (entry point of
+    `nfs4_share sync`). Shares that are in use are skipped. Exits with 1 when operations failed.
+    """
+    if shares:
+        share_directories = [os.path.join(str(root), os.path.basename(str(share))) for share in shares]
+    else:
+        share_directories = sorted(walk.share_directories(root))
+
+    def sync(share_directory):
+        try:
+            return sync_share(share_directory, force=force, dry_run=dry_run, full=full,
+                              track_change_dir=track_change_dir, wait=wait)
+        except ShareBusyError as e:
+            logging.warning("Skipping %s: %s" % (share_directory, e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reports = [report for report in executor.map(sync, share_directories) if report is not None]
+    if output_json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(format_report(reports))
+    if any(report['failed'] for report in reports):
+        raise SystemExit(1)
+    return reports
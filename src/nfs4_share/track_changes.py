@@ -1,14 +1,167 @@
-from git import Repo
-from git.exc import InvalidGitRepositoryError
 import re
+import json
+import time
+import fcntl
+import tempfile
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 import logging
 import os
 
+from . import metrics
+from .share import is_share_metadata
+
+# Open transactions per thread and (resolved) tracking directory, see transaction()
+_transactions = {}
+
+# Name of the advisory lock file and group-commit queue directory within the .git directory of a tracking repository
+LOCK_FILENAME = 'nfs4_share.lock'
+QUEUE_DIRNAME = 'nfs4_share-queue'
+# Interval (seconds) at which a writer waiting for a group commit checks whether its changes were committed
+GROUP_COMMIT_POLL_INTERVAL = 0.05
+
+
+class Transaction:
+    """
+    Collects the list-file changes of one or more share operations on a tracking repository so that they end up in a
+    single commit. The changes are recorded as intents (e.g. "these items were added to share X") and only applied to
+    the list files when the transaction is committed, while holding an exclusive advisory lock on the repository. That
+    way concurrent writers are serialized and each applies its changes to the latest list files, so no update is lost.
+
+    With a group_commit_window (seconds) the changes are queued in the repository instead; the writer that gets the
+    lock waits for the window, then applies and commits the queued changes of all writers in a single commit.
+    """
+
+    def __init__(self, track_change_dir, group_commit_window=0):
+        self.track_change_dir = Path(track_change_dir)
+        self.group_commit_window = group_commit_window
+        self.changes = []
+
+    def record(self, kind, share_directory, **kwargs):
+        change = dict(kwargs, kind=kind, share=Path(share_directory).name)
+        self.changes.append(change)
+
+    def commit(self):
+        """
+        Applies all recorded changes and commits them with the combined message (one line per change)
+        """
+        if not self.changes:
+            return
+        with metrics.phase('commit'):
+            repo = initialize_track_changes_dir(self.track_change_dir)
+            if self.group_commit_window:
+                self._group_commit(repo)
+            else:
+                with locked(repo):
+                    apply_and_commit(repo, self.changes)
+        self.changes = []
+
+    def _group_commit(self, repo):
+        queue_dir = Path(repo.git_dir, QUEUE_DIRNAME)
+        os.makedirs(queue_dir, exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(dir=queue_dir, prefix='.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.changes, f)
+        queued = Path(queue_dir, f'{time.time():.6f}-{os.getpid()}-{os.path.basename(tmp_filename)}.json')
+        os.replace(tmp_filename, queued)
+        while queued.exists():
+            with locked(repo, blocking=False) as leader:
+                if not leader or not queued.exists():
+                    time.sleep(GROUP_COMMIT_POLL_INTERVAL)
+                    continue
+                time.sleep(self.group_commit_window)  # Give concurrent writers the chance to queue their changes
+                batch = sorted(queue_dir.glob('*.json'))
+                changes = []
+                for filename in batch:
+                    with open(filename, 'r') as f:
+                        changes.extend(json.load(f))
+                apply_and_commit(repo, changes)
+                for filename in batch:
+                    os.remove(filename)
+                logging.debug(f'Group-committed the changes of {len(batch)} writer(s) in {self.track_change_dir}')
+
+
+@contextmanager
+def locked(repo, blocking=True):
+    """
+    Context holding an exclusive advisory (flock) lock on a tracking repository. Yields False when blocking is False
+    and the lock is held by another process.
+    """
+    with open(Path(repo.git_dir, LOCK_FILENAME), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def transaction(track_change_dir, group_commit_window=0):
+    """
+    Context in which all tracked changes to track_change_dir are committed at once when the (outermost) context
+    exits, e.g. to combine a batch of operations:
+
+        with transaction(track_change_dir):
+            manage.add(share1, items=..., track_change_dir=track_change_dir)
+            manage.add(share2, items=..., track_change_dir=track_change_dir)
+
+    Changes recorded before an exception are committed as well, as they reflect changes already made to the shares.
+    A track_change_dir of None makes this a no-op.
+    """
+    if track_change_dir is None:
+        yield None
+        return
+    key = (threading.get_ident(), os.path.realpath(str(track_change_dir)))
+    if key in _transactions:  # Nested; the outermost context commits
+        yield _transactions[key]
+        return
+    active = _transactions[key] = Transaction(track_change_dir, group_commit_window=group_commit_window)
+    try:
+        yield active
+    finally:
+        del _transactions[key]
+        active.commit()
+
+
+def apply_and_commit(repo, changes):
+    """
+    Applies changes to the list files of a tracking repository and commits them. The caller should hold the lock.
+    """
+    touched, messages = [], []
+    for change in changes:
+        to_stage, to_remove, commit_msg = APPLY[change['kind']](Path(repo.working_tree_dir), change)
+        if commit_msg is None:
+            continue
+        logging.info(commit_msg)
+        messages.append(commit_msg)
+        touched.extend(filename for filename in to_stage + to_remove if filename not in touched)
+    if not messages:
+        return
+    index = repo.index
+    # Each file is staged or removed by its final state, e.g. the file list of a share that was deleted and created
+    # again within the same commit is staged; files that were created and removed never made it into the index
+    existing = [filename for filename in touched if os.path.exists(Path(repo.working_tree_dir, filename))]
+    removed = [filename for filename in touched if filename not in existing and (filename, 0) in index.entries]
+    if removed:
+        index.remove(removed)
+    if existing:
+        index.add(existing)
+    index.commit("\n".join(messages))
+    logging.debug(f'Committed {len(messages)} change(s) in {repo.working_tree_dir}')
+
+
 def initialize_track_changes_dir(track_change_dir:Path):
     """
     Run git init in a directory for tracking changes if it's not done already
     """
+    # GitPython is imported on first use to keep it out of the CLI start-up time
+    from git import Repo
+    from git.exc import InvalidGitRepositoryError
     if not track_change_dir.exists():
         logging.info(f'Creating track changes dir: {track_change_dir}')
         os.mkdir(track_change_dir)
@@ -20,6 +173,36 @@ def initialize_track_changes_dir(track_change_dir:Path):
         repo=Repo.init(track_change_dir)
     return repo
 
+
+def read_list(list_txt):
+    """
+    Returns the lines of a list file (empty if it does not exist)
+    """
+    try:
+        with open(list_txt, 'r') as tc_file:
+            return [line.strip() for line in tc_file.readlines()]
+    except FileNotFoundError:
+        return []
+
+
+def write_list(list_txt, lines):
+    with open(list_txt, 'w') as tc_file:
+        for line in lines:
+            tc_file.write(line+'\n')
+
+
+def read_htaccess_users(share_directory):
+    """
+    Returns the sorted ldap entries of the htaccess file of a share
+    """
+    with open(Path(share_directory, '.htaccess.files.bioinf'), 'r') as htaccess_file:
+        lines = htaccess_file.readlines()
+        htaccess = [re.sub('Require.*(?=ldap)', '', line) for line in lines if 'ldap' in line]
+        htaccess = [line.strip() for line in htaccess]
+        htaccess.sort()
+    return htaccess
+
+
 def initialize_file_list(track_change_dir, share_directory):
     """
     Create a txt file to track item changes in a share
@@ -27,13 +210,18 @@ def initialize_file_list(track_change_dir, share_directory):
     filelist_txt=Path(track_change_dir, f"{Path(share_directory).name}_files.txt")
     if not filelist_txt.exists():
         filelist=os.listdir(share_directory)
-        filelist=[item for item in filelist if item != ".htaccess.files.bioinf"]
-        with open(filelist_txt, 'w') as tc_file:
-            for item in filelist:
-                tc_file.write(item+'\n')
-        commit_msg=f'[{Path(share_directory).name}]File change tracking initialized'
-        logging.info(commit_msg)
-        stage_and_commit(track_change_dir, filelist_txt, commit_msg)
+        filelist = [item for item in filelist if not is_share_metadata(item)]
+        with transaction(track_change_dir) as active:
+            active.record('initialize_file_list', share_directory, items=filelist)
+
+
+def _apply_initialize_file_list(track_change_dir, change):
+    filelist_txt = f"{change['share']}_files.txt"
+    if Path(track_change_dir, filelist_txt).exists():  # Initialized concurrently
+        return [], [], None
+    write_list(Path(track_change_dir, filelist_txt), change['items'])
+    return [filelist_txt], [], f"[{change['share']}]File change tracking initialized"
+
 
 def initialize_user_list(track_change_dir, share_directory):
     """
@@ -42,52 +230,42 @@ def initialize_user_list(track_change_dir, share_directory):
     userlist_txt=Path(track_change_dir, f"{Path(share_directory).name}_users.txt")
     if not userlist_txt.exists():
         try:
-            with open(Path(share_directory,'.htaccess.files.bioinf'), 'r') as htaccess_file:
-                lines=htaccess_file.readlines()
-                htaccess_list=[re.sub('Require.*(?=ldap)','',l) for l in lines if 'ldap' in l]
-                htaccess_list=[l.strip() for l in htaccess_list]
-                htaccess_list.sort()
+            htaccess_list = read_htaccess_users(share_directory)
         except FileNotFoundError:
             htaccess_list=[]
-        with open(userlist_txt, 'w') as tc_file:
-            for htaccess in htaccess_list:
-                tc_file.write(htaccess+'\n')
-        commit_msg=f'[{Path(share_directory).name}]User change tracking initialized'
-        logging.info(commit_msg)
-        stage_and_commit(track_change_dir, userlist_txt, commit_msg)
+        with transaction(track_change_dir) as active:
+            active.record('initialize_user_list', share_directory, users=htaccess_list)
+
+
+def _apply_initialize_user_list(track_change_dir, change):
+    userlist_txt = f"{change['share']}_users.txt"
+    if Path(track_change_dir, userlist_txt).exists():  # Initialized concurrently
+        return [], [], None
+    write_list(Path(track_change_dir, userlist_txt), change['users'])
+    return [userlist_txt], [], f"[{change['share']}]User change tracking initialized"
 
 
 def track_user_addition(track_change_dir, share_directory):
     """
     read and update user list from htaccess file of a share
     """
-    # Read htaccess file and sort entries
-    with open(Path(share_directory,'.htaccess.files.bioinf'), 'r') as htaccess_file:
-        lines=htaccess_file.readlines()
-        htaccess=[re.sub('Require.*(?=ldap)','',l) for l in lines if 'ldap' in l]
-        htaccess=[l.strip() for l in htaccess]
-        htaccess.sort()
+    with transaction(track_change_dir) as active:
+        active.record('track_user_addition', share_directory, users=read_htaccess_users(share_directory))
+
 
+def _apply_track_user_addition(track_change_dir, change):
     # Check the list of existing users in the track changes dir
-    userlist_txt=Path(track_change_dir, f"{Path(share_directory).name}_users.txt")
-    if userlist_txt.exists():
-        with open(userlist_txt, 'r') as tc_file:
-            previous_htaccess=tc_file.readlines()
-            previous_htaccess=[l.strip() for l in previous_htaccess]
-    else:
-        previous_htaccess=[]
-    
+    userlist_txt = f"{change['share']}_users.txt"
+    previous_htaccess = read_list(Path(track_change_dir, userlist_txt))
+
     # Update userlist if new user(s) are added
-    new_users=set(htaccess)-set(previous_htaccess)
-    if len(new_users) > 0:
-        with open(userlist_txt, 'a') as tc_file:
-            for item in new_users:
-                tc_file.write(item+'\n')
-        commit_msg=f'[{Path(share_directory).name}][USER][ADDED]{",".join(sorted(new_users))}'
-        stage_and_commit(track_change_dir, userlist_txt, commit_msg)
-        logging.info(commit_msg)
-    else:
-        logging.info(f'No user access changes in {Path(share_directory).name}')
+    new_users = set(change['users'])-set(previous_htaccess)
+    if len(new_users) == 0:
+        logging.info(f"No user access changes in {change['share']}")
+        return [], [], None
+    write_list(Path(track_change_dir, userlist_txt), previous_htaccess + sorted(new_users))
+    return [userlist_txt], [], f'[{change["share"]}][USER][ADDED]{",".join(sorted(new_users))}'
+
 
 def track_file_addition(track_change_dir, share_directory, new_items):
     """
@@ -95,79 +273,96 @@ def track_file_addition(track_change_dir, share_directory, new_items):
     """
     # update file list if there are new item(s) added
     if len(new_items)>0:
-        filelist_txt=Path(track_change_dir, f"{Path(share_directory).name}_files.txt")
-        with open(filelist_txt, 'a') as tc_file:
-            for item in new_items:
-                basename_item=Path(item).name
-                tc_file.write(basename_item+'\n')
-
-        # Note changes in commit message
-        commit_msg=f'[{Path(share_directory).name}][ITEM][ADDED]{str(len(new_items))} item(s)'
-        stage_and_commit(track_change_dir,filelist_txt,commit_msg)
-        logging.info(commit_msg)
+        with transaction(track_change_dir) as active:
+            active.record('track_file_addition', share_directory, items=[Path(item).name for item in new_items])
     else:
         logging.info(f'No new files added to {Path(share_directory).name}')
 
+
+def _apply_track_file_addition(track_change_dir, change):
+    filelist_txt = f"{change['share']}_files.txt"
+    previous_filelist = read_list(Path(track_change_dir, filelist_txt))
+    known = set(previous_filelist)
+    write_list(Path(track_change_dir, filelist_txt),
+               previous_filelist + [item for item in change['items'] if item not in known])
+    # Note changes in commit message
+    return [filelist_txt], [], f"[{change['share']}][ITEM][ADDED]{len(change['items'])} item(s)"
+
+
 def track_share_deletion(track_change_dir, share_directory):
-    repo = Repo(track_change_dir)
-    tc_files=[f"{Path(share_directory).name}_files.txt",
-              f"{Path(share_directory).name}_users.txt"]
-    repo.index.remove(tc_files)
+    with transaction(track_change_dir) as active:
+        active.record('track_share_deletion', share_directory)
+
+
+def _apply_track_share_deletion(track_change_dir, change):
+    tc_files = [f"{change['share']}_files.txt",
+                f"{change['share']}_users.txt"]
     for f in tc_files:
-        if os.path.exists(Path(track_change_dir,f)):
-            os.remove(Path(track_change_dir,f))
-    commit_msg=f'[{Path(share_directory).name}][SHARE][REMOVED]'
-    repo.index.commit(commit_msg)
-    logging.info(commit_msg)
+        if os.path.exists(Path(track_change_dir, f)):
+            os.remove(Path(track_change_dir, f))
+    return [], tc_files, f"[{change['share']}][SHARE][REMOVED]"
+
 
 def track_file_deletion(track_change_dir, share_directory, deleted_items):
-    filelist_txt=Path(track_change_dir, f"{Path(share_directory).name}_files.txt")
-    # read existing file list
-    with open(filelist_txt, 'r') as tc_file:
-        previous_filelist=tc_file.readlines()
-        previous_filelist=[l.strip() for l in previous_filelist]
-    
-    # remove deleted items from file list
-    deleted_items=[Path(item).name for item in deleted_items]
-    updated_filelist=[file for file in previous_filelist if file not in deleted_items]
-
-    # rewrite filelist_txt
-    with open(filelist_txt, 'w') as tc_file:
-        for item in updated_filelist:
-            basename_item=Path(item).name
-            tc_file.write(basename_item+'\n')
+    if not deleted_items:
+        logging.info(f'No files removed from {Path(share_directory).name}')
+        return
+    with transaction(track_change_dir) as active:
+        active.record('track_file_deletion', share_directory, items=[Path(item).name for item in deleted_items])
+
 
+def _apply_track_file_deletion(track_change_dir, change):
+    filelist_txt = f"{change['share']}_files.txt"
+    # remove deleted items from the latest file list
+    deleted_items = set(change['items'])
+    updated_filelist = [file for file in read_list(Path(track_change_dir, filelist_txt)) if file not in deleted_items]
+    write_list(Path(track_change_dir, filelist_txt), updated_filelist)
     # keep track of changes with git
-    commit_msg=f'[{Path(share_directory).name}][ITEM][REMOVED]{str(len(deleted_items))} item(s)'
-    logging.info(commit_msg)
-    stage_and_commit(track_change_dir, filelist_txt, commit_msg)
+    return [filelist_txt], [], f"[{change['share']}][ITEM][REMOVED]{len(change['items'])} item(s)"
 
-def track_user_removal(track_change_dir, share_directory, deleted_users):
-    userlist_txt=Path(track_change_dir, f"{Path(share_directory).name}_users.txt")
-    with open(userlist_txt, 'r') as tc_file:
-        previous_htaccess=tc_file.readlines()
-        previous_htaccess=[l.strip() for l in previous_htaccess]
-    
-    # get a list of current user from git-tracked userlist
-    current_htaccess=[l for l in previous_htaccess if not re.search(rf'\b({"|".join(deleted_users)})\b', l)]
 
-    # remove deleted users from git-tracked userlist
+def track_user_removal(track_change_dir, share_directory, deleted_users):
     if deleted_users:
-        removed_htaccess=set(previous_htaccess)-set(current_htaccess)
-        with open(userlist_txt, 'w') as tc_file:
-            for item in current_htaccess:
-                tc_file.write(item+'\n')
-        commit_msg=f'[{Path(share_directory).name}][USER][REMOVED]{",".join(sorted(removed_htaccess))}'
-        stage_and_commit(track_change_dir, userlist_txt, commit_msg)
-        logging.info(commit_msg)
+        with transaction(track_change_dir) as active:
+            active.record('track_user_removal', share_directory, users=list(deleted_users))
     else:
         logging.info(f'No user access changes in {Path(share_directory).name}')
 
+
+def _apply_track_user_removal(track_change_dir, change):
+    userlist_txt = f"{change['share']}_users.txt"
+    previous_htaccess = read_list(Path(track_change_dir, userlist_txt))
+    # get a list of current user from git-tracked userlist
+    deleted_users = re.compile(rf'\b({"|".join(re.escape(user) for user in change["users"])})\b')
+    current_htaccess = [line for line in previous_htaccess if not deleted_users.search(line)]
+    # remove deleted users from git-tracked userlist
+    removed_htaccess = set(previous_htaccess)-set(current_htaccess)
+    write_list(Path(track_change_dir, userlist_txt), current_htaccess)
+    return [userlist_txt], [], f'[{change["share"]}][USER][REMOVED]{",".join(sorted(removed_htaccess))}'
+
+
 def stage_and_commit(track_change_dir, filename, commit_msg):
     """
-    Function to stage and commit changes to list files
+    Function to stage and commit changes to list files. Within a transaction the commit is deferred until the
+    transaction ends.
     """
-    repo = initialize_track_changes_dir(track_change_dir)
-    repo.index.add(filename)
-    repo.index.commit(commit_msg)
-    
\ No newline at end of file
+    with transaction(track_change_dir) as active:
+        active.record('stage_and_commit', track_change_dir, filename=Path(filename).name, commit_msg=commit_msg)
+
+
+def _apply_stage_and_commit(track_change_dir, change):
+    return [change['filename']], [], change['commit_msg']
+
+
+# Functions that apply a recorded change to the list files, returning the files to stage, the files to remove and the
+# commit message (None if the change turned out to be a no-op)
+APPLY = {
+    'initialize_file_list': _apply_initialize_file_list,
+    'initialize_user_list': _apply_initialize_user_list,
+    'track_user_addition': _apply_track_user_addition,
+    'track_file_addition': _apply_track_file_addition,
+    'track_share_deletion': _apply_track_share_deletion,
+    'track_file_deletion': _apply_track_file_deletion,
+    'track_user_removal': _apply_track_user_removal,
+    'stage_and_commit': _apply_stage_and_commit,
+}
@@ -0,0 +1,208 @@
+import os
+import sys
+import stat
+import json
+import time
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from . import solecopy
+from .cache import load_json, dump_json
+from .report import tabulate
+from .share import Share, ShareBusyError, share_flock, metadata_file
+
+# Name of the trash directory next to the shares: on the same filesystem, so moving a share into it is a rename
+TRASH_NAME = '.trash'
+# Number of subtrees of a trashed share that are unlinked in parallel
+workers = 8
+
+
+def trash_directory(share_directory):
+    """
+    Returns the trash directory of the shares root that share_directory is in
+    """
+    return os.path.join(os.path.dirname(os.path.realpath(str(share_directory))), TRASH_NAME)
+
+
+def check_sole_copies(share_directory):
+    """
+    Raises FileNotFoundError when a share holds the last copy of files (see solecopy.py), so trashing it without force
+    is refused like deleting it right away is, instead of only being noticed by the reaper
+    """
+    share_directory = os.path.realpath(str(share_directory))
+    sole_copies = solecopy.find_sole_copies(os.path.dirname(share_directory), share=share_directory)
+    files = [path for item in sole_copies.get(os.path.basename(share_directory), {}).values() for path, _ in item['files']]
+    if files:
+        msg = "Share %s holds the last copy of %d files (e.g. %s). Deleting it will delete them! Apply \'--force\' to " \
+              "do so." % (share_directory, len(files), files[0])
+        logging.error(msg)
+        raise FileNotFoundError(msg)
+
+
+def move_to_trash(share, force=False):
+    """
+    Moves a share into the trash with an atomic rename, so it disappears at once; reap() removes it later. The trash is
+    only accessible for its owner, which revokes the access to the trashed share. force is remembered for the reaper.
+    Raises OSError when the trash cannot be on the same filesystem. Returns the trashed directory.
+    """
+    trash = trash_directory(share.directory)
+    try:
+        os.mkdir(trash, 0o700)
+    except FileExistsError:
+        pass
+    trashed = os.path.join(trash, "%s.%d.%d" % (os.path.basename(share.directory), int(time.time() * 1000), os.getpid()))
+    os.rename(share.directory, trashed)
+    dump_json(trashed + '.json', {'share': share.directory, 'force': force, 'trashed': time.time()})
+    if os.path.exists(metadata_file(share.directory)):
+        os.remove(metadata_file(share.directory))
+    logging.info("Moved %s to the trash (%s)" % (share.directory, trashed))
+    return trashed
+
+
+def start_background_reaper(root):
+    """
+    Starts `nfs4_share reap ROOT` detached from this process, logging to the trash directory
+    """
+    trash = os.path.join(str(root), TRASH_NAME)
+    with open(os.path.join(trash, '.reap.log'), 'a') as log:
+        process = subprocess.Popen([sys.executable, '-m', 'nfs4_share', '-v', 'reap', str(root)],
+                                   stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+    logging.info("Started reaping %s in the background (pid %d)" % (trash, process.pid))
+    return process
+
+
+def _unlink_files(directory, names, force=False):
+    """
+    Unlinks files in a trashed directory, except (without force) files of which the trash holds the last copy.
+    Returns the number of removed and kept files.
+    """
+    removed = kept = 0
+    for name in names:
+        path = os.path.join(directory, name)
+        file_stat = os.lstat(path)
+        if not force and stat.S_ISREG(file_stat.st_mode) and file_stat.st_nlink == 1:
+            logging.debug("Keeping %s, it is the last copy" % path)
+            kept += 1
+            continue
+        Share._unshare_file(path, force=True)
+        removed += 1
+    return removed, kept
+
+
+def _reap_tree(directory, force=False):
+    """
+    Removes a trashed directory tree bottom-up, returns the number of removed and kept files. Directories that hold
+    kept files are left in place.
+    """
+    removed = kept = 0
+    for root, subdirectories, files in os.walk(directory, topdown=False, followlinks=False):
+        symlinks = [name for name in subdirectories if os.path.islink(os.path.join(root, name))]
+        root_removed, root_kept = _unlink_files(root, files + symlinks, force)
+        removed += root_removed
+        kept += root_kept
+        if not root_kept:
+            try:
+                Share._unshare_dir(root)
+            except OSError:  # Holds kept files further down
+                pass
+    return removed, kept
+
+
+def reap_entry(trashed, force=False):
+    """
+    Removes a trashed share, its top-level directories in parallel. Without force (given here or to the delete that
+    trashed it) the files of which it holds the last copy are kept, and so is the trashed share. Returns a report.
+    """
+    settings = load_json(trashed + '.json', default={})
+    force = force or settings.get('force', False)
+    with os.scandir(trashed) as iterator:
+        entries = list(iterator)
+    removed, kept = _unlink_files(trashed, [entry.name for entry in entries if not entry.is_dir(follow_symlinks=False)],
+                                  force)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for tree_removed, tree_kept in executor.map(lambda directory: _reap_tree(directory, force),
+                                                    [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]):
+            removed += tree_removed
+            kept += tree_kept
+    if kept:
+        logging.error("Kept %d files in %s of which it holds the last copy, reap with '--force' to delete them" %
+                      (kept, trashed))
+    else:
+        Share._unshare_dir(trashed)
+        if os.path.exists(trashed + '.json'):
+            os.remove(trashed + '.json')
+        logging.info("Reaped %s (%s)" % (settings.get('share', trashed), trashed))
+    return {'share': settings.get('share'), 'trashed': trashed, 'removed': removed, 'kept': kept}
+
+
+def reap(root, force=False):
+    """
+    Removes the shares in the trash of a shares root, until no new ones arrive. Only one reaper runs per trash at a
+    time: raises ShareBusyError when another one is running. Returns the reports of the trashed shares.
+    """
+    trash = os.path.join(str(root), TRASH_NAME)
+    if not os.path.isdir(trash):
+        return []
+    reports = []
+    seen = set()
+    retrying = False
+    while True:
+        try:
+            with share_flock(trash, timeout=0):
+                while True:
+                    names = _trashed_names(trash, seen)
+                    if not names:
+                        break
+                    for name in names:
+                        seen.add(name)
+                        reports.append(reap_entry(os.path.join(trash, name), force))
+        except ShareBusyError:
+            if not retrying:
+                raise
+            break  # Another reaper took over, it lists the trash again when it is done as well
+        # A reaper that was started while the lock was still held gave up, so what it was started for is reaped here
+        if not _trashed_names(trash, seen):
+            break
+        retrying = True
+    return reports
+
+
+def _trashed_names(trash, seen):
+    """
+    Returns the trashed shares in the trash that are not in seen
+    """
+    return sorted(name for name in os.listdir(trash) if name not in seen and not name.startswith('.')
+                  and os.path.isdir(os.path.join(trash, name)))
+
+
+def format_report(reports):
+    """
+    Formats reap reports as a plain-text table
+    """
+    rows = [['SHARE', 'TRASHED', 'REMOVED', 'KEPT']]
+    for report in reports:
+        rows.append([os.path.basename(report['share'] or ''),
+                     os.path.basename(report['trashed']),
+                     str(report['removed']),
+                     str(report['kept'])])
+    return tabulate(rows)
+
+
+def reap_command(root, force=False, output_json=False):
+    """
+    Removes the shares that `delete --trash` moved to the trash of root (entry point of `nfs4_share reap`). Exits with
+    1 when files were kept because the trash holds their last copy.
+    """
+    try:
+        reports = reap(root, force=force)
+    except ShareBusyError:
+        logging.warning("Not reaping %s, another reaper is running" % os.path.join(str(root), TRASH_NAME))
+        return []
+    if output_json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(format_report(reports))
+    if any(report['kept'] for report in reports):
+        raise SystemExit(1)
+    return reports
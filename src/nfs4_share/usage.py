@@ -0,0 +1,104 @@
+import os
+import json
+import logging
+
+from . import walk
+from .inodes import InodeSet
+from .report import human_readable_size, tabulate
+from .share import is_share_metadata
+
+
+def new_usage(name):
+    return {'share': name, 'files': 0, 'logical': 0, 'unique': 0, 'share_only': 0, 'sole_copy': 0}
+
+
+def account(shares, workers=8):
+    """
+    Accounts the storage of shares while counting every inode once. Per share this reports:
+    * logical: the size `du --count-links` would report
+    * unique: the size of the distinct inodes within the share
+    * share_only: the size of inodes whose links all live within this share (i.e. the share holds the only copy)
+    * sole_copy: the part of share_only made of files with a single hard link
+    The totals add the unique and share-only bytes over all shares, and overlap reports the bytes a share has in
+    common with the share that first linked the same inodes.
+    """
+    totals = new_usage('TOTAL')
+    overlap = {}
+    usages = []
+    inodes = InodeSet()
+    shares = [os.path.realpath(str(share)) for share in shares]
+    for index, share in enumerate(shares):
+        usage = new_usage(share)
+        usages.append(usage)
+        within_share = InodeSet()  # Inodes (with multiple links) encountered in this share, freed afterwards
+        for _, directory, entries in walk.scan([share], workers=workers):
+            for entry in entries:
+                stat_result = entry.stat
+                if not entry.is_file() or (directory == share and is_share_metadata(entry.name)):
+                    continue
+                size = stat_result.st_size
+                usage['files'] += 1
+                usage['logical'] += size
+                if stat_result.st_nlink == 1:
+                    for counter in (usage, totals):
+                        counter['unique'] += size
+                        counter['share_only'] += size
+                        counter['sole_copy'] += size
+                    continue
+                dev_ino = (stat_result.st_dev, stat_result.st_ino)
+                new_in_share = within_share.add(dev_ino)
+                if new_in_share:
+                    usage['unique'] += size
+                table = inodes.table(stat_result.st_dev)
+                slot = table.slot(stat_result.st_ino)
+                if table.seen[slot] == 0:
+                    table.owners[slot] = index
+                    totals['unique'] += size
+                elif table.owners[slot] != index and new_in_share:
+                    table.shared[slot] = 1
+                    key = "%s|%s" % (os.path.basename(shares[table.owners[slot]]), os.path.basename(share))
+                    overlap[key] = overlap.get(key, 0) + size
+                table.seen[slot] += 1
+                if table.seen[slot] == stat_result.st_nlink:  # All links are within the accounted shares
+                    totals['share_only'] += size
+                    if not table.shared[slot]:
+                        usage['share_only'] += size
+        logging.info("Accounted %s: %s" % (share, usage))
+    totals['files'] = sum(usage['files'] for usage in usages)
+    totals['logical'] = sum(usage['logical'] for usage in usages)
+    return {'shares': usages, 'total': totals, 'overlap': overlap, 'multi_link_inodes': len(inodes)}
+
+
+def format_report(report):
+    """
+    Formats a usage report as plain-text tables
+    """
+    rows = [['SHARE', 'FILES', 'LOGICAL', 'UNIQUE', 'SHARE-ONLY', 'SOLE-COPY']]
+    for usage in report['shares'] + [report['total']]:
+        rows.append([os.path.basename(usage['share']) or usage['share'],
+                     str(usage['files']),
+                     human_readable_size(usage['logical']),
+                     human_readable_size(usage['unique']),
+                     human_readable_size(usage['share_only']),
+                     human_readable_size(usage['sole_copy'])])
+    text = tabulate(rows)
+    if report['overlap']:
+        overlap_rows = [['SHARE', 'OVERLAPS WITH', 'BYTES']]
+        for key in sorted(report['overlap']):
+            overlap_rows.append(key.split('|') + [human_readable_size(report['overlap'][key])])
+        text += "\n\n" + tabulate(overlap_rows)
+    return text
+
+
+def usage_command(shares, root=False, output_json=False, workers=8):
+    """
+    Prints the storage accounting of shares (entry point of `nfs4_share usage`)
+    """
+    if root:
+        shares = [share for directory in shares for share in sorted(walk.share_directories(directory))]
+    report = account(shares, workers=workers)
+    if output_json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report))
+    return report
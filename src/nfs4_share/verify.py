@@ -0,0 +1,114 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import walk
+from .acl import AccessControlList, read_entries, read_entries_batch
+from .report import tabulate
+from .share import Share, LOCK_ACE, LOCK_ACL
+
+# Directories whose ACLs are read per nfs4_getfacl call, and repaired per nfs4_setfacl call
+BATCH_SIZE = 256
+
+
+def normalized(acl):
+    """
+    Returns an ACL without the lock: the LOCK_ACE is left out and the manage entries get their unlocked permissions
+    (lock() only takes the write permission of the managers away on the share directory itself)
+    """
+    return Share.manage_write_adjusted(AccessControlList(acl) - LOCK_ACL, add_write=True)
+
+
+def drift(entries, expected, locked):
+    """
+    Compares the ACL entries of a directory with the expected (normalized) ACL and lock state of its share. Returns
+    the drift as {'missing': [ACEs], 'extra': [ACEs], 'reordered': bool, 'lock': 'missing'/'unexpected'/None}, or None
+    when there is none.
+    """
+    acl = AccessControlList(entries)
+    actual = normalized(acl)
+    has_lock = LOCK_ACE in acl
+    if actual == expected and has_lock == locked:
+        return None
+    missing = [repr(entry) for entry in expected - actual]
+    extra = [repr(entry) for entry in actual - expected]
+    return {'missing': missing,
+            'extra': extra,
+            'reordered': actual != expected and not missing and not extra,
+            'lock': None if has_lock == locked else 'missing' if locked else 'unexpected'}
+
+
+def read_acls(directories, workers=8):
+    """
+    Generates (directory, entries) for directories, reading several batches (one nfs4_getfacl call each) in parallel
+    """
+    batches = [directories[start:start + BATCH_SIZE] for start in range(0, len(directories), BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for acls in executor.map(lambda batch: list(read_entries_batch(batch, batch_size=BATCH_SIZE)), batches):
+            yield from acls
+
+
+def verify_share(share_directory, repair=False, workers=8):
+    """
+    Checks that the ACLs of the subdirectories of a share match the ACL of the share directory, and that they carry the
+    LOCK_ACE when (and only when) the share is locked. Directories with identical ACLs are compared only once. With
+    repair, the drifted directories get the ACL of the share directory (with the manage entries unlocked).
+    """
+    share = Share(share_directory, exist_ok=True)
+    with share.flock(exclusive=repair):
+        root_acl = AccessControlList(read_entries(share.directory))
+        locked = LOCK_ACE in root_acl
+        expected = normalized(root_acl)
+        directories = list(share._subdirectories())
+        groups = {}  # ACL text -> (entries, directories)
+        for directory, entries in read_acls(directories, workers):
+            groups.setdefault(",".join(repr(entry) for entry in entries), (entries, []))[1].append(directory)
+        report = {'share': share.directory, 'directories': len(directories), 'distinct_acls': len(groups),
+                  'locked': locked, 'drift': [], 'repaired': 0}
+        for acl_text, (entries, acl_directories) in sorted(groups.items()):
+            difference = drift(entries, expected, locked)
+            if difference is not None:
+                difference.update(acl=acl_text, directories=sorted(acl_directories))
+                report['drift'].append(difference)
+                logging.warning("%d directories of %s drifted (e.g. %s): missing %s, extra %s, lock %s" %
+                                (len(acl_directories), share.directory, difference['directories'][0],
+                                 difference['missing'], difference['extra'], difference['lock']))
+        if repair and report['drift']:
+            targets = sorted(directory for difference in report['drift'] for directory in difference['directories'])
+            Share.manage_write_adjusted(root_acl, add_write=True).set_many(targets, batch_size=BATCH_SIZE)
+            report['repaired'] = len(targets)
+            logging.info("Repaired the ACLs of %d directories of %s" % (len(targets), share.directory))
+    return report
+
+
+def format_report(reports):
+    """
+    Formats verify reports as a plain-text table
+    """
+    rows = [['SHARE', 'DIRECTORIES', 'ACLS', 'LOCKED', 'DRIFTED', 'REPAIRED']]
+    for report in reports:
+        rows.append([os.path.basename(report['share']),
+                     str(report['directories']),
+                     str(report['distinct_acls']),
+                     'yes' if report['locked'] else 'no',
+                     str(sum(len(difference['directories']) for difference in report['drift'])),
+                     str(report['repaired'])])
+    return tabulate(rows)
+
+
+def verify_command(shares, root=False, repair=False, workers=8, output_json=False):
+    """
+    Reports (or with repair, fixes) ACL and lock drift within shares (entry point of `nfs4_share verify`). Exits with 1
+    when drift remains.
+    """
+    if root:
+        shares = [share for directory in shares for share in sorted(walk.share_directories(directory))]
+    reports = [verify_share(share, repair=repair, workers=workers) for share in shares]
+    if output_json:
+        print(json.dumps(reports, indent=2))
+    else:
+        print(format_report(reports))
+    if any(report['drift'] and not report['repaired'] for report in reports):
+        raise SystemExit(1)
+    return reports
@@ -0,0 +1,155 @@
+import os
+import stat
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class Entry:
+    """
+    A directory entry together with its (non-followed) stat result
+    """
+    __slots__ = ('name', 'path', 'stat')
+
+    def __init__(self, name, path, stat_result):
+        self.name = name
+        self.path = path
+        self.stat = stat_result
+
+    def __repr__(self):
+        return "Entry({!r})".format(self.path)
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.stat.st_mode)
+
+    def is_file(self):
+        return stat.S_ISREG(self.stat.st_mode)
+
+
+def scan_directory(directory, directory_stat=None, listing=None):
+    """
+    Lists a single directory and stats its entries (without following symlinks). When a cached listing
+    ([mtime_ns, ctime_ns, names]) is given and the directory did not change since, the names are taken from it so
+    only the entries themselves are stat-ed. Returns the entries and the (possibly new) listing.
+    """
+    if listing is not None and directory_stat is not None \
+            and listing[:2] == [directory_stat.st_mtime_ns, directory_stat.st_ctime_ns]:
+        entries = []
+        for name in listing[2]:
+            path = os.path.join(directory, name)
+            try:
+                entries.append(Entry(name, path, os.lstat(path)))
+            except FileNotFoundError:  # Removed while scanning
+                continue
+        return entries, listing
+    entries = []
+    with os.scandir(directory) as iterator:
+        for dir_entry in iterator:
+            try:
+                entries.append(Entry(dir_entry.name, dir_entry.path, dir_entry.stat(follow_symlinks=False)))
+            except FileNotFoundError:  # Removed while scanning
+                continue
+    if directory_stat is None:
+        return entries, None
+    return entries, [directory_stat.st_mtime_ns, directory_stat.st_ctime_ns, [entry.name for entry in entries]]
+
+
+def item_directories(source_root, relative_root='', context=None, skipped=None):
+    """
+    Traverses the directory tree of a shared item (source_root) in the order that decides under which path a directory
+    is shared when it can be reached through several paths (via symlinks): every directory is visited once, at the
+    first of its paths by (number of symlinks on the path, path). So all real directories of the tree come before any
+    directory that is reached through a symlink, and sharing, syncing and partitioning an item agree on the path of
+    every directory.
+
+    Yields (path, relative, stat_result, context, subdirectories) per directory, where relative is its path within the
+    item ending with '/' (relative_root for source_root, '' for a whole item). Before resuming, the caller appends the
+    (name, context) of the subdirectories to descend into to subdirectories. The context of a subdirectory is yielded
+    with it, or passed to skipped(path, context) when it was already visited or does not resolve to a directory.
+    """
+    visited = set()
+    pending = [(0, relative_root, str(source_root), os.stat(source_root), context)]
+    while pending:
+        links, relative, path, directory_stat, context = heapq.heappop(pending)
+        if (directory_stat.st_dev, directory_stat.st_ino) in visited:
+            logging.debug("Not traversing %s, the same directory was reached through another path" % path)
+            if skipped is not None:
+                skipped(path, context)
+            continue
+        visited.add((directory_stat.st_dev, directory_stat.st_ino))
+        subdirectories = []
+        yield path, relative, directory_stat, context, subdirectories
+        for name, subdirectory_context in subdirectories:
+            subdirectory = os.path.join(path, name)
+            try:
+                subdirectory_stat = os.lstat(subdirectory)
+                symlinked = stat.S_ISLNK(subdirectory_stat.st_mode)
+                if symlinked:
+                    subdirectory_stat = os.stat(subdirectory)
+            except FileNotFoundError:  # A dangling symlink, or removed meanwhile
+                subdirectory_stat, symlinked = None, True
+            if subdirectory_stat is None or not stat.S_ISDIR(subdirectory_stat.st_mode):
+                logging.debug("Not traversing %s, it does not resolve to a directory" % subdirectory)
+                if skipped is not None:
+                    skipped(subdirectory, subdirectory_context)
+                continue
+            heapq.heappush(pending, (links + symlinked, relative + name + '/', subdirectory, subdirectory_stat,
+                                     subdirectory_context))
+
+
+def share_directories(root):
+    """
+    Returns {path: stat_result} for every share (i.e. non-hidden directory) directly below root
+    """
+    shares = {}
+    with os.scandir(str(root)) as iterator:
+        for entry in iterator:
+            if not entry.name.startswith('.') and entry.is_dir(follow_symlinks=False):
+                shares[entry.path] = entry.stat(follow_symlinks=False)
+    return shares
+
+
+def scan(roots, workers=8, listings=None):
+    """
+    Walks the directory trees below the given roots with a pool of threads that each list and stat one directory at
+    a time. On NFS the latency of every readdir/stat call dominates, so keeping several calls in flight is what makes
+    a walk fast. Yields (root, directory, entries) for every directory in no particular order. Symlinks are reported
+    but never followed and unreadable directories are logged and skipped.
+
+    Passing a dict as listings makes the walk incremental: directories whose mtime and ctime are unchanged are not
+    listed again but their cached names are re-stat-ed. The dict is updated in place with the listings of this walk
+    (listings of directories that were not encountered are dropped) so it can be persisted for the next walk.
+    """
+    visited = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+
+        def submit(root, directory, directory_stat):
+            if listings is None:
+                directory_stat, listing = None, None
+            else:
+                listing = listings.get(directory)
+            pending[executor.submit(scan_directory, directory, directory_stat, listing)] = (root, directory)
+
+        for root in roots:
+            root = str(root)
+            submit(root, root, os.stat(root) if listings is not None else None)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                root, directory = pending.pop(future)
+                try:
+                    entries, listing = future.result()
+                except OSError as e:
+                    logging.warning("Could not scan %s: %s" % (directory, e))
+                    continue
+                if listings is not None:
+                    visited.add(directory)
+                    listings[directory] = listing
+                for entry in entries:
+                    if entry.is_dir():
+                        submit(root, entry.path, entry.stat)
+                yield root, directory, entries
+    if listings is not None:
+        for directory in set(listings) - visited:
+            del listings[directory]
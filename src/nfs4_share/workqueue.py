@@ -0,0 +1,315 @@
+import os
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+
+from . import walk
+from .cache import load_json, dump_json
+from .share import Share, ItemResults, LINKED, RELINKED, FILTERED, UNHANDLED
+from .filters import PathFilter
+from .sync import scan_item, apply_operations
+
+# Subdirectories of a queue directory; a unit moves from pending to claimed (by a worker) to done
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+# Interval (seconds) at which workers look for new units and the coordinator for finished ones
+POLL_INTERVAL = 0.5
+# A claimed unit without a heartbeat (an update of the mtime of its claim) for this long (seconds) is queued again,
+# e.g. because its worker died. Workers send a heartbeat every stale_after / HEARTBEATS_PER_PERIOD seconds, also while
+# they scan, and results that nobody collected for this long are removed.
+stale_after = 600
+HEARTBEATS_PER_PERIOD = 4
+
+
+def _queue_directory(queue, state):
+    directory = os.path.join(str(queue), state)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _unit_names(directory, prefix=''):
+    """
+    Returns the units in a queue directory (temporary files of dump_json start with a dot)
+    """
+    return sorted(name for name in os.listdir(directory) if name.endswith('.json') and not name.startswith('.')
+                  and name.startswith(prefix))
+
+
+def partition(source_root, path_filter=None, symlinks='follow', split_depth=2):
+    """
+    Splits an item directory into work units, returned as (relative path, deep) tuples ('' is the item itself):
+    * the directories above split_depth are shallow units: only their own entries are linked
+    * the directories at split_depth (and symlinked directories above it) are deep units: their whole subtree is linked
+    Excluded directories are left out, as are directories that were already reached through another path (the same
+    traversal as Share.add and sync.scan_item, see walk.item_directories).
+    """
+    path_filter = path_filter or PathFilter()
+    units = []
+    for path, relative, _, (depth, symlinked), subdirectories in walk.item_directories(source_root, context=(0, False)):
+        relative = relative.rstrip('/')
+        if depth == split_depth or symlinked:
+            units.append((relative, True))
+            continue
+        units.append((relative, False))
+        with os.scandir(path) as iterator:
+            entries = sorted(iterator, key=lambda entry: entry.name)
+        for entry in entries:
+            child = relative + '/' + entry.name if relative else entry.name
+            if not entry.is_dir() or not path_filter.includes_directory(child) \
+                    or (entry.is_symlink() and symlinks != 'follow'):
+                continue
+            subdirectories.append((entry.name, (depth + 1, entry.is_symlink())))
+    return units
+
+
+def distribute(share, items, path_filter, symlinks, queue, split_depth=2):
+    """
+    Writes the work units of directory items to the queue. The directories of the shallow units are created first, so
+    the workers only create directories within their own unit. Returns the job id, the number of units and the
+    directories of the shallow units.
+    """
+    job = "%s-%d-%d" % (os.path.basename(share.directory), int(time.time() * 1000), os.getpid())
+    pending_directory = _queue_directory(queue, PENDING)
+    _queue_directory(queue, CLAIMED)
+    _queue_directory(queue, DONE)
+    created = {share.directory}
+    shallow = []
+    count = 0
+    for item in items:
+        item = os.path.realpath(str(item))
+        target_root = os.path.join(share.directory, os.path.basename(item))
+        for relative, deep in partition(item, path_filter, symlinks, split_depth):
+            target = os.path.join(target_root, relative) if relative else target_root
+            if not deep:
+                share._makedirs(target, created)
+                shallow.append(target)
+            unit = {'job': job, 'share': share.directory, 'item': item, 'relative': relative, 'deep': deep,
+                    'source': os.path.join(item, relative) if relative else item, 'target': target,
+                    'filter': path_filter.to_dict() if path_filter else {}, 'symlinks': symlinks}
+            dump_json(os.path.join(pending_directory, "%s.%06d.json" % (job, count)), unit)
+            count += 1
+    logging.info("Queued %d work units for %s in %s (job %s)" % (count, share.directory, queue, job))
+    return job, count, shallow
+
+
+def requeue_stale(queue, prefix=''):
+    """
+    Moves claimed units without a recent heartbeat back to pending, returns their names
+    """
+    claimed_directory = _queue_directory(queue, CLAIMED)
+    requeued = []
+    for name in _unit_names(claimed_directory, prefix):
+        try:
+            if time.time() - os.stat(os.path.join(claimed_directory, name)).st_mtime < stale_after:
+                continue
+            os.rename(os.path.join(claimed_directory, name), os.path.join(_queue_directory(queue, PENDING), name))
+        except FileNotFoundError:  # Finished meanwhile
+            continue
+        logging.warning("Queued %s again, its worker did not report for %ss" % (name, stale_after))
+        requeued.append(name)
+    return requeued
+
+
+def wait(queue, job, count, timeout=None):
+    """
+    Waits until the workers finished all units of a job and returns their results (removing them from the queue).
+    Raises TimeoutError when that takes longer than timeout seconds.
+    """
+    done_directory = _queue_directory(queue, DONE)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        names = _unit_names(done_directory, job + '.')
+        if len(names) >= count:
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            raise TimeoutError("%d of %d work units of job %s are finished after %ss (are workers running on %s?)" %
+                               (len(names), count, job, timeout, queue))
+        requeue_stale(queue, job + '.')
+        time.sleep(POLL_INTERVAL)
+    results = []
+    for name in names:
+        results.append(load_json(os.path.join(done_directory, name)))
+        os.remove(os.path.join(done_directory, name))
+    _remove_leftovers(queue, job)
+    return results
+
+
+def _remove_leftovers(queue, job):
+    """
+    Removes the units of a finished job that were queued again (they finished twice, or would), and the results of
+    earlier jobs that nobody collected (of a unit that finished twice after its job was done, or of a coordinator that
+    died)
+    """
+    for state in [PENDING, CLAIMED]:
+        directory = _queue_directory(queue, state)
+        for name in _unit_names(directory, job + '.'):
+            _remove(os.path.join(directory, name))
+    done_directory = _queue_directory(queue, DONE)
+    for name in _unit_names(done_directory):
+        try:
+            if time.time() - os.stat(os.path.join(done_directory, name)).st_mtime >= stale_after:
+                _remove(os.path.join(done_directory, name))
+        except FileNotFoundError:
+            continue
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def claim(queue):
+    """
+    Claims a pending unit by renaming it (atomic, also on NFS), returns its name or None when there are none. The unit
+    is touched before the rename: a rename keeps the mtime from when the unit was queued, and the claim would look
+    stale right away. Units that are already done (they were queued again while their worker finished) are dropped.
+    """
+    pending_directory = _queue_directory(queue, PENDING)
+    claimed_directory = _queue_directory(queue, CLAIMED)
+    done_directory = _queue_directory(queue, DONE)
+    for name in _unit_names(pending_directory):
+        try:
+            os.utime(os.path.join(pending_directory, name))
+            os.rename(os.path.join(pending_directory, name), os.path.join(claimed_directory, name))
+        except FileNotFoundError:  # Claimed by another worker
+            continue
+        if os.path.exists(os.path.join(done_directory, name)):
+            _remove(os.path.join(claimed_directory, name))
+            continue
+        return name
+    return None
+
+
+@contextmanager
+def heartbeats(claimed):
+    """
+    Context in which a thread touches a claimed unit every stale_after / HEARTBEATS_PER_PERIOD seconds, so it is not
+    queued again while it is scanned or linked
+    """
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(stale_after / HEARTBEATS_PER_PERIOD):
+            try:
+                os.utime(claimed)
+            except FileNotFoundError:  # Queued again (or its job finished) meanwhile
+                logging.warning("Lost the claim of %s" % claimed)
+                return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def process_unit(unit):
+    """
+    Links a unit into its share (see sync.scan_item and apply_operations)
+    """
+    share = Share(unit['share'], exist_ok=True)
+    relative_root = unit['relative'] + '/' if unit['relative'] else ''
+    operations, _, _ = scan_item(unit['source'], unit['target'], PathFilter(**unit['filter']), unit['symlinks'],
+                                 relative_root=relative_root, recursive=unit['deep'])
+    failed = apply_operations(share, operations)
+    return {'operations': len(operations), 'failed': sorted(failed)}
+
+
+def work(queue, idle_timeout=None, max_units=None):
+    """
+    Claims and processes units until the queue has been empty for idle_timeout seconds (None keeps waiting) or
+    max_units were processed. Returns the number of processed units.
+    """
+    worker = "%s:%d" % (socket.gethostname(), os.getpid())
+    done_directory = _queue_directory(queue, DONE)
+    processed = 0
+    idle_since = time.monotonic()
+    while max_units is None or processed < max_units:
+        name = claim(queue)
+        if name is None:
+            if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                break
+            time.sleep(POLL_INTERVAL)
+            continue
+        claimed = os.path.join(_queue_directory(queue, CLAIMED), name)
+        unit = load_json(claimed)
+        logging.info("%s processing %s (%s)" % (worker, name, unit['source']))
+        try:
+            with heartbeats(claimed):
+                result = process_unit(unit)
+            result['error'] = None
+        except Exception as e:
+            logging.exception("Work unit %s failed" % name)
+            result = {'operations': 0, 'failed': [], 'error': str(e)}
+        result.update(unit=unit, worker=worker)
+        dump_json(os.path.join(done_directory, name), result)
+        if not os.path.exists(claimed):  # Queued again meanwhile; another worker need not process it again
+            _remove(os.path.join(_queue_directory(queue, PENDING), name))
+        _remove(claimed)
+        processed += 1
+        idle_since = time.monotonic()
+    return processed
+
+
+def add_distributed(share, items, path_filter=None, symlinks='follow', queue=None, split_depth=2, timeout=None):
+    """
+    Adds items to a share like Share.add, with the directory items linked by workers (see work()) that may run on
+    other nodes. Existing items are brought up to date in place. The caller holds the share lock for the workers, and
+    finishes the access file, tracking and lock steps. Returns the ItemResults.
+    """
+    results = ItemResults()
+    directories = []
+    existed = {}
+    for item in items:
+        item = str(item)
+        if os.path.isfile(item):
+            if path_filter and not path_filter.includes_file(os.path.basename(item)):
+                results.record(item, FILTERED)
+            else:
+                status, reason = share._link_files(item, os.path.join(share.directory, os.path.basename(item)))
+                results.record(item, status, reason)
+        elif os.path.isdir(item):
+            directories.append(item)
+            existed[item] = os.path.lexists(os.path.join(share.directory, os.path.basename(item)))
+        else:
+            logging.error("Did not handle input item '%s'" % item)
+            results.record(item, UNHANDLED, "not a file or directory")
+    if directories:
+        job, count, shallow = distribute(share, directories, path_filter, symlinks, queue, split_depth)
+        unit_results = wait(queue, job, count, timeout)
+        problems = {}
+        for unit_result in unit_results:
+            if unit_result['error'] or unit_result['failed']:
+                problems.setdefault(unit_result['unit']['item'], []).append(
+                    unit_result['error'] or "%d directories could not be fully linked" % len(unit_result['failed']))
+        if path_filter:
+            # The directories of shallow units that hold nothing that passes the filter
+            for directory in sorted(shallow, reverse=True):
+                if not os.listdir(directory):
+                    share._unshare_dir(directory)
+        for item in directories:
+            target = os.path.join(share.directory, os.path.basename(item))
+            reason = "; ".join(problems.get(os.path.realpath(item), [])) or None
+            if not os.path.lexists(target):
+                results.record(item, FILTERED, "nothing passes the filter")
+            else:
+                results.record(item, RELINKED if existed[item] else LINKED, reason)
+    share.record_items([result.item for result in results if result.status != UNHANDLED
+                        and not (result.status == FILTERED and os.path.isfile(result.item))], path_filter, symlinks)
+    return results
+
+
+def worker_command(queue, idle_timeout=None, max_units=None):
+    """
+    Processes the work units of distributed share builds (entry point of `nfs4_share worker`)
+    """
+    processed = work(queue, idle_timeout=idle_timeout, max_units=max_units)
+    logging.info("Processed %d work units from %s" % (processed, queue))
+    return processed
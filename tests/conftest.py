@@ -38,4 +38,30 @@ def single_file_share(source_dir, shares_dir, calling_user, calling_prim_group,
                    user_apache_directive=variables["user_directive"], group_apache_directive=variables["group_directive"],
                    domain=variables["domain_name"],
                    service_application_accounts=variables['service_application_accounts'])
-    return share
\ No newline at end of file
+    return share
+
+
+@pytest.fixture
+def fake_acl_binaries(tmpdir, monkeypatch):
+    """
+    nfs4_getfacl/nfs4_setfacl stand-ins, so operations that read and set ACLs can run on any filesystem
+    """
+    from nfs4_share import acl
+    for name, script in [('getfacl', "#!/bin/sh\necho 'A::EVERYONE@:rtncy'\n"), ('setfacl', "#!/bin/sh\nexit 0\n")]:
+        path = str(tmpdir.join('nfs4_%s' % name))
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+        monkeypatch.setattr(acl, '%s_bin' % name, path)
+
+
+@pytest.fixture
+def without_acls(monkeypatch):
+    """
+    Shares whose directories are created without setting an ACL and whose permissions are an empty ACL, so share
+    operations can run on any filesystem
+    """
+    from nfs4_share.acl import AccessControlList
+    from nfs4_share.share import Share
+    monkeypatch.setattr(Share, '_makedir', lambda self, directory, permissions=True: os.makedirs(directory))
+    monkeypatch.setattr(Share, 'permissions', property(lambda self: AccessControlList([])))
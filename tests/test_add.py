@@ -69,3 +69,23 @@ def test_cli_with_file(single_file_share, source_dir, variables):
         if e.output is not None:
             print(e.output.decode())
     assert os.path.samefile(os.path.join(single_file_share.directory, "extra_file"), items[0])
+
+
+def test_add_reports_per_item_results(tmpdir, without_acls):
+    from nfs4_share.share import Share, LINKED, RELINKED, PRESENT, FILTERED, UNHANDLED, REMOVED, MISSING
+    from nfs4_share.filters import PathFilter
+    source = tmpdir.mkdir('source')
+    items = fabricate_a_source(source, ["a.bam", "b.log", "run/c.bam"])[:2] + [os.path.join(source, 'run')]
+    os.mkfifo(os.path.join(source, 'fifo'))
+    share = Share(tmpdir.join('shares', 'share'))
+    results = share.add(items + [os.path.join(source, 'fifo')], PathFilter(exclude=['*.log']))
+    assert [(os.path.basename(result.item), result.status) for result in results] == \
+        [('a.bam', LINKED), ('b.log', FILTERED), ('run', LINKED), ('fifo', UNHANDLED)]
+    assert results.linked == [items[0], items[2]]
+    results = share.add(items)
+    assert results.counts() == {PRESENT: 1, LINKED: 1, RELINKED: 1}  # b.log is no longer filtered
+
+    results = share.remove_items([os.path.join(share.directory, name) for name in ['run', 'a.bam', 'x']],
+                                 force_file_removal=True)
+    assert results.counts() == {REMOVED: 2, MISSING: 1}
+    assert sorted(os.listdir(share.directory)) == ['b.log']
@@ -0,0 +1,36 @@
+import os
+import asyncio
+import pytest
+from os.path import join as j
+from .utils import fabricate_a_source
+
+
+def test_async_create_add_and_cancel(tmpdir, fake_acl_binaries, calling_prim_group, monkeypatch):
+    from nfs4_share import aio
+    from nfs4_share.share import Share, LINKED
+    monkeypatch.setattr(aio, 'BATCH_SIZE', 1)
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a", "run/d/b", "big/1", "big/2", "big/3", "big/4"])
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    progress = []
+    share = loop.run_until_complete(aio.create(tmpdir.join('shares', 'share'), domain='example.org',
+                                               items=[j(source, 'run')], managing_groups=[calling_prim_group],
+                                               progress=lambda *args: progress.append(args)))
+    assert os.path.samefile(j(share.directory, 'run', 'd', 'b'), j(source, 'run', 'd', 'b'))
+    assert progress[-1] == (j(source, 'run'), 4, 4)  # Two directories and two files
+
+    def cancel_after_two_batches(item, done, total):
+        if done == 2:
+            task.cancel()
+    task = loop.create_task(aio.add(share.directory, items=[j(source, 'big')], progress=cancel_after_two_batches))
+    with pytest.raises(asyncio.CancelledError):
+        loop.run_until_complete(task)
+    assert not os.path.exists(j(share.directory, 'big'))  # The partially added item is removed again
+
+    def synchronous_acl_call(self):
+        raise AssertionError("the ACL of the share was read outside of the ACL process limit")
+    monkeypatch.setattr(Share, 'permissions', property(synchronous_acl_call))
+    results = loop.run_until_complete(aio.add(share.directory, items=[j(source, 'big')], lock=True))
+    assert results.counts() == {LINKED: 1} and len(os.listdir(j(share.directory, 'big'))) == 4
+    loop.close()
@@ -0,0 +1,65 @@
+import os
+import hashlib
+from os.path import join as j
+from .utils import fabricate_a_source
+
+
+def test_checksum_manifest(tmpdir, fake_acl_binaries, without_acls, monkeypatch):
+    from nfs4_share import hashing
+    from nfs4_share.share import Share
+    from nfs4_share.checksum import checksum_command
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a", "run/d/b", "single"])
+    first = Share(tmpdir.join('shares', 'first'))
+    first.add([j(source, 'run'), j(source, 'single')])
+    second = Share(tmpdir.join('shares', 'second'))
+    second.add([j(source, 'run')])
+    cache_file = str(tmpdir.join('hashes.sqlite'))
+
+    reports = checksum_command([first.directory], workers=2, cache_file=cache_file)
+    assert (reports[0]['files'], reports[0]['written']) == (3, True)
+    with open(j(first.directory, 'SHA256SUMS')) as f:
+        lines = f.read().splitlines()
+    with open(j(source, 'run', 'd', 'b'), 'rb') as f:
+        assert lines[1] == "%s  run/d/b" % hashlib.sha256(f.read()).hexdigest()
+    assert [line.split('  ')[1] for line in lines] == ['run/a', 'run/d/b', 'single']
+
+    # The files of the second share are hard links of files that were hashed already, so nothing is read
+    def not_read(*args):
+        raise AssertionError("a file was hashed again")
+    monkeypatch.setattr(hashing, 'ProcessPoolExecutor', not_read)
+    reports = checksum_command([tmpdir.join('shares')], root=True, workers=2, cache_file=cache_file)
+    assert [(report['files'], report['written']) for report in reports] == [(3, False), (2, True)]
+
+
+def test_manifests_of_locked_shares_and_shared_items(tmpdir, fake_acl_binaries, without_acls, monkeypatch):
+    from nfs4_share.acl import AccessControlList, AccessControlEntity
+    from nfs4_share.share import Share, LOCK_ACE
+    from nfs4_share.checksum import checksum_share, remove_manifests
+    from nfs4_share.inventory import summarize_share
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a", "SHA256SUMS"])
+    share = Share(tmpdir.join('shares', 'share'))
+    share.add([j(source, 'run')])
+
+    # Only the share directory is unlocked for writing the manifest, and locked again
+    locked = AccessControlList([AccessControlEntity.from_string('A:g:managers@domain:rxaDdtTNcCo'), LOCK_ACE])
+    applied = []
+    monkeypatch.setattr(Share, 'permissions', property(lambda self: applied[-1] if applied else locked,
+                                                       lambda self, acl: applied.append(acl)))
+
+    def not_called(self):
+        raise AssertionError("the whole share was locked or unlocked")
+    monkeypatch.setattr(Share, 'unlock', not_called)
+    monkeypatch.setattr(Share, 'lock', not_called)
+    assert checksum_share(share.directory)['written']
+    assert [repr(acl) for acl in applied] == ['A:g:managers@domain:rwxaDdtTNcCo', repr(locked)]
+    assert summarize_share(share.directory)['items'] == 1  # The manifest is not an item
+
+    # A shared item with the name of the manifest is neither overwritten nor removed
+    os.remove(j(share.directory, 'SHA256SUMS'))
+    share.add([j(source, 'SHA256SUMS')])
+    report = checksum_share(share.directory)
+    assert report['error'] and not report['written']
+    remove_manifests(share)
+    assert os.path.samefile(j(share.directory, 'SHA256SUMS'), j(source, 'SHA256SUMS'))
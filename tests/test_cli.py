@@ -0,0 +1,42 @@
+import subprocess
+import sys
+
+# Budget (in microseconds) for importing the command-line interface, as reported by `python -X importtime`
+IMPORT_TIME_BUDGET = 100000
+
+
+def cli_import_times(module='nfs4_share.cli'):
+    """Returns the cumulative import time (us) of every module imported when importing the given module"""
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    import_times = {}
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        import_times[name.strip()] = int(cumulative)
+    return import_times
+
+
+def test_cli_import_time_budget():
+    import_times = cli_import_times()
+    assert import_times['nfs4_share.cli'] < IMPORT_TIME_BUDGET, \
+        "Importing the CLI took %dus (budget: %dus)" % (import_times['nfs4_share.cli'], IMPORT_TIME_BUDGET)
+
+
+def test_cli_does_not_import_heavy_modules():
+    import_times = cli_import_times()
+    for module in ['git', 'parse', 'nfs4_share.manage', 'nfs4_share.track_changes']:
+        assert module not in import_times
+
+
+def test_cli_parser_does_not_lookup_domain(monkeypatch):
+    from nfs4_share import acl
+    from nfs4_share.cli import _cli_argument_parser
+
+    def fail():
+        raise AssertionError("The domain should not be looked up while building the parser")
+    monkeypatch.setattr(acl, 'get_nfs4_domain', fail)
+    args = _cli_argument_parser().parse_args(['add', 'share'])
+    assert args.domain is None
+    assert args.func.__name__ == 'add'
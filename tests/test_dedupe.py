@@ -0,0 +1,36 @@
+import os
+from os.path import join as j
+
+
+def test_dedupe_links_identical_copies(tmpdir, monkeypatch):
+    from nfs4_share import dedupe, hashing
+    monkeypatch.setattr(hashing, 'BLOCK_SIZE', 16)  # Files above 32 bytes get a full hash
+    data = tmpdir.mkdir('data')
+    content = b"x" * 100 + b"middle" + b"y" * 100
+    for name, file_content in [('a', content), ('copy/b', content), ('c', content.replace(b"middle", b"MIDDLE")),
+                               ('d', content[:-1] + b"z"),
+                               ('small', b"same"), ('copy/small', b"same"), ('private', b"same"), ('other', b"diff")]:
+        os.makedirs(os.path.dirname(j(data, name)), exist_ok=True)
+        with open(j(data, name), 'wb') as f:
+            f.write(file_content)
+    os.link(j(data, 'a'), j(data, 'a-link'))
+    os.chmod(j(data, 'private'), 0o600)
+    cache_file = str(tmpdir.join('hashes.sqlite'))
+
+    with hashing.HashCache(cache_file) as hash_cache:
+        groups = dedupe.find_duplicates([data], hash_cache=hash_cache, workers=2)
+    assert sorted(inode['paths'] for group in groups for inode in group['inodes']) == \
+        [[j(data, 'a'), j(data, 'a-link')], [j(data, 'copy', 'b')], [j(data, 'copy', 'small')], [j(data, 'private')],
+         [j(data, 'small')]]
+    assert sum(dedupe.reclaimable(group) for group in groups) == len(content) + 2 * 4
+    with hashing.HashCache(cache_file) as hash_cache:  # Resumed from the cache
+        assert hash_cache.get(os.stat(j(data, 'd')), 'sha256') is None  # Its tail differs, it is not read completely
+        assert hash_cache.get(os.stat(j(data, 'c')), 'sha256') != hash_cache.get(os.stat(j(data, 'a')), 'sha256')
+        assert hash_cache.get(os.stat(j(data, 'copy', 'b')), 'sha256') == hashing.hash_file(j(data, 'a'))
+
+    report = dedupe.dedupe_command([data], link=True, workers=2, cache_file=cache_file)
+    assert (report['linked'], report['reclaimed']) == (2, len(content) + 4)
+    assert os.path.samefile(j(data, 'copy', 'b'), j(data, 'a')) and os.stat(j(data, 'a')).st_nlink == 3
+    assert os.path.samefile(j(data, 'copy', 'small'), j(data, 'small'))
+    assert not os.path.samefile(j(data, 'private'), j(data, 'small'))  # Its access differs
+    assert not any(name.endswith('.nfs4_share-dedupe') for name in os.listdir(data))
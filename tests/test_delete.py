@@ -182,7 +182,8 @@ def test_remove_one_user(single_file_share, variables):
                                                variables["domain_name"], 'rxtncy')
     acl_expected_after_rm = after_share_permissions - acl.AccessControlList([acl_tobe_removed])
 
-    delete(single_file_share.directory, domain=variables["domain_name"], users=[variables["user_to_rm_from_share"]], lock=True)
+    delete(single_file_share.directory, domain=variables["domain_name"], users=[variables["user_to_rm_from_share"]], lock=True,
+           user_apache_directive=variables["user_directive"], group_apache_directive=variables["group_directive"])
     acl_after_user_rm = acl.AccessControlList.from_file(single_file_share.directory)
     assert sorted(acl_after_user_rm.entries) == sorted(acl_expected_after_rm.entries)
 
@@ -206,7 +207,8 @@ def test_remove_multiple_users(single_file_share, variables):
     
     acl_expected_after_rm = acl.AccessControlList(set(after_share_permissions) - set(extra_user_permissions))
 
-    delete(single_file_share.directory, domain=variables["domain_name"], users=variables["multiple_new_users"], lock=True)
+    delete(single_file_share.directory, domain=variables["domain_name"], users=variables["multiple_new_users"], lock=True,
+           user_apache_directive=variables["user_directive"], group_apache_directive=variables["group_directive"])
     acl_after_user_rm = acl.AccessControlList.from_file(single_file_share.directory)
     assert sorted(acl_after_user_rm.entries) == sorted(acl_expected_after_rm.entries)
 
@@ -0,0 +1,26 @@
+from .utils import fabricate_a_source
+
+
+def test_ordered_allow_and_deny():
+    from nfs4_share.acl import AccessControlEntity
+    from nfs4_share.evaluate import Principal, is_allowed
+    group = Principal('group1', is_group=True)
+
+    def acl(*specs):
+        return [AccessControlEntity.from_string(spec) for spec in specs]
+    assert is_allowed(acl('A:g:group1@domain:rtncy'), group)
+    assert not is_allowed(acl('A:g:group2@domain:rtncy', 'A::group1@domain:r'), group)  # A user, not the group
+    assert not is_allowed(acl('D:g:group1@domain:r', 'A:g:group1@domain:rtncy'), group)
+    assert is_allowed(acl('A:g:group1@domain:r', 'D:g:group1@domain:r'), group)  # The first entry decides
+    assert not is_allowed(acl('A:g:group1@domain:r'), group, permissions='rx')  # Undecided is denied
+    assert not is_allowed(acl('A:gi:group1@domain:r'), group)  # Inherit-only
+
+
+def test_check_share_access(single_file_share, source_dir, calling_user, calling_prim_group):
+    from nfs4_share.evaluate import Principal, check_access
+    report = check_access([single_file_share.directory], [Principal(calling_user)])
+    assert report['denied'] == {'user:%s' % calling_user: []}
+
+    items = fabricate_a_source(source_dir, ["a", "b", "c"])
+    report = check_access(items, [Principal(calling_user), Principal(calling_prim_group, is_group=True)])
+    assert report['files'] == 3 and report['distinct_acls'] == 1 and report['evaluations'] == 2
@@ -0,0 +1,30 @@
+import os
+import json
+from os.path import join as j
+from .utils import fabricate_a_source
+
+
+def test_events_are_recorded_per_operation(tmpdir, fake_acl_binaries):
+    from nfs4_share import events
+    from nfs4_share.share import Share
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a", "run/d/b", "run/d/c"])
+    share = Share(tmpdir.join('shares', 'share'))
+
+    with events.recording(str(tmpdir.join('events.jsonl'))):
+        share.add([j(source, 'run')])
+    with open(tmpdir.join('events.jsonl')) as f:
+        records = [json.loads(line) for line in f]
+    assert sorted((record['op'], os.path.relpath(record['path'], share.directory)) for record in records) == \
+        [('link', 'run/a'), ('link', 'run/d/b'), ('link', 'run/d/c'), ('mkdir', 'run'), ('mkdir', 'run/d'),
+         ('setfacl', 'run'), ('setfacl', 'run/d')]
+    assert events.sink is None
+
+    with events.recording(str(tmpdir.join('summary.jsonl')), summary=True):
+        share.remove_items([j(share.directory, 'run')], force_file_removal=True)
+    with open(tmpdir.join('summary.jsonl')) as f:
+        assert [json.loads(line) for line in f] == [
+            {'dir': share.directory, 'op': 'rmdir', 'count': 1},
+            {'dir': j(share.directory, 'run'), 'op': 'rmdir', 'count': 1},
+            {'dir': j(share.directory, 'run'), 'op': 'unlink', 'count': 1},
+            {'dir': j(share.directory, 'run', 'd'), 'op': 'unlink', 'count': 2}]
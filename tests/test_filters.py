@@ -0,0 +1,79 @@
+import os
+from os.path import join as j
+from .utils import fabricate_a_source
+
+
+def test_path_filter():
+    from nfs4_share.filters import PathFilter
+    path_filter = PathFilter(include=['*.bam', 'run1/*.vcf.gz', r're:\.csv$'], exclude=['tmp/', 'work', '*.log'])
+    assert path_filter.includes_file('a.bam') and path_filter.includes_file('sample/a.bam')
+    assert path_filter.includes_file('run1/a.vcf.gz') and not path_filter.includes_file('run2/a.vcf.gz')
+    assert path_filter.includes_file('x/y.csv') and not path_filter.includes_file('a.txt')
+    assert not path_filter.includes_file('a.log') and not path_filter.includes_file('work')
+    assert PathFilter(exclude=['tmp/']).includes_file('tmp')  # 'tmp/' only excludes directories
+    assert not path_filter.includes_directory('tmp') and not path_filter.includes_directory('x/work')
+    assert path_filter.includes_directory('tmp2') and path_filter.includes_directory('sample')
+    assert PathFilter(exclude=['*.log']).includes_file('a.txt')
+    assert not PathFilter()
+
+
+def test_filtered_add_prunes_excluded_directories(source_dir, shares_dir, calling_prim_group, variables, monkeypatch):
+    from nfs4_share.manage import create
+    from nfs4_share.share import metadata_file
+    fabricate_a_source(source_dir, ["run/a.bam", "run/a.log", "run/tmp/b.bam", "run/qc/c.txt", "run/lane/d.bam"])
+    listed = []
+    walk = os.walk
+
+    def tracking_walk(top, **kwargs):
+        for root, subdirectories, files in walk(top, **kwargs):
+            listed.append(os.path.relpath(root, top))
+            yield root, subdirectories, files
+    monkeypatch.setattr(os, 'walk', tracking_walk)
+    share = create(shares_dir.join("share"),
+                   items=[j(source_dir, "run")],
+                   managing_groups=[calling_prim_group],
+                   domain=variables["domain_name"],
+                   include=['*.bam'], exclude=['tmp/'],
+                   service_application_accounts=variables['service_application_accounts'])
+    assert 'tmp' not in listed
+    assert sorted(os.listdir(j(share.directory, 'run'))) == ['a.bam', 'lane']  # No empty qc directory
+    assert os.path.exists(metadata_file(share.directory))
+    assert share.metadata['items'] == {os.path.realpath(j(source_dir, 'run')): {'include': ['*.bam'],
+                                                                                'exclude': ['tmp/'],
+                                                                                'symlinks': 'follow'}}
+
+
+def test_symlink_loops_are_traversed_once(tmpdir, without_acls):
+    from nfs4_share.share import Share
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a", "run/d/b"])
+    os.symlink('..', j(source, 'run', 'd', 'loop'))
+    os.symlink(j('..', 'a'), j(source, 'run', 'd', 'alias'))
+    os.symlink('d', j(source, 'run', 'd2'))
+
+    for policy, expected in [('follow', [('run', ['d'], ['a']), ('run/d', [], ['b'])]),
+                             ('skip', [('run', ['d'], ['a']), ('run/d', [], ['b'])]),
+                             ('mirror', [('run', ['d', 'd2'], ['a']), ('run/d', ['loop'], ['alias', 'b'])])]:
+        share = Share(tmpdir.join('shares', policy))
+        share.add([j(source, 'run')], symlinks=policy)
+        assert [(os.path.relpath(root, share.directory), sorted(directories), sorted(files))
+                for root, directories, files in sorted(os.walk(share.directory))][1:] == expected
+    share._unshare_linked_tree(j(share.directory, 'run'))  # Removes the mirrored symlinks, not what they point to
+    assert os.path.exists(j(source, 'run', 'd', 'b'))
+
+
+def test_filtered_add_removes_directories_of_files_that_could_not_be_linked(tmpdir, monkeypatch, without_acls):
+    from nfs4_share.share import Share, LINKED, CROSS_DEVICE
+    from nfs4_share.filters import PathFilter
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a.bam", "run/d/e/b.bam", "other/d/e/c.bam"])
+    link_files = Share._link_files
+    monkeypatch.setattr(Share, '_link_files', lambda self, source, target: (CROSS_DEVICE, "cross-device link")
+                        if source.endswith(('b.bam', 'c.bam')) else link_files(self, source, target))
+    share = Share(tmpdir.join('shares', 'share'))
+
+    results = share.add([j(source, 'run'), j(source, 'other')], PathFilter(include=['*.bam']))
+    assert [(result.status, result.reason) for result in results] == \
+        [(LINKED, "1 files could not be linked"), (CROSS_DEVICE, "none of the 1 files that pass the filter could be linked")]
+    assert [(os.path.relpath(root, share.directory), directories, files)
+            for root, directories, files in os.walk(share.directory)] == [('.', ['run'], []), ('run', [], ['a.bam'])]
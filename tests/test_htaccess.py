@@ -0,0 +1,116 @@
+import os
+from types import SimpleNamespace
+
+USER_DIRECTIVE = "Require ldap-user {}"
+GROUP_DIRECTIVE = "Require ldap-group cn={},cn=groups,cn=accounts"
+
+
+def fake_share(directory, permission_targets):
+    """A share stand-in that records the files its permissions are set on"""
+    return SimpleNamespace(directory=str(directory),
+                           permissions=SimpleNamespace(set=permission_targets.append))
+
+
+def read_lines(path):
+    with open(path, 'r') as f:
+        return [line.rstrip() for line in f]
+
+
+def test_extract_targets():
+    from nfs4_share.htaccess import extract_targets
+    lines = ['<RequireAny>', 'Require ldap-user a.b', 'Require ldap-group cn=a.b,cn=groups,cn=accounts',
+             'require LDAP-USER c', '</RequireAny>']
+    assert extract_targets(lines, USER_DIRECTIVE) == ['a.b', 'c']
+    assert extract_targets(lines, GROUP_DIRECTIVE) == ['a.b']
+
+
+def test_append_and_remove(tmpdir):
+    from nfs4_share.htaccess import create_at, append_at, remove_at
+    permission_targets = []
+    share = fake_share(tmpdir, permission_targets)
+    path = str(tmpdir.join('.htaccess.files.bioinf'))
+    create_at(share, ['user1'], USER_DIRECTIVE, ['group1'], GROUP_DIRECTIVE)
+    append_at(share, ['user2', 'user1'], USER_DIRECTIVE, ['group2'], GROUP_DIRECTIVE)
+    assert read_lines(path) == ['<RequireAny>',
+                                'Require ldap-user user1',
+                                'Require ldap-user user2',
+                                'Require ldap-group cn=group1,cn=groups,cn=accounts',
+                                'Require ldap-group cn=group2,cn=groups,cn=accounts',
+                                '</RequireAny>']
+
+    remove_at(share, ['user1', 'user1.b', 'groups'], ['group.*', 'cn', 'user2'],
+              user_directive_template=USER_DIRECTIVE, group_directive_template=GROUP_DIRECTIVE)  # Only whole fields
+    assert read_lines(path) == ['<RequireAny>',
+                                'Require ldap-user user2',
+                                'Require ldap-group cn=group1,cn=groups,cn=accounts',
+                                'Require ldap-group cn=group2,cn=groups,cn=accounts',
+                                '</RequireAny>']
+    assert len(permission_targets) == 3
+    assert sorted(os.listdir(str(tmpdir))) == ['.htaccess.files.bioinf']  # No temporary files are left behind
+
+
+def test_access_file_targets_are_indexed(monkeypatch):
+    from nfs4_share import htaccess
+    scans = []
+    extract_targets = htaccess.extract_targets
+    monkeypatch.setattr(htaccess, 'extract_targets', lambda *args: scans.append(args) or extract_targets(*args))
+    access_file = htaccess.AccessFile()
+    for name in ['user1', 'user2', 'user1']:
+        access_file.add([name], USER_DIRECTIVE)
+    assert access_file.targets(USER_DIRECTIVE) == {'user1', 'user2'} and len(scans) == 1
+    assert access_file.remove(['user1'], USER_DIRECTIVE) == {'user1'}
+    assert access_file.targets(USER_DIRECTIVE) == {'user2'} and len(scans) == 1
+    access_file.add(['user1'], USER_DIRECTIVE)
+    assert access_file.lines == ['<RequireAny>', 'Require ldap-user user2', 'Require ldap-user user1', '</RequireAny>']
+
+
+def test_access_file_with_catch_all_template():
+    from nfs4_share.htaccess import AccessFile
+    access_file = AccessFile()
+    access_file.add(['user1'], "{}")
+    access_file.add(['user2'], "{}")
+    assert access_file.lines == ['<RequireAny>', 'user1', 'user2', '</RequireAny>']
+    assert access_file.targets("{}") == {'user1', 'user2'}
+    assert access_file.remove(['<RequireAny>', 'user1'], "{}") == {'user1'}
+    assert access_file.lines == ['<RequireAny>', 'user2', '</RequireAny>']
+
+
+def test_unchanged_access_file_is_not_rewritten(tmpdir):
+    from nfs4_share.htaccess import create_at, append_at, remove_at
+    permission_targets = []
+    share = fake_share(tmpdir, permission_targets)
+    create_at(share, ['user1'], USER_DIRECTIVE, ['group1'], GROUP_DIRECTIVE)
+    mtime_ns = os.stat(str(tmpdir.join('.htaccess.files.bioinf'))).st_mtime_ns
+
+    create_at(share, ['user1'], USER_DIRECTIVE, ['group1'], GROUP_DIRECTIVE)
+    append_at(share, ['user1'], USER_DIRECTIVE, [], GROUP_DIRECTIVE)
+    remove_at(share, ['user2'], [], user_directive_template=USER_DIRECTIVE, group_directive_template=GROUP_DIRECTIVE)
+    assert len(permission_targets) == 1
+    assert os.stat(str(tmpdir.join('.htaccess.files.bioinf'))).st_mtime_ns == mtime_ns
+
+
+def test_apache_map(tmpdir):
+    from nfs4_share import apache
+    from nfs4_share.htaccess import create_at, remove_at, remove_from
+    shares = tmpdir.mkdir('shares')
+    map_file = str(tmpdir.join('shares.conf'))
+    share1, share2 = fake_share(shares.mkdir('share1'), []), fake_share(shares.mkdir('share2'), [])
+    create_at(share1, ['user1'], USER_DIRECTIVE, [], GROUP_DIRECTIVE)
+    apache.generate(shares, map_file)
+    with open(map_file, 'r') as f:
+        assert '<Directory "%s">\n    <RequireAny>\n    Require ldap-user user1\n' % share1.directory in f.read()
+
+    apache.apache_map = map_file  # Changes to access files update the map from now on
+    try:
+        create_at(share2, ['user2'], USER_DIRECTIVE, [], GROUP_DIRECTIVE)
+        remove_at(share1, ['user1'], [], user_directive_template=USER_DIRECTIVE)
+        with open(map_file, 'r') as f:
+            content = f.read()
+        assert 'Require ldap-user user2' in content and 'Require ldap-user user1' not in content
+        assert 'Require all denied' in content
+        remove_from(share2)
+    finally:
+        apache.apache_map = None
+    with open(map_file, 'r') as f:
+        assert share2.directory not in f.read()
+    assert apache.generate(shares, map_file) == {os.path.basename(apache.fragment_file(map_file, share1.directory))}
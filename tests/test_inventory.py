@@ -0,0 +1,40 @@
+import os
+import json
+from .utils import fabricate_a_source
+
+
+def test_list_single_file_share(single_file_share, shares_dir, calling_user, calling_prim_group, tmpdir):
+    from nfs4_share.inventory import list_shares
+    summaries = list_shares(shares_dir, cache_file=tmpdir.join('inventory.json'))
+    assert len(summaries) == 1
+    summary = summaries[0]
+    assert summary['share'] == single_file_share.directory
+    assert calling_user in summary['users']
+    assert calling_prim_group in summary['managing_groups']
+    assert summary['locked']
+    assert (summary['items'], summary['files']) == (1, 1)
+
+
+def test_list_reuses_cache_of_unchanged_shares(tmpdir, monkeypatch):
+    from nfs4_share import inventory
+    root = tmpdir.mkdir('shares')
+    fabricate_a_source(root, ["share1/file", "share2/dir/file"])
+    cache_file = tmpdir.join('inventory.json')
+    first = inventory.list_shares(root, cache_file=cache_file)
+    assert [summary['name'] for summary in first] == ['share1', 'share2']
+    assert [summary['files'] for summary in first] == [1, 1]
+
+    # Only the share that changed is scanned again
+    scanned = []
+    summarize_share = inventory.summarize_share
+
+    def tracking_summarize_share(share_directory, *args):
+        scanned.append(os.path.basename(share_directory))
+        return summarize_share(share_directory, *args)
+    monkeypatch.setattr(inventory, 'summarize_share', tracking_summarize_share)
+    fabricate_a_source(root, ["share2/extra_file"])
+    second = inventory.list_shares(root, cache_file=cache_file)
+    assert scanned == ['share2']
+    assert [summary['items'] for summary in second] == [1, 2]
+    with open(cache_file, 'r') as f:
+        assert sorted(json.load(f)) == [os.path.join(root, 'share1'), os.path.join(root, 'share2')]
@@ -24,3 +24,49 @@ def test_lock_on_single_file(calling_prim_group, source_dir, shares_dir, variabl
     # Try deleting it via the share_dir stuff
     delete(share_dir, domain=variables["domain_name"])
     assert not os.path.exists(j(share.directory, "file"))
+
+
+def hold_share_flock(directory, exclusive, acquired, release):
+    from nfs4_share.share import share_flock
+    with share_flock(directory, exclusive=exclusive):
+        acquired.set()
+        release.wait(10)
+
+
+def test_share_flock(tmpdir):
+    import threading
+    from nfs4_share.share import share_flock, ShareBusyError
+    share_dir = str(tmpdir.join("share"))
+    acquired, release = threading.Event(), threading.Event()
+    holder = threading.Thread(target=hold_share_flock, args=(share_dir, False, acquired, release))
+    holder.start()
+    acquired.wait(10)
+    try:
+        with share_flock(share_dir, exclusive=False, timeout=0):  # Readers do not block each other
+            pass
+        with pytest.raises(ShareBusyError):
+            with share_flock(share_dir, timeout=0.2):
+                pass
+        with share_flock(str(tmpdir.join("other_share")), timeout=0):  # Other shares are not affected
+            pass
+    finally:
+        release.set()
+        holder.join()
+    with share_flock(share_dir, timeout=0):
+        with share_flock(share_dir, exclusive=False, timeout=0):  # Nested calls join the lock already held
+            pass
+    assert os.path.exists(tmpdir.join(".share.lock"))
+
+
+def test_shared_share_flock_without_write_access(tmpdir):
+    from nfs4_share.share import share_flock, open_flock_file
+    with share_flock(str(tmpdir.join("share")), exclusive=False):
+        pass
+    with open_flock_file(str(tmpdir.join("share")), exclusive=False) as lock_file:
+        assert lock_file.mode == 'r'  # Existing lock files are opened read-only
+    tmpdir.join("root").write("")  # The lock file cannot be created
+    with share_flock(str(tmpdir.join("root", "share")), exclusive=False):
+        pass
+    with pytest.raises(OSError):
+        with share_flock(str(tmpdir.join("root", "share"))):
+            pass
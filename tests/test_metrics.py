@@ -0,0 +1,40 @@
+import os
+import multiprocessing
+
+
+def test_metrics_are_merged_into_the_textfile(tmpdir):
+    from nfs4_share import metrics, events
+    textfile = str(tmpdir.join('nfs4_share.prom'))
+
+    def run(operation):
+        with metrics.recording(textfile, operation):
+            with metrics.phase('add'):
+                events.emit('link', '/shares/share/file', source='/source/file')
+                metrics.count('nfs4_share_acl_calls_total', binary='nfs4_setfacl')
+
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run, args=('add',)) for _ in range(4)]  # Concurrent runs
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    with open(textfile) as f:
+        samples, headers = metrics.parse(f.read())
+    assert samples[('nfs4_share_operations_total', '{operation="add",status="ok"}')] == 4
+    assert samples[('nfs4_share_filesystem_operations_total', '{op="link",operation="add"}')] == 4
+    assert samples[('nfs4_share_acl_calls_total', '{binary="nfs4_setfacl",operation="add"}')] == 4
+    assert samples[('nfs4_share_phase_duration_seconds_bucket', '{le="+Inf",operation="add",phase="add"}')] == 4
+    assert headers['nfs4_share_operations_total'][1] == '# TYPE nfs4_share_operations_total counter'
+    assert [name for name in os.listdir(str(tmpdir)) if name.startswith('.')] == []  # No temporary files left
+
+    try:
+        with metrics.recording(textfile, 'delete'):
+            raise RuntimeError("failed")
+    except RuntimeError:
+        pass
+    assert events.sink is None and metrics.collector is None
+    with open(textfile) as f:
+        samples, _ = metrics.parse(f.read())
+    assert samples[('nfs4_share_operations_total', '{operation="delete",status="error"}')] == 1
+    assert samples[('nfs4_share_operations_total', '{operation="add",status="ok"}')] == 4
@@ -0,0 +1,62 @@
+def test_optimize_acl():
+    from nfs4_share.acl import AccessControlEntity
+    from nfs4_share.optimize import optimize_acl, ace_size
+    members = {'group1': {'user1', 'user2'}, 'group2': {'user3'}}.get
+
+    def ace(spec):
+        return AccessControlEntity.from_string(spec)
+    # As returned by read_entries, i.e. including duplicates
+    entries = [ace('A::user1@domain:rxtncy'),           # Covered by group1
+               ace('A::user2@domain:rwxtncy'),          # Needs more than group1 grants
+               ace('A::user3@domain:rxtncy'),           # The DENY of user3 in between keeps this one
+               ace('D::user3@domain:x'),
+               ace('A:g:group1@domain:rxtncy'),
+               ace('A:g:group1@domain:yctnxr'),         # Duplicate
+               ace('A:g:group2@domain:rxtncy'),
+               ace('A::user4@domain:rxtncy')]           # Not a member
+    optimized, removed = optimize_acl(entries, members)
+    assert [repr(entry) for entry in removed] == ['A:g:group1@domain:yctnxr', 'A::user1@domain:rxtncy']
+    assert len(optimized.entries) == 6
+    assert ace_size(ace('A::user1@domain:rxtncy')) == 16 + 12
+    assert optimize_acl(optimized, members)[1] == []
+
+
+def test_deny_entries_of_groups_the_user_may_be_in_keep_the_user_entry():
+    from nfs4_share.acl import AccessControlEntity
+    from nfs4_share.optimize import optimize_acl
+    # The users of a primary group are not enumerated (e.g. sssd without enumeration)
+    members = {'group1': {'user1', 'user2'}, 'staff': set()}.get
+    groups = {'user1': {'group1', 'staff'}}.__getitem__  # user2 is unknown
+
+    def ace(spec):
+        return AccessControlEntity.from_string(spec)
+    entries = [ace('A::user1@domain:rxtncy'),           # The DENY of its primary group in between keeps this one
+               ace('A::user2@domain:rxtncy'),           # Its groups are unknown, so the DENY may apply
+               ace('D:g:staff@domain:x'),
+               ace('A:g:group1@domain:rxtncy')]
+    assert optimize_acl(entries, members, groups)[1] == []
+    assert [repr(entry) for entry in optimize_acl(entries, members, {'user1': {'group1'}, 'user2': {'group1'}}.get)[1]] \
+        == ['A::user1@domain:rxtncy', 'A::user2@domain:rxtncy']
+
+
+def test_apply_keeps_managers_writing_in_subdirectories(tmpdir, monkeypatch):
+    from nfs4_share import optimize
+    from nfs4_share.acl import AccessControlEntity, AccessControlList
+    from nfs4_share.share import Share, LOCK_ACE
+    share_directory = tmpdir.mkdir('share')
+    share_directory.mkdir('a').mkdir('b')
+    locked = [AccessControlEntity.from_string(spec) for spec in
+              ['A::user1@domain:rxtncy', 'A:g:group1@domain:rxtncy', 'A:g:managers@domain:rxaDdtTNcCo']] + [LOCK_ACE]
+    applied = {}
+    monkeypatch.setattr(optimize, 'read_entries', lambda path: locked)
+    monkeypatch.setattr(AccessControlList, 'set', lambda self, target: applied.setdefault(str(target), self))
+    monkeypatch.setattr(AccessControlList, 'set_many',
+                        lambda self, targets, batch_size=256: applied.update((target, self) for target in targets))
+
+    report = optimize.optimize_share(share_directory, apply=True, members={'group1': {'user1'}}.get,
+                                     groups={'user1': {'group1'}}.get)
+    assert report['applied'] and report['removed'] == ['A::user1@domain:rxtncy']
+    assert 'A:g:managers@domain:rxaDdtTNcCo' in repr(applied[str(share_directory)])
+    for directory in [share_directory.join('a'), share_directory.join('a', 'b')]:
+        assert repr(applied[str(directory)]) == repr(Share.manage_write_adjusted(applied[str(share_directory)], True))
+        assert LOCK_ACE in applied[str(directory)]
@@ -0,0 +1,61 @@
+import os
+from os.path import join as j
+from .utils import fabricate_a_source
+
+
+def test_snapshot_and_restore(source_dir, shares_dir, calling_prim_group, variables):
+    from nfs4_share.manage import create, delete
+    from nfs4_share.acl import AccessControlList
+    from nfs4_share.snapshot import snapshot, restore
+    items = fabricate_a_source(source_dir, ["file", "dir/file1", "dir/sub/file2"])
+    share = create(shares_dir.join("share"),
+                   items=[items[0], j(source_dir, "dir")],
+                   managing_groups=[calling_prim_group],
+                   domain=variables["domain_name"],
+                   lock=True,
+                   service_application_accounts=variables['service_application_accounts'])
+    permissions = AccessControlList.from_file(share.directory)
+    records = snapshot(share.directory, sources=[source_dir])
+    assert records[0]['locked']
+    assert sorted(record['path'] for record in records if record['type'] == 'file') == \
+        ['dir/file1', 'dir/sub/file2', 'file']
+
+    delete(share.directory, domain=variables["domain_name"])
+    assert restore(records) == []
+    assert os.stat(j(share.directory, 'dir', 'sub', 'file2')).st_ino == os.stat(items[2]).st_ino
+    assert AccessControlList.from_file(share.directory) == permissions
+
+
+def test_restore_updates_the_apache_map(tmpdir, fake_acl_binaries):
+    from nfs4_share import apache
+    from nfs4_share.snapshot import restore, SNAPSHOT_VERSION
+    share_directory = str(tmpdir.join('shares', 'share'))
+    map_file = str(tmpdir.join('shares.conf'))
+    records = [{'type': 'share', 'version': SNAPSHOT_VERSION, 'share': share_directory, 'locked': False},
+               {'type': 'acl', 'id': 0, 'acl': 'A::EVERYONE@:rtncy'},
+               {'type': 'dir', 'path': '.', 'acl': 0},
+               {'type': 'htaccess', 'content': "<RequireAny>\nRequire ldap-user user1\n</RequireAny>\n", 'acl': 0}]
+    apache.apache_map = map_file
+    try:
+        assert restore(records) == []
+    finally:
+        apache.apache_map = None
+    with open(map_file, 'r') as f:
+        assert '<Directory "%s">\n    <RequireAny>\n    Require ldap-user user1\n' % share_directory in f.read()
+
+
+def test_snapshot_keeps_the_metadata_of_the_share(tmpdir, fake_acl_binaries):
+    import shutil
+    from nfs4_share.share import Share, metadata_file
+    from nfs4_share.snapshot import snapshot, restore
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a"])
+    share = Share(tmpdir.join('shares', 'share'))
+    share.add([j(source, 'run')], symlinks='skip')
+    metadata = share.metadata
+
+    records = snapshot(share.directory, sources=[source])
+    shutil.rmtree(share.directory)
+    os.remove(metadata_file(share.directory))
+    assert restore(records) == []
+    assert share.metadata == metadata and metadata['items'][os.path.realpath(j(source, 'run'))]['symlinks'] == 'skip'
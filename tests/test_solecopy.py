@@ -0,0 +1,46 @@
+import os
+from os.path import join as j
+from .utils import fabricate_a_source
+
+
+def test_sole_copies_grouped_by_share_and_item(tmpdir):
+    from nfs4_share.solecopy import find_sole_copies
+    source = tmpdir.mkdir('source')
+    shares = tmpdir.mkdir('shares')
+    items = fabricate_a_source(source, ["run/a.bam", "run/b.bam", "qc.txt"])
+    os.makedirs(j(shares, 'share', 'run'))
+    for item in items:
+        os.link(item, j(shares, 'share', os.path.relpath(item, source)))
+    fabricate_a_source(shares, ["share/.htaccess.files.bioinf"])
+
+    assert find_sole_copies(shares, cache_file=tmpdir.join('cache.json')) == {}
+
+    os.remove(items[0])
+    os.remove(items[2])
+    sole_copies = find_sole_copies(shares, cache_file=tmpdir.join('cache.json'))
+    assert sorted(sole_copies['share']) == ['qc.txt', 'run']
+    assert sole_copies['share']['run']['files'] == [(j(shares, 'share', 'run', 'a.bam'), os.path.getsize(items[1]))]
+    assert sole_copies['share']['run']['bytes'] == os.path.getsize(items[1])
+
+
+def test_incremental_scan_does_not_relist_unchanged_directories(tmpdir, monkeypatch):
+    from nfs4_share import walk
+    from nfs4_share.solecopy import find_sole_copies
+    source = tmpdir.mkdir('source')
+    shares = tmpdir.mkdir('shares')
+    items = fabricate_a_source(source, ["dir/file"])
+    os.makedirs(j(shares, 'share', 'dir'))
+    os.link(items[0], j(shares, 'share', 'dir', 'file'))
+    find_sole_copies(shares, cache_file=tmpdir.join('cache.json'))
+
+    listed = []
+    scandir = os.scandir
+
+    def tracking_scandir(path):
+        listed.append(str(path))
+        return scandir(path)
+    monkeypatch.setattr(walk.os, 'scandir', tracking_scandir)
+    os.remove(items[0])
+    sole_copies = find_sole_copies(shares, cache_file=tmpdir.join('cache.json'))
+    assert listed == [str(shares)]  # Only the shares root itself is listed
+    assert sole_copies['share']['dir']['files'][0][0] == j(shares, 'share', 'dir', 'file')
@@ -0,0 +1,83 @@
+import os
+from os.path import join as j
+from .utils import fabricate_a_source
+
+
+def test_sync_links_new_and_removes_vanished_files(tmpdir, monkeypatch, without_acls):
+    from nfs4_share.share import Share
+    from nfs4_share.sync import sync_share
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    monkeypatch.setattr(Share, 'lock', lambda self: None)
+    monkeypatch.setattr(Share, 'unlock', lambda self: None)
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a", "run/old", "run/d/b", "run/e/c"])
+    share = Share(tmpdir.join('shares', 'share'))
+    share.add([j(source, 'run')])
+
+    report = sync_share(share.directory)
+    assert (report['listed'], report['linked'], report['removed']) == (3, 0, 0)
+
+    fabricate_a_source(source, ["run/d/new", "run/f/g"])
+    os.remove(j(source, 'run', 'old'))
+    report = sync_share(share.directory)
+    assert (report['listed'], report['linked'], report['removed'], report['failed']) == (3, 2, 1, 1)
+    assert os.path.exists(j(share.directory, 'run', 'old'))  # The last copy is kept without force
+    assert os.path.samefile(j(share.directory, 'run', 'd', 'new'), j(source, 'run', 'd', 'new'))
+    assert os.path.samefile(j(share.directory, 'run', 'f', 'g'), j(source, 'run', 'f', 'g'))
+
+    report = sync_share(share.directory, force=True)
+    assert (report['listed'], report['removed'], report['failed']) == (1, 1, 0)  # Only the failed directory
+    assert not os.path.exists(j(share.directory, 'run', 'old'))
+
+    assert sync_share(share.directory)['listed'] == 0
+
+    for name in ['a', 'd/b', 'd/new', 'e/c', 'f/g']:
+        os.remove(j(source, 'run', name))
+    os.rmdir(j(source, 'run', 'e'))
+    report = sync_share(share.directory, force=True)
+    assert report['removed'] == 5 and not os.path.exists(j(share.directory, 'run', 'e'))
+
+    os.rename(j(source, 'run'), j(source, 'moved'))
+    report = sync_share(share.directory, force=True)
+    assert report['vanished'] == [os.path.realpath(j(source, 'run'))]
+    assert os.listdir(share.directory) == [] and share.metadata['items'] == {}
+
+
+def test_scan_files_replaced_by_directories(tmpdir):
+    from nfs4_share.sync import scan_item
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/x/y", "item/z"])
+    target = tmpdir.mkdir('share')
+    fabricate_a_source(target, ["run/x", "item"])  # Files when they were shared
+
+    operations, _, _ = scan_item(j(source, 'run'), j(target, 'run'))
+    assert [(action, target_path) for action, _, target_path, _ in operations] == \
+        [('unshare', j(target, 'run', 'x')), ('mkdir', j(target, 'run', 'x')), ('link', j(target, 'run', 'x', 'y'))]
+    operations, _, _ = scan_item(j(source, 'item'), j(target, 'item'))
+    assert [(action, target_path) for action, _, target_path, _ in operations] == \
+        [('unshare', j(target, 'item')), ('mkdir', j(target, 'item')), ('link', j(target, 'item', 'z'))]
+
+
+def test_directories_reached_through_nested_symlinks_are_shared_at_their_real_path(tmpdir, monkeypatch, without_acls):
+    from nfs4_share.share import Share
+    from nfs4_share.sync import scan_item
+    from nfs4_share.workqueue import partition
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a/x", "run/y/sub/f", "run/z/g"])
+    os.symlink(j('..', 'y', 'sub'), j(source, 'run', 'a', 'link'))  # Found before run/y/sub by a walk in name order
+    os.symlink(j('..', '..', 'z'), j(source, 'run', 'y', 'sub', 'nested'))
+    share = Share(tmpdir.join('shares', 'share'))
+    share.add([j(source, 'run')])
+
+    shared = sorted(os.path.relpath(j(root, name), share.directory)
+                    for root, directories, files in os.walk(share.directory) for name in directories + files)
+    assert shared == ['run', 'run/a', 'run/a/x', 'run/y', 'run/y/sub', 'run/y/sub/f', 'run/z', 'run/z/g']
+    assert scan_item(j(source, 'run'), j(share.directory, 'run'))[0] == []
+    units = partition(j(source, 'run'), split_depth=2)
+    assert units == [('', False), ('a', False), ('y', False), ('y/sub', True), ('z', False)]
+
+    os.makedirs(j(share.directory, 'run', 'a', 'link'))  # Shared through the symlink before
+    os.link(j(source, 'run', 'y', 'sub', 'f'), j(share.directory, 'run', 'a', 'link', 'f'))
+    operations, _, _ = scan_item(j(source, 'run'), j(share.directory, 'run'))
+    assert [(action, target) for action, _, target, _ in operations] == [('unshare', j(share.directory, 'run', 'a', 'link'))]
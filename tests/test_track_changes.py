@@ -18,9 +18,9 @@ def read_tracking_file(track_changes_dir:Path, share_name:str, files_or_users:st
     return tracked_items
 
 def get_last_n_commit_msgs(repo, branch, n):
-    """Retrieve last n git commit message"""
+    """Retrieve the messages of the last n git commits (one per line, as a commit combines all changes of an operation)"""
     commits = list(repo.iter_commits(branch, max_count=n))
-    commit_msgs = [commit.message.strip() for commit in commits]
+    commit_msgs = [line.strip() for commit in commits for line in commit.message.strip().splitlines()]
     return commit_msgs
 
 # tests #
@@ -47,7 +47,7 @@ def test_initialize_user_tracking(single_file_share, track_changes_repo, calling
     expected_tracked_users = [re.sub('Require.*(?=ldap)','',user) for user in expected_tracked_users]
     
     # test values
-    # user and item list initializations are done at the same time, thus get last 2 commits
+    # user and item list initializations are done at the same time, thus they are committed together
     commit_msgs = get_last_n_commit_msgs(track_changes_repo, 'HEAD', 2)
     tracked_users = read_tracking_file(track_changes_repo.working_dir, share_name, 'users')
 
@@ -62,7 +62,7 @@ def test_initialize_item_tracking(single_file_share, track_changes_repo):
     expected_tracked_items = sorted(list(set(os.listdir(single_file_share.directory)) - {'.htaccess.files.bioinf'}))
 
     # test values
-    # user and item list initializations are done at the same time, thus get last 2 commits
+    # user and item list initializations are done at the same time, thus they are committed together
     commit_msgs = get_last_n_commit_msgs(track_changes_repo, 'HEAD', 2)
     tracked_items = read_tracking_file(track_changes_repo.working_dir, share_name, 'files')
 
@@ -137,6 +137,7 @@ def test_user_rm_tracking(single_file_share, track_changes_repo, variables):
     # test values
     delete(single_file_share.directory, domain=variables["domain_name"], 
            users=[variables["user_to_rm_from_share"]], lock=True,
+           user_apache_directive=variables["user_directive"], group_apache_directive=variables["group_directive"],
            track_change_dir=Path(track_changes_repo.working_dir))
     tracked_users = read_tracking_file(track_changes_repo.working_dir, share_name, 'users')
     last_commit = track_changes_repo.head.commit.message
@@ -155,4 +156,94 @@ def test_share_rm_tracking(single_file_share, track_changes_repo):
     last_commit = track_changes_repo.head.commit.message
     tracking_files = set(os.listdir(track_changes_repo.working_dir))
 
-    assert (last_commit, sorted(tracking_files)) == (expected_commit_msg, sorted(expected_tracking_files))
\ No newline at end of file
+    assert (last_commit, sorted(tracking_files)) == (expected_commit_msg, sorted(expected_tracking_files))
+
+
+def test_batched_operations_tracking(single_file_share, source_dir, track_changes_repo, variables):
+    share_name = Path(single_file_share.directory).name
+    track_change_dir = Path(track_changes_repo.working_dir)
+    items = fabricate_a_source(source_dir, ['batched_file'])
+    commits_before = len(list(track_changes_repo.iter_commits('HEAD')))
+
+    with track_changes.transaction(track_change_dir):
+        add(single_file_share.directory, items=items, track_change_dir=track_change_dir)
+        add(single_file_share.directory, users=variables["multiple_new_users"], domain=variables["domain_name"],
+            user_apache_directive=variables["user_directive"], group_apache_directive=variables["group_directive"],
+            track_change_dir=track_change_dir)
+
+    commit_msgs = track_changes_repo.head.commit.message.splitlines()
+    assert len(list(track_changes_repo.iter_commits('HEAD'))) == commits_before + 1
+    assert f'[{share_name}][ITEM][ADDED]{len(items)} item(s)' in commit_msgs
+    assert 'batched_file' in read_tracking_file(track_changes_repo.working_dir, share_name, 'files')
+
+
+def test_transaction_commits_once(tmpdir):
+    track_change_dir = Path(tmpdir.mkdir('tc_transaction'))
+    repo = track_changes.initialize_track_changes_dir(track_change_dir)
+
+    with track_changes.transaction(track_change_dir):
+        track_changes.track_file_addition(track_change_dir, '/shares/share1', ['/data/file1'])
+        track_changes.track_file_addition(track_change_dir, '/shares/share2', ['/data/file2', '/data/file3'])
+        assert not repo.head.is_valid()  # Nothing is committed before the transaction ends
+
+    assert len(list(repo.iter_commits('HEAD'))) == 1
+    assert get_last_n_commit_msgs(repo, 'HEAD', 1) == ['[share1][ITEM][ADDED]1 item(s)', '[share2][ITEM][ADDED]2 item(s)']
+    assert read_tracking_file(track_change_dir, 'share2', 'files') == ['file2', 'file3']
+
+
+def test_delete_then_create_in_one_transaction(tmpdir):
+    track_change_dir = Path(tmpdir.mkdir('tc_recreate'))
+    share_directory = tmpdir.mkdir('recreated')
+    repo = track_changes.initialize_track_changes_dir(track_change_dir)
+    track_changes.track_file_addition(track_change_dir, share_directory, ['/data/old_file'])
+
+    with track_changes.transaction(track_change_dir):
+        track_changes.track_share_deletion(track_change_dir, share_directory)
+        track_changes.initialize_file_list(track_change_dir, share_directory)
+        track_changes.track_file_addition(track_change_dir, share_directory, ['/data/new_file'])
+
+    assert read_tracking_file(track_change_dir, 'recreated', 'files') == ['new_file']
+    assert ('recreated_files.txt', 0) in repo.index.entries
+    assert not repo.is_dirty(untracked_files=True)
+
+
+def add_items_concurrently(track_change_dir, share_name, group_commit_window=0):
+    track_changes.initialize_track_changes_dir(track_change_dir)
+    with track_changes.transaction(track_change_dir, group_commit_window=group_commit_window):
+        track_changes.track_file_addition(track_change_dir, f'/shares/{share_name}', [f'/data/{share_name}_file'])
+        track_changes.track_file_addition(track_change_dir, '/shares/common', [f'/data/{share_name}_file'])
+
+
+def test_concurrent_writers_lose_no_updates(tmpdir):
+    import multiprocessing
+    track_change_dir = Path(tmpdir.mkdir('tc_concurrent'))
+    repo = track_changes.initialize_track_changes_dir(track_change_dir)
+    writers = [multiprocessing.get_context('fork').Process(target=add_items_concurrently, args=(track_change_dir, f'share{i}'))
+               for i in range(8)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+        assert writer.exitcode == 0
+
+    assert len(list(repo.iter_commits('HEAD'))) == 8
+    assert read_tracking_file(track_change_dir, 'common', 'files') == sorted(f'share{i}_file' for i in range(8))
+    assert not repo.is_dirty(untracked_files=True)
+
+
+def test_group_commit(tmpdir):
+    import multiprocessing
+    track_change_dir = Path(tmpdir.mkdir('tc_group_commit'))
+    repo = track_changes.initialize_track_changes_dir(track_change_dir)
+    writers = [multiprocessing.get_context('fork').Process(target=add_items_concurrently, args=(track_change_dir, f'share{i}', 1))
+               for i in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+        assert writer.exitcode == 0
+
+    assert len(list(repo.iter_commits('HEAD'))) < 4  # At least two writers shared a commit
+    assert len(get_last_n_commit_msgs(repo, 'HEAD', 4)) == 8
+    assert read_tracking_file(track_change_dir, 'common', 'files') == sorted(f'share{i}_file' for i in range(4))
+    assert not os.listdir(Path(repo.git_dir, track_changes.QUEUE_DIRNAME))
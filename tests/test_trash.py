@@ -0,0 +1,73 @@
+import os
+from os.path import join as j
+from .utils import fabricate_a_source
+
+
+def test_trashed_share_is_reaped(tmpdir, monkeypatch, without_acls):
+    from nfs4_share.share import Share, metadata_file
+    from nfs4_share import trash
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a", "run/d/b", "run/d/e/c", "single"])
+    share = Share(tmpdir.join('shares', 'share'))
+    share.add([j(source, 'run'), j(source, 'single')])
+    os.remove(j(source, 'run', 'd', 'b'))  # The share holds the last copy
+
+    trashed = trash.move_to_trash(share)
+    assert not os.path.exists(share.directory) and not os.path.exists(metadata_file(share.directory))
+    assert os.path.exists(j(trashed, 'run', 'd', 'e', 'c'))
+
+    reports = trash.reap(tmpdir.join('shares'))
+    assert [(report['share'], report['removed'], report['kept']) for report in reports] == [(share.directory, 3, 1)]
+    assert os.listdir(trashed) == ['run'] and os.path.exists(j(trashed, 'run', 'd', 'b'))
+
+    reports = trash.reap(tmpdir.join('shares'), force=True)
+    assert [(report['removed'], report['kept']) for report in reports] == [(1, 0)]
+    assert os.listdir(tmpdir.join('shares', trash.TRASH_NAME)) == []
+    assert os.path.exists(j(source, 'run', 'd', 'e', 'c'))
+
+
+def test_trashing_a_share_with_last_copies_is_refused_without_force(tmpdir, monkeypatch, without_acls):
+    import pytest
+    from nfs4_share.share import Share
+    from nfs4_share.manage import delete
+    from nfs4_share import trash
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir.join('cache')))
+    monkeypatch.setattr(Share, 'unlock', lambda self: None)
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["run/a", "run/d/b"])
+    share = Share(tmpdir.join('shares', 'share'))
+    share.add([j(source, 'run')])
+    os.remove(j(source, 'run', 'd', 'b'))  # The share holds the last copy
+
+    with pytest.raises(FileNotFoundError, match="last copy of 1 files"):
+        delete(share.directory, trash=True, reap=False)
+    assert os.path.exists(j(share.directory, 'run', 'd', 'b'))
+
+    delete(share.directory, trash=True, reap=False, force=True)
+    assert not os.path.exists(share.directory)
+    assert [report['kept'] for report in trash.reap(tmpdir.join('shares'))] == [0]  # force is remembered
+
+
+def test_share_trashed_while_the_reaper_finishes_is_reaped(tmpdir, monkeypatch, without_acls):
+    from contextlib import contextmanager
+    from nfs4_share.share import Share
+    from nfs4_share import trash
+    source = tmpdir.mkdir('source')
+    fabricate_a_source(source, ["a", "b"])
+    shares = [Share(tmpdir.join('shares', name)) for name in ['first', 'second']]
+    for share, item in zip(shares, ['a', 'b']):
+        share.add([j(source, item)])
+    share_flock = trash.share_flock
+
+    @contextmanager
+    def trashing_second_share_before_release(directory, timeout=None):
+        with share_flock(directory, timeout=timeout):
+            yield
+            if os.path.exists(shares[1].directory):  # Its reaper would not get the lock and give up
+                trash.move_to_trash(shares[1])
+    monkeypatch.setattr(trash, 'share_flock', trashing_second_share_before_release)
+    trash.move_to_trash(shares[0])
+
+    reports = trash.reap(tmpdir.join('shares'))
+    assert [report['share'] for report in reports] == [share.directory for share in shares]
+    assert os.listdir(tmpdir.join('shares', trash.TRASH_NAME)) == []
@@ -0,0 +1,41 @@
+import os
+from os.path import join as j
+
+
+def write_bytes(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+
+
+def test_inode_set_grows():
+    from nfs4_share.inodes import InodeSet
+    inodes = InodeSet()
+    for ino in range(0, 300000, 3):
+        assert inodes.add((1, ino))
+    assert not inodes.add((1, 3))
+    assert (1, 299997) in inodes
+    assert (1, 1) not in inodes
+    assert (2, 3) not in inodes
+    assert len(inodes) == 100000
+
+
+def test_account_hard_links(tmpdir):
+    from nfs4_share.usage import account
+    source = tmpdir.mkdir('source')
+    shares = tmpdir.mkdir('shares')
+    write_bytes(j(source, 'linked_once'), 1000)
+    write_bytes(j(source, 'linked_twice'), 2000)
+    write_bytes(j(shares, 'a', 'sole'), 500)
+    write_bytes(j(shares, 'b', 'only_in_share'), 3000)
+    os.link(j(source, 'linked_once'), j(shares, 'a', 'linked_once'))
+    os.link(j(source, 'linked_twice'), j(shares, 'a', 'linked_twice'))
+    os.link(j(source, 'linked_twice'), j(shares, 'b', 'linked_twice'))
+    os.link(j(shares, 'b', 'only_in_share'), j(shares, 'b', 'only_in_share_again'))
+
+    report = account([j(shares, 'a'), j(shares, 'b')], workers=2)
+    share_a, share_b = report['shares']
+    assert (share_a['logical'], share_a['unique'], share_a['share_only'], share_a['sole_copy']) == (3500, 3500, 500, 500)
+    assert (share_b['logical'], share_b['unique'], share_b['share_only'], share_b['sole_copy']) == (8000, 5000, 3000, 0)
+    assert (report['total']['unique'], report['total']['share_only']) == (6500, 3500)
+    assert report['overlap'] == {'a|b': 2000}
@@ -104,7 +104,8 @@ def test_acl_minus_acl(calling_user, calling_prim_group, variables):
                                                 domain=variables["domain_name"],
                                                 permissions='rwadxtTnNcCoy')]
 
-    pre_share_acl = nfs4_acl.AccessControlList(pre_entries + pre_entries)
+    # Entries are removed wherever they are in the list (here the share entries equal the last two pre-entries)
+    pre_share_acl = nfs4_acl.AccessControlList(pre_entries[:1])
     with_share_acl = nfs4_acl.AccessControlList(pre_entries + share_entries + pre_entries)
     share_removed_acl = with_share_acl - nfs4_acl.AccessControlList(share_entries)
     try:
@@ -116,6 +117,22 @@ def test_acl_minus_acl(calling_user, calling_prim_group, variables):
         raise e
 
 
+def test_acl_is_an_ordered_set():
+    from nfs4_share.acl import AccessControlList, AccessControlEntity
+    from nfs4_share.share import LOCK_ACE as lock
+    user, group, other = [AccessControlEntity.from_string(spec) for spec in
+                          ['A::user@domain:rxtncy', 'A:g:group@domain:rxtncy', 'A::other@domain:rxtncy']]
+    deny = AccessControlEntity.from_string('D::other@domain:w')
+    acl = AccessControlList([lock, user, group, AccessControlEntity.from_string('A::user@domain:yctnxr')])
+    assert acl.entries == [lock, user, group]  # Permission order does not matter, duplicates are dropped
+    assert (acl + [other, deny, user]).entries == [lock, deny, user, group, other]  # DENY before the first ALLOW
+    assert (acl - [lock]).entries == [user, group]
+    assert acl.replace(user, other).entries == [lock, other, group]
+    assert acl.replace(user, group).entries == [lock, group]
+    assert user in acl and other not in acl and len(acl) == 3
+    assert hash(acl) == hash(AccessControlList(acl.entries))
+
+
 def test_importing_api():
     from nfs4_share.manage import create, delete, add
     type(create)
@@ -0,0 +1,20 @@
+def test_acl_drift():
+    from nfs4_share.acl import AccessControlEntity, AccessControlList
+    from nfs4_share.share import Share, LOCK_ACE
+    from nfs4_share.verify import normalized, drift
+
+    def ace(spec):
+        return AccessControlEntity.from_string(spec)
+    manage = ace('A:g:managers@domain:' + Share.MANAGE_PERMISSION_UNLOCK)
+    user = ace('A::user1@domain:rxtncy')
+    # A locked share: the managers lost their write permission on the share directory only
+    root = AccessControlList([LOCK_ACE, ace('A:g:managers@domain:' + Share.MANAGE_PERMISSION_LOCK), user])
+    expected = normalized(root)
+    assert expected == AccessControlList([manage, user])
+
+    assert drift([LOCK_ACE, manage, user], expected, locked=True) is None
+    assert drift([manage, user], expected, locked=True)['lock'] == 'missing'  # Missed by a shallow lock
+    assert drift([LOCK_ACE, manage, user], expected, locked=False)['lock'] == 'unexpected'
+    difference = drift([LOCK_ACE, manage, ace('A::user2@domain:rxtncy')], expected, locked=True)
+    assert (difference['missing'], difference['extra']) == (['A::user1@domain:rxtncy'], ['A::user2@domain:rxtncy'])
+    assert drift([LOCK_ACE, user, manage], expected, locked=True)['reordered']
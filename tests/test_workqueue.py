@@ -0,0 +1,87 @@
+import os
+import multiprocessing
+from os.path import join as j
+from .utils import fabricate_a_source
+
+
+def test_workers_link_distributed_units(tmpdir, monkeypatch, without_acls):
+    from nfs4_share.share import Share, LINKED, FILTERED
+    from nfs4_share.filters import PathFilter
+    from nfs4_share import workqueue
+    monkeypatch.setattr(workqueue, 'POLL_INTERVAL', 0.05)
+    source = tmpdir.mkdir('source')
+    names = ["run/a", "run/d/b", "run/d/e/c", "run/d/e/f/g", "run/h/i/j", "run/k/l.log"]
+    fabricate_a_source(source, names + ["single", "logs/x/y.log"])
+    queue = str(tmpdir.join('queue'))
+    share = Share(tmpdir.join('shares', 'share'))
+
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=workqueue.work, args=(queue,), kwargs={'idle_timeout': 2}) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    results = workqueue.add_distributed(share, [j(source, 'run'), j(source, 'single'), j(source, 'logs')],
+                                        PathFilter(exclude=['*.log']), queue=queue, split_depth=1, timeout=30)
+    for worker in workers:
+        worker.join()
+
+    assert results.counts() == {LINKED: 2, FILTERED: 1}
+    for name in names[:-1] + ["single"]:
+        assert os.path.samefile(j(share.directory, name), j(source, name))
+    assert not os.path.exists(j(share.directory, 'run', 'k'))  # Holds nothing that passes the filter
+    assert not os.path.exists(j(share.directory, 'logs'))
+    assert sorted(share.metadata['items']) == [os.path.realpath(j(source, name)) for name in ['logs', 'run', 'single']]
+    assert all(os.listdir(j(queue, state)) == [] for state in ['pending', 'claimed', 'done'])
+
+
+def test_stale_units_are_queued_again(tmpdir, monkeypatch):
+    from nfs4_share import workqueue
+    from nfs4_share.cache import dump_json
+    monkeypatch.setattr(workqueue, 'stale_after', 60)
+    queue = str(tmpdir.join('queue'))
+    dump_json(j(queue, 'pending', 'job.000000.json'), {})
+    assert workqueue.claim(queue) == 'job.000000.json' and workqueue.claim(queue) is None
+    assert workqueue.requeue_stale(queue) == []
+    claimed = j(queue, 'claimed', 'job.000000.json')
+    os.utime(claimed, (0, 0))  # The worker died
+    assert workqueue.requeue_stale(queue) == ['job.000000.json']
+    assert workqueue.claim(queue) == 'job.000000.json'
+
+
+def test_units_queued_long_ago_are_not_stale_when_claimed(tmpdir, monkeypatch):
+    from nfs4_share import workqueue
+    from nfs4_share.cache import dump_json
+    monkeypatch.setattr(workqueue, 'stale_after', 60)
+    queue = str(tmpdir.join('queue'))
+    dump_json(j(queue, 'pending', 'job.000000.json'), {})
+    os.utime(j(queue, 'pending', 'job.000000.json'), (0, 0))  # Waited in the queue
+    assert workqueue.claim(queue) == 'job.000000.json'
+    assert workqueue.requeue_stale(queue) == []
+
+
+def test_heartbeats_while_processing(tmpdir, monkeypatch):
+    import time
+    from nfs4_share import workqueue
+    from nfs4_share.cache import dump_json
+    monkeypatch.setattr(workqueue, 'stale_after', 0.4)
+    claimed = j(tmpdir, 'job.000000.json')
+    dump_json(claimed, {})
+    os.utime(claimed, (0, 0))
+    with workqueue.heartbeats(claimed):
+        time.sleep(0.3)  # E.g. scanning a large subtree
+    assert time.time() - os.stat(claimed).st_mtime < 0.4
+    os.remove(claimed)
+    with workqueue.heartbeats(claimed):  # Queued again meanwhile
+        time.sleep(0.3)
+
+
+def test_units_that_finished_twice_are_collected_once(tmpdir):
+    from nfs4_share import workqueue
+    from nfs4_share.cache import dump_json
+    queue = str(tmpdir.join('queue'))
+    for state in ['pending', 'done']:  # Queued again while its worker finished
+        dump_json(j(queue, state, 'job.000000.json'), {'error': None})
+    dump_json(j(queue, 'done', 'old.000000.json'), {})
+    os.utime(j(queue, 'done', 'old.000000.json'), (0, 0))  # Nobody collected it
+    assert workqueue.claim(queue) is None
+    assert workqueue.wait(queue, 'job', 1, timeout=1) == [{'error': None}]
+    assert all(os.listdir(j(queue, state)) == [] for state in ['pending', 'claimed', 'done'])